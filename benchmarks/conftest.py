@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  conftest.py
+#  This file is part of isbg.
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+
+
+"""Synthetic inputs of the benchmarks of isbg.
+
+The benchmarks use `pytest-benchmark`::
+
+    $ pytest benchmarks --benchmark-json=benchmarks.json
+
+They are not run with the tests (see ``testpaths`` in ``setup.cfg``), and
+``make bench`` runs them saving the results to compare them between
+commits.
+"""
+
+import os
+import sys
+
+import pytest
+
+# We add the upper dir to the path
+sys.path.insert(0, os.path.abspath(os.path.join(
+    os.path.dirname(__file__), '..')))
+
+#: Number of ``uids`` of the SEARCH responses.
+UIDS = [10 ** 3, 10 ** 4, 10 ** 5, 10 ** 6]
+#: Size in bytes of the messages.
+SIZES = [1024, 100 * 1024, 1024 * 1024, 20 * 1024 * 1024]
+#: Number of SpamAssassin reports wrapping a message.
+DEPTHS = [1, 2, 3]
+
+_LINE = b"Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do.\n"
+
+
+def make_message(size):
+    """Get a ``multipart/alternative`` message of about `size` bytes."""
+    lines = _LINE * max(size // (2 * len(_LINE)), 1)
+    return (b"From: sender@example.com\n"
+            b"To: user@example.com\n"
+            b"Subject: Benchmark message\n"
+            b"Message-ID: <bench@example.com>\n"
+            b"MIME-Version: 1.0\n"
+            b"Content-Type: multipart/alternative; boundary=\"alt\"\n\n"
+            b"--alt\nContent-Type: text/plain; charset=utf-8\n\n" + lines +
+            b"\n--alt\nContent-Type: text/html; charset=utf-8\n\n<html><p>" +
+            lines + b"</p></html>\n--alt--\n")
+
+
+def wrap_report(message, depth=1):
+    """Wrap a message `depth` times in a SpamAssassin report."""
+    for level in range(depth):
+        boundary = "----------=_report{}".format(level).encode()
+        message = (b"From: sender@example.com\n"
+                   b"To: user@example.com\n"
+                   b"Subject: [SPAM] Benchmark message\n"
+                   b"X-Spam-Status: Yes, score=12.3 required=5.0 "
+                   b"tests=BAYES_99 autolearn=no\n"
+                   b"MIME-Version: 1.0\n"
+                   b"Content-Type: multipart/mixed; boundary=\"" + boundary +
+                   b"\"\n\nThis is a multi-part message in MIME format.\n\n"
+                   b"--" + boundary + b"\n"
+                   b"Content-Type: text/plain; charset=iso-8859-1\n\n"
+                   b"Spam detection software has identified this message.\n"
+                   b"\n--" + boundary + b"\n"
+                   b"Content-Type: message/rfc822; x-spam-type=original\n"
+                   b"Content-Description: original message before SpamAssassin"
+                   b"\nContent-Disposition: inline\n"
+                   b"Content-Transfer-Encoding: 8bit\n\n" + message +
+                   b"\n--" + boundary + b"--\n")
+    return message
+
+
+@pytest.fixture(params=UIDS, ids=lambda num: "{}uids".format(num))
+def search_response(request):
+    """Get the response to a UID SEARCH with `UIDS` ``uids``."""
+    return [" ".join(str(uid) for uid in range(1, request.param + 1))]
+
+
+@pytest.fixture(params=SIZES, ids=lambda size: "{}KB".format(size // 1024))
+def message(request):
+    """Get a message of every size of `SIZES`."""
+    return make_message(request.param)
+
+
+@pytest.fixture(params=DEPTHS, ids=lambda depth: "depth{}".format(depth))
+def report(request):
+    """Get a message of 100 KB wrapped in reports `DEPTHS` times."""
+    return wrap_report(make_message(100 * 1024), request.param)
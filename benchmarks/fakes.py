@@ -0,0 +1,651 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  fakes.py
+#  This file is part of isbg.
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+
+"""In-process fake IMAP server and spamd, to load test isbg.
+
+:py:class:`FakeImapServer` speaks enough IMAP4rev1 for isbg (``SELECT``,
+``STATUS``, ``LIST``, ``APPEND``, ``EXPUNGE``, and ``UID SEARCH``,
+``FETCH``, ``STORE``, ``COPY``), optionally with ``UIDPLUS``, ``MOVE``,
+``CONDSTORE`` and ``IDLE``. :py:class:`FakeSpamd` answers the ``PROCESS``
+and ``TELL`` requests of ``spamc`` (see ``fakespamc.py``) and
+:py:class:`isbg.bulklearn.SpamdClient` with canned scores.
+
+Both inject the :py:class:`Faults` given: latency, jitter, errors, dropped
+connections and throttling.
+"""
+
+import random
+import re
+import socketserver
+import threading
+import time
+
+#: Capabilities always announced by :py:class:`FakeImapServer`.
+CAPABILITIES = ['IMAP4rev1', 'AUTH=PLAIN']
+#: Optional capabilities of :py:class:`FakeImapServer`.
+EXTENSIONS = ['UIDPLUS', 'MOVE', 'CONDSTORE', 'IDLE']
+#: Header of the synthetic spams, see :py:func:`default_score`.
+SPAM_HEADER = b"X-Fake-Spam: yes"
+
+_TOKEN_RE = re.compile(r'\s*(?:(\()|(\))|"((?:[^"\\]|\\.)*)"|'
+                       r'([^\s()"\[]+(?:\[[^\]]*\][^\s()"]*)?))')
+_LITERAL_RE = re.compile(br'\{(\d+)(\+?)\}\r?\n$')
+
+
+class Faults(object):
+    """Faults injected in every request.
+
+    Attributes:
+        latency (float): Seconds added to every request.
+        jitter (float): Random seconds, up to this, added to every request.
+        errors (float): Probability of answering a request with an error.
+        drops (float): Probability of closing the connection instead of
+            answering a request.
+        rate (float): If it's not None, the requests per second served: the
+            others wait (throttling).
+
+    """
+
+    def __init__(self, latency=0.0, jitter=0.0, errors=0.0, drops=0.0,
+                 rate=None, seed=None):
+        """Initialize a Faults object."""
+        self.latency, self.jitter = (latency, jitter)
+        self.errors, self.drops, self.rate = (errors, drops, rate)
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._next = time.monotonic()
+
+    def delay(self):
+        """Wait the latency, the jitter and the throttling of a request."""
+        wait = self.latency
+        with self._lock:
+            if self.jitter:
+                wait += self._random.uniform(0, self.jitter)
+            if self.rate:
+                now = time.monotonic()
+                self._next = max(self._next, now) + 1.0 / self.rate
+                wait += self._next - 1.0 / self.rate - now
+        if wait > 0:
+            time.sleep(wait)
+
+    def _chance(self, probability):
+        with self._lock:
+            return probability > 0 and self._random.random() < probability
+
+    def error(self):
+        """Check if an error is injected."""
+        return self._chance(self.errors)
+
+    def drop(self):
+        """Check if the connection is dropped."""
+        return self._chance(self.drops)
+
+
+class Mailbox(object):
+    """A mailbox of :py:class:`FakeImapServer`.
+
+    Attributes:
+        uidvalidity (int): Its *uidvalidity*.
+        uidnext (int): The next *uid*.
+        messages (dict): The body and the set of flags of every *uid*.
+        modseq (int): The last modification sequence (``CONDSTORE``).
+
+    """
+
+    def __init__(self, uidvalidity=1):
+        """Initialize a Mailbox object."""
+        self.uidvalidity, self.uidnext, self.modseq = (uidvalidity, 1, 1)
+        self.messages = {}
+
+    def add(self, body, flags=()):
+        """Add a message, returning its *uid*."""
+        uid = self.uidnext
+        self.uidnext += 1
+        self.modseq += 1
+        self.messages[uid] = [body, set(flags)]
+        return uid
+
+    def uids(self):
+        """Get the *uids*, sorted."""
+        return sorted(self.messages)
+
+
+def _tokens(parts):
+    """Parse the parts of a command, its text and its literals, to tokens.
+
+    The parenthesized lists are nested lists, the quoted strings are
+    unquoted and the literals are bytes.
+    """
+    stack = [[]]
+    for part in parts:
+        if isinstance(part, bytes):
+            stack[-1].append(part)
+            continue
+        pos = 0
+        text = part.rstrip('\r\n')
+        while pos < len(text):
+            match = _TOKEN_RE.match(text, pos)
+            if match is None or match.end() == pos:
+                break
+            pos = match.end()
+            if match.group(1):
+                stack.append([])
+            elif match.group(2):
+                group = stack.pop()
+                stack[-1].append(group)
+            elif match.group(3) is not None:
+                stack[-1].append(re.sub(r'\\(.)', r'\1', match.group(3)))
+            elif match.group(4):
+                stack[-1].append(match.group(4))
+    return stack[0]
+
+
+def _flags(tokens):
+    """Get a set of flags of a token or a list of tokens."""
+    if not isinstance(tokens, list):
+        tokens = [tokens]
+    return {flag for token in tokens for flag in re.split(r'[,\s]+', token)
+            if flag}
+
+
+def _uid_set(text, uids):
+    """Get the *uids* of a set like ``1,3:5,7:*``."""
+    last = uids[-1] if uids else 0
+    wanted = set()
+    for item in text.split(','):
+        low, _, high = item.partition(':')
+        low = last if low == '*' else int(low)
+        high = low if not high else (last if high == '*' else int(high))
+        low, high = min(low, high), max(low, high)
+        wanted.update(uid for uid in uids if low <= uid <= high)
+    return sorted(wanted)
+
+
+def _header(body, name):
+    """Get a header of a message, or ``None``."""
+    head = body.split(b"\r\n\r\n", 1)[0].split(b"\n\n", 1)[0]
+    match = re.search(br'(?im)^' + re.escape(name.encode()) +
+                      br':[ \t]*(.*(?:\r?\n[ \t].*)*)', head)
+    return match.group(1).decode(errors='replace') if match else None
+
+
+class _ImapHandler(socketserver.StreamRequestHandler):
+    """A connection of :py:class:`FakeImapServer`."""
+
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        """Initialize the connection."""
+        super().setup()
+        self.selected, self.readonly = (None, False)
+
+    def _send(self, data):
+        if isinstance(data, str):
+            data = data.encode()
+        self.wfile.write(data)
+
+    def _read_command(self):
+        """Read a command, with its literals, as a list of parts."""
+        parts = []
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return None
+            match = _LITERAL_RE.search(line)
+            if match is None:
+                parts.append(line.decode(errors='replace'))
+                return parts
+            parts.append(line[:match.start()].decode(errors='replace'))
+            if not match.group(2):
+                self._send(b"+ Ready for literal data\r\n")
+            parts.append(self.rfile.read(int(match.group(1))))
+
+    def handle(self):
+        """Serve the commands of the connection."""
+        server = self.server
+        self._send("* OK [CAPABILITY {}] Fake IMAP4rev1 server ready\r\n"
+                   .format(' '.join(server.capabilities)))
+        while True:
+            parts = self._read_command()
+            if parts is None:
+                return
+            tokens = _tokens(parts)
+            if len(tokens) < 2:
+                self._send("* BAD Invalid command\r\n")
+                continue
+            tag, command, args = (tokens[0], tokens[1].upper(), tokens[2:])
+            server.faults.delay()
+            if server.faults.drop():
+                return
+            if server.faults.error() and command not in ('LOGOUT',):
+                self._send("{} NO [UNAVAILABLE] Injected error\r\n".format(
+                    tag))
+                continue
+            with server.lock:
+                server.commands[command] = server.commands.get(command, 0) + 1
+                try:
+                    result = self._dispatch(tag, command, args)
+                except (IndexError, ValueError, KeyError) as exc:
+                    result = "BAD {}".format(exc)
+            self._send("{} {}\r\n".format(tag, result))
+            if command == 'LOGOUT':
+                return
+
+    def _dispatch(self, tag, command, args):
+        """Do a command, sending its untagged responses.
+
+        Returns:
+            str: The tagged response, without the tag.
+
+        """
+        if command == 'UID':
+            return self._uid(args[0].upper(), args[1:])
+        method = getattr(self, '_cmd_' + command.lower(), None)
+        if method is None:
+            return "BAD Unknown command {}".format(command)
+        return method(tag, args)
+
+    def _mailbox(self, name):
+        """Get a mailbox by its name."""
+        if name.upper() == 'INBOX':
+            name = 'INBOX'
+        return self.server.mailboxes.get(name)
+
+    def _cmd_capability(self, tag, args):
+        self._send("* CAPABILITY {}\r\n".format(
+            ' '.join(self.server.capabilities)))
+        return "OK CAPABILITY completed"
+
+    def _cmd_noop(self, tag, args):
+        return "OK NOOP completed"
+
+    def _cmd_login(self, tag, args):
+        return "OK LOGIN completed"
+
+    def _cmd_logout(self, tag, args):
+        self._send("* BYE Logging out\r\n")
+        return "OK LOGOUT completed"
+
+    def _cmd_select(self, tag, args, readonly=False):
+        mailbox = self._mailbox(args[0])
+        if mailbox is None:
+            self.selected = None
+            return "NO Mailbox does not exist"
+        self.selected, self.readonly = (mailbox, readonly)
+        self._send("* {} EXISTS\r\n* 0 RECENT\r\n".format(
+            len(mailbox.messages)))
+        self._send("* FLAGS (\\Answered \\Flagged \\Deleted \\Seen "
+                   "\\Draft)\r\n")
+        self._send("* OK [UIDVALIDITY {}] UIDs valid\r\n".format(
+            mailbox.uidvalidity))
+        self._send("* OK [UIDNEXT {}] Predicted next UID\r\n".format(
+            mailbox.uidnext))
+        if 'CONDSTORE' in self.server.capabilities:
+            self._send("* OK [HIGHESTMODSEQ {}] Highest\r\n".format(
+                mailbox.modseq))
+        return "OK [{}] {} completed".format(
+            'READ-ONLY' if readonly else 'READ-WRITE',
+            'EXAMINE' if readonly else 'SELECT')
+
+    def _cmd_examine(self, tag, args):
+        return self._cmd_select(tag, args, True)
+
+    def _cmd_close(self, tag, args):
+        self.selected = None
+        return "OK CLOSE completed"
+
+    def _cmd_status(self, tag, args):
+        mailbox = self._mailbox(args[0])
+        if mailbox is None:
+            return "NO Mailbox does not exist"
+        values = {'MESSAGES': len(mailbox.messages),
+                  'UIDNEXT': mailbox.uidnext,
+                  'UIDVALIDITY': mailbox.uidvalidity,
+                  'RECENT': 0,
+                  'UNSEEN': sum(1 for _, flags in mailbox.messages.values()
+                                if '\\Seen' not in flags),
+                  'HIGHESTMODSEQ': mailbox.modseq}
+        items = [item.upper() for item in args[1]]
+        self._send('* STATUS "{}" ({})\r\n'.format(args[0], ' '.join(
+            "{} {}".format(item, values[item]) for item in items)))
+        return "OK STATUS completed"
+
+    def _cmd_list(self, tag, args):
+        for name in sorted(self.server.mailboxes):
+            self._send('* LIST (\\HasNoChildren) "." "{}"\r\n'.format(name))
+        return "OK LIST completed"
+
+    def _cmd_append(self, tag, args):
+        mailbox = self._mailbox(args[0])
+        if mailbox is None:
+            return "NO [TRYCREATE] Mailbox does not exist"
+        flags = _flags(args[1]) if isinstance(args[1], list) else set()
+        uid = mailbox.add(args[-1], flags)
+        if 'UIDPLUS' in self.server.capabilities:
+            return "OK [APPENDUID {} {}] APPEND completed".format(
+                mailbox.uidvalidity, uid)
+        return "OK APPEND completed"
+
+    def _expunge(self, uids=None):
+        """Remove the messages deleted, sending their EXPUNGE."""
+        mailbox = self.selected
+        for uid in list(mailbox.uids()):
+            if '\\Deleted' in mailbox.messages[uid][1] and \
+                    (uids is None or uid in uids):
+                self._send("* {} EXPUNGE\r\n".format(
+                    mailbox.uids().index(uid) + 1))
+                del mailbox.messages[uid]
+                mailbox.modseq += 1
+
+    def _cmd_expunge(self, tag, args):
+        if self.selected is None:
+            return "BAD No mailbox selected"
+        self._expunge()
+        return "OK EXPUNGE completed"
+
+    def _cmd_idle(self, tag, args):
+        self._send("+ idling\r\n")
+        while True:
+            line = self.rfile.readline()
+            if not line or line.strip().upper() == b"DONE":
+                return "OK IDLE terminated"
+
+    def _uid(self, command, args):
+        """Do a UID command."""
+        if self.selected is None:
+            return "BAD No mailbox selected"
+        if command == 'SEARCH':
+            return self._search(args)
+        if command == 'EXPUNGE' and 'UIDPLUS' in self.server.capabilities:
+            self._expunge(set(_uid_set(args[0], self.selected.uids())))
+            return "OK UID EXPUNGE completed"
+        uids = _uid_set(args[0], self.selected.uids())
+        if command == 'FETCH':
+            return self._fetch(uids, args[1])
+        if command == 'STORE':
+            return self._store(uids, args[1], args[2])
+        if command == 'COPY' or (command == 'MOVE' and
+                                 'MOVE' in self.server.capabilities):
+            return self._copy(uids, args[1], command)
+        return "BAD Unknown UID command {}".format(command)
+
+    def _search(self, args):
+        """Do a UID SEARCH, with the criteria used by isbg."""
+        mailbox = self.selected
+        criteria = []
+        for arg in args:
+            criteria.extend(arg if isinstance(arg, list) else [arg])
+        found = []
+        for uid in mailbox.uids():
+            body, flags = mailbox.messages[uid]
+            if self._match(uid, body, flags, list(criteria)):
+                found.append(str(uid))
+        self._send("* SEARCH {}\r\n".format(' '.join(found)).replace(
+            " \r\n", "\r\n"))
+        return "OK SEARCH completed"
+
+    @staticmethod
+    def _match(uid, body, flags, criteria):
+        """Check if a message matches all the search criteria."""
+        while criteria:
+            key = criteria.pop(0).upper()
+            if key in ('ALL', 'CHARSET') or key == 'US-ASCII':
+                if key == 'CHARSET':
+                    criteria.pop(0)
+                continue
+            simple = {'SEEN': '\\Seen', 'FLAGGED': '\\Flagged',
+                      'DELETED': '\\Deleted', 'ANSWERED': '\\Answered'}
+            if key in simple:
+                if simple[key] not in flags:
+                    return False
+            elif key.startswith('UN') and key[2:] in simple:
+                if simple[key[2:]] in flags:
+                    return False
+            elif key == 'SMALLER':
+                if len(body) >= int(criteria.pop(0)):
+                    return False
+            elif key == 'LARGER':
+                if len(body) <= int(criteria.pop(0)):
+                    return False
+            elif key == 'KEYWORD':
+                if criteria.pop(0) not in flags:
+                    return False
+            elif key == 'UNKEYWORD':
+                if criteria.pop(0) in flags:
+                    return False
+            elif key == 'HEADER':
+                name, value = (criteria.pop(0), criteria.pop(0))
+                if value not in (_header(body, name) or ''):
+                    return False
+            elif key == 'UID':
+                if uid not in _uid_set(criteria.pop(0), [uid]):
+                    return False
+            else:
+                raise ValueError("Unknown search key {}".format(key))
+        return True
+
+    def _fetch(self, uids, items):
+        """Do a UID FETCH of the data items used by isbg."""
+        mailbox = self.selected
+        items = items if isinstance(items, list) else [items]
+        for uid in uids:
+            body, flags = mailbox.messages[uid]
+            data = [b"UID " + str(uid).encode()]
+            for item in items:
+                upper = item.upper()
+                if upper in ('BODY[]', 'BODY.PEEK[]', 'RFC822'):
+                    name = 'RFC822' if upper == 'RFC822' else 'BODY[]'
+                    data.append(b"%s {%d}\r\n%s" % (name.encode(), len(body),
+                                                    body))
+                    if not upper.startswith('BODY.PEEK') and \
+                            not self.readonly:
+                        flags.add('\\Seen')
+                elif upper.startswith(('BODY[HEADER', 'BODY.PEEK[HEADER')):
+                    section = item[item.index('['):]
+                    names = re.findall(r'[\w-]+', section.split('(')[1]) \
+                        if '(' in section else None
+                    head = body.split(b"\r\n\r\n", 1)[0].split(
+                        b"\n\n", 1)[0]
+                    if names is not None:
+                        head = b"\r\n".join(
+                            "{}: {}".format(name, _header(body, name))
+                            .encode() for name in names
+                            if _header(body, name) is not None)
+                    head += b"\r\n\r\n"
+                    data.append(b"BODY%s {%d}\r\n%s" % (
+                        section.encode(), len(head), head))
+                elif upper == 'FLAGS':
+                    data.append("FLAGS ({})".format(' '.join(
+                        sorted(flags))).encode())
+                elif upper == 'RFC822.SIZE':
+                    data.append(b"RFC822.SIZE %d" % len(body))
+                elif upper != 'UID':
+                    raise ValueError("Unknown fetch item {}".format(item))
+            self._send(b"* %d FETCH (%s)\r\n" % (
+                mailbox.uids().index(uid) + 1, b" ".join(data)))
+        return "OK FETCH completed"
+
+    def _store(self, uids, item, values):
+        """Do a UID STORE of flags."""
+        mailbox = self.selected
+        item = item.upper()
+        flags = _flags(values)
+        for uid in uids:
+            current = mailbox.messages[uid][1]
+            if item.startswith('+'):
+                current.update(flags)
+            elif item.startswith('-'):
+                current.difference_update(flags)
+            else:
+                current.clear()
+                current.update(flags)
+            mailbox.modseq += 1
+            if not item.endswith('.SILENT'):
+                self._send("* {} FETCH (UID {} FLAGS ({}))\r\n".format(
+                    mailbox.uids().index(uid) + 1, uid,
+                    ' '.join(sorted(current))))
+        return "OK STORE completed"
+
+    def _copy(self, uids, name, command):
+        """Do a UID COPY or a UID MOVE."""
+        target = self._mailbox(name)
+        if target is None:
+            return "NO [TRYCREATE] Mailbox does not exist"
+        new = [target.add(self.selected.messages[uid][0],
+                          self.selected.messages[uid][1] - {'\\Deleted'})
+               for uid in uids]
+        if command == 'MOVE':
+            for uid in uids:
+                self.selected.messages[uid][1].add('\\Deleted')
+            self._expunge(set(uids))
+        if 'UIDPLUS' in self.server.capabilities and uids:
+            return "OK [COPYUID {} {} {}] {} completed".format(
+                target.uidvalidity, ','.join(map(str, uids)),
+                ','.join(map(str, new)), command)
+        return "OK {} completed".format(command)
+
+
+class FakeImapServer(socketserver.ThreadingTCPServer):
+    """An IMAP server, in background, with the mailboxes in memory.
+
+    Attributes:
+        mailboxes (dict): The :py:class:`Mailbox` of every name.
+        capabilities (list(str)): The capabilities announced.
+        faults (Faults): The faults injected.
+        commands (dict): Number of requests of every command.
+        lock (threading.Lock): Serializes the commands.
+
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, mailboxes=('INBOX',), extensions=EXTENSIONS,
+                 faults=None, host='127.0.0.1', port=0):
+        """Initialize a FakeImapServer object."""
+        super().__init__((host, port), _ImapHandler)
+        self.mailboxes = {name: Mailbox(num + 1)
+                          for num, name in enumerate(mailboxes)}
+        self.capabilities = CAPABILITIES + list(extensions)
+        self.faults = faults or Faults()
+        self.commands = {}
+        self.lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def port(self):
+        """The TCP port of the server."""
+        return self.server_address[1]
+
+    def start(self):
+        """Serve in a background thread."""
+        self._thread = threading.Thread(target=self.serve_forever,
+                                        name="fakeimap")
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """Stop serving."""
+        self.shutdown()
+        self.server_close()
+
+
+def default_score(body):
+    """Score a message: ``10.0`` if it has :py:data:`SPAM_HEADER`."""
+    return 10.0 if SPAM_HEADER in body.split(b"\n\n", 1)[0] else 1.0
+
+
+class _SpamdHandler(socketserver.StreamRequestHandler):
+    """A request to :py:class:`FakeSpamd`."""
+
+    disable_nagle_algorithm = True
+
+    def handle(self):
+        """Answer a ``PROCESS``, ``CHECK`` or ``TELL`` request."""
+        server = self.server
+        request = self.rfile.readline().decode(errors='replace').split()
+        headers = {}
+        while True:
+            line = self.rfile.readline()
+            if not line or not line.strip():
+                break
+            name, _, value = line.decode(errors='replace').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        body = self.rfile.read(int(headers.get('content-length', 0)))
+        with server.children:
+            server.faults.delay()
+            if server.faults.drop():
+                return
+            with server.lock:
+                server.requests += 1
+            if not request or server.faults.error():
+                self.wfile.write(b"SPAMD/1.1 76 Bad header line\r\n\r\n")
+                return
+            if request[0] == 'TELL':
+                with server.lock:
+                    server.told.append(headers.get('message-class'))
+                self.wfile.write(b"SPAMD/1.1 0 EX_OK\r\nDidSet: local\r\n\r\n")
+                return
+            score = server.score(body)
+            spam = score >= server.required
+            status = "{}, score={:.1f} required={:.1f} tests=FAKE".format(
+                'Yes' if spam else 'No', score, server.required)
+            processed = "X-Spam-Status: {}\r\n".format(status).encode() + \
+                body
+            self.wfile.write(
+                "SPAMD/1.1 0 EX_OK\r\nSpam: {} ; {:.1f} / {:.1f}\r\n"
+                "Content-length: {}\r\n\r\n".format(
+                    spam, score, server.required,
+                    len(processed)).encode() + processed)
+
+
+class FakeSpamd(socketserver.ThreadingTCPServer):
+    """A spamd, in background, that scores with a function.
+
+    Attributes:
+        score (callable): Gets the score of the bytes of a message.
+        required (float): The score of the spams.
+        faults (Faults): The faults injected.
+        requests (int): Number of requests answered.
+        told (list(str)): The class of every message learned.
+        children (threading.Semaphore): Limits the requests served at the
+            same time, like the children of spamd.
+
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, score=default_score, required=5.0, faults=None,
+                 children=5, host='127.0.0.1', port=0):
+        """Initialize a FakeSpamd object."""
+        super().__init__((host, port), _SpamdHandler)
+        self.score, self.required = (score, required)
+        self.faults = faults or Faults()
+        self.children = threading.BoundedSemaphore(children)
+        self.requests, self.told = (0, [])
+        self.lock = threading.Lock()
+        self._thread = None
+
+    port = FakeImapServer.port
+    start = FakeImapServer.start
+    stop = FakeImapServer.stop
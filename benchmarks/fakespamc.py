@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  fakespamc.py
+#  This file is part of isbg.
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+
+"""A ``spamc`` that talks to :py:class:`fakes.FakeSpamd`.
+
+It supports the options of ``spamc`` used by isbg: ``-E``, ``-d host``,
+``-p port``, ``--learntype=type`` and ``--max-size=bytes``. Without ``-d``
+and ``-p`` it uses the spamd of :py:data:`ENVIRON` (``host:port``).
+
+:py:func:`install` writes a ``spamc`` that runs it in a directory, to be
+added to the ``PATH``.
+"""
+
+import os
+import socket
+import stat
+import sys
+
+#: Environment variable with the ``host:port`` of the spamd used.
+ENVIRON = 'FAKESPAMD'
+
+#: Exit codes of ``spamc``.
+EX_OK, EX_ISSPAM, EX_UNAVAILABLE, EX_IOERR = (0, 1, 69, 74)
+
+
+def _request(host, port, head, body):
+    """Send a request to spamd, returning its status, headers and body."""
+    with socket.create_connection((host, port)) as sock:
+        sock.sendall(head + b"Content-length: %d\r\n\r\n" % len(body) + body)
+        sock.shutdown(socket.SHUT_WR)
+        data = b""
+        while True:
+            chunk = sock.recv(65536)
+            if not chunk:
+                break
+            data += chunk
+    head, _, body = data.partition(b"\r\n\r\n")
+    lines = head.decode(errors='replace').split("\r\n")
+    return lines[0].split(None, 2), lines[1:], body
+
+
+def main(argv=None, stdin=None, stdout=None):
+    """Run ``spamc``, returning its exit code."""
+    argv = sys.argv[1:] if argv is None else argv
+    stdin = stdin or sys.stdin.buffer
+    stdout = stdout or sys.stdout.buffer
+    host, _, port = os.environ.get(ENVIRON, 'localhost:783').partition(':')
+    exitcode, learntype = (False, None)
+    args = list(argv)
+    while args:
+        arg = args.pop(0)
+        if arg == '-E':
+            exitcode = True
+        elif arg == '-d':
+            host = args.pop(0)
+        elif arg == '-p':
+            port = args.pop(0)
+        elif arg.startswith('--learntype='):
+            learntype = arg.split('=', 1)[1]
+    body = stdin.read()
+
+    try:
+        if learntype is not None:
+            mclass = {'ham': 'ham'}.get(learntype, 'spam')
+            action = 'Remove' if learntype == 'forget' else 'Set'
+            status, _, _ = _request(
+                host, int(port), b"TELL SPAMC/1.3\r\nMessage-class: " +
+                mclass.encode() + b"\r\n" + action.encode() +
+                b": local\r\n", body)
+        else:
+            status, headers, result = _request(
+                host, int(port), b"PROCESS SPAMC/1.3\r\n", body)
+    except OSError:
+        stdout.write(body)
+        return EX_UNAVAILABLE
+    if len(status) < 2 or status[1] != '0':
+        stdout.write(body)
+        return EX_IOERR if learntype is None else EX_UNAVAILABLE
+
+    if learntype is not None:
+        stdout.write(b"Message successfully un/learned\n")
+        return EX_OK
+    stdout.write(result)
+    spam = any(line.lower().startswith('spam: true') for line in headers)
+    return EX_ISSPAM if exitcode and spam else EX_OK
+
+
+def install(directory):
+    """Write a ``spamc`` executable that runs :py:func:`main`.
+
+    Returns:
+        str: The file written.
+
+    """
+    filename = os.path.join(directory, 'spamc')
+    with open(filename, 'w') as fhandle:
+        fhandle.write("#!{}\nimport sys\nsys.path.insert(0, {!r})\n"
+                      "import fakespamc\nsys.exit(fakespamc.main())\n".format(
+                          sys.executable, os.path.dirname(
+                              os.path.abspath(__file__))))
+    os.chmod(filename, os.stat(filename).st_mode | stat.S_IXUSR)
+    return filename
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,259 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  loadtest.py
+#  This file is part of isbg.
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+
+"""End-to-end load test of isbg with a fake IMAP server and a fake spamd.
+
+It fills the mailboxes of a :py:class:`fakes.FakeImapServer` with synthetic
+messages, and runs :py:meth:`isbg.isbg.ISBG.do_isbg` against it with
+``--spamc``, using ``fakespamc.py`` and a :py:class:`fakes.FakeSpamd`::
+
+    $ python benchmarks/loadtest.py --messages 2000 --size 20000 \\
+        --imap-latency 0.005 --spamd-latency 0.05 --spamd-errors 0.01
+
+It reports the messages per second, the 99th percentile of the latency of
+the messages and of the IMAP commands, and the peak RSS of isbg and of the
+``spamc`` processes.
+"""
+
+import argparse
+import io
+import json
+import logging
+import os
+import random
+import resource
+import sys
+import tempfile
+
+# We add the upper dir to the path
+sys.path.insert(0, os.path.abspath(os.path.join(
+    os.path.dirname(__file__), '..')))
+
+import fakes  # noqa: E402
+import fakespamc  # noqa: E402
+from isbg import eventlog, isbg, timing  # noqa: E402
+
+#: The folders of the synthetic account.
+INBOX, SPAMBOX, LEARNSPAM, LEARNHAM = ('INBOX', 'INBOX.Spam',
+                                       'INBOX.LearnSpam', 'INBOX.LearnHam')
+
+_LINE = b"Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do.\r\n"
+
+
+def make_message(num, size, spam=False):
+    """Get a synthetic message of about `size` bytes.
+
+    Args:
+        num (int): Number of the message, for its ``Message-ID``.
+        size (int): Its size in bytes.
+        spam (bool): If it's a spam for :py:func:`fakes.default_score`.
+
+    Returns:
+        bytes: The message.
+
+    """
+    head = (b"From: sender%d@example.com\r\n"
+            b"To: user@example.com\r\n"
+            b"Subject: Load test message %d\r\n"
+            b"Date: Mon, 01 Jan 2024 00:00:00 +0000\r\n"
+            b"Message-ID: <load%d@example.com>\r\n" % (num, num, num))
+    if spam:
+        head += fakes.SPAM_HEADER + b"\r\n"
+    lines = _LINE * max((size - len(head)) // len(_LINE), 1)
+    return head + b"\r\n" + lines
+
+
+def fill(server, folder, count, size=2048, spamratio=0.2, seed=None):
+    """Append `count` synthetic messages to a mailbox of `server`.
+
+    The sizes are drawn from an exponential distribution of mean `size`,
+    like those of real mailboxes: many small messages and a long tail.
+    """
+    rnd = random.Random(seed)
+    mailbox = server.mailboxes.setdefault(folder, fakes.Mailbox(
+        len(server.mailboxes) + 1))
+    with server.lock:
+        for _ in range(count):
+            num = mailbox.uidnext
+            mailbox.add(make_message(
+                num, int(rnd.expovariate(1.0 / size)) + 256,
+                rnd.random() < spamratio))
+
+
+def _peak_rss():
+    """Get the peak RSS, in KiB, of this process and of its children."""
+    scale = 1024 if sys.platform == 'darwin' else 1  # bytes in macOS
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // scale,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss // scale)
+
+
+def run_load(messages=100, size=2048, spamratio=0.2, learn=0, seed=0,
+             imap_faults=None, spamd_faults=None,
+             extensions=fakes.EXTENSIONS, children=5, **options):
+    """Run isbg against a synthetic account, measuring it.
+
+    Args:
+        messages (int): Number of messages of the inbox.
+        size (int): Mean size of the messages in bytes.
+        spamratio (float): Fraction of spams.
+        learn (int): Number of messages of the learn folders.
+        seed (int): Seed of the synthetic messages.
+        imap_faults (fakes.Faults): Faults of the IMAP server.
+        spamd_faults (fakes.Faults): Faults of spamd.
+        extensions (list(str)): Optional capabilities of the IMAP server.
+        children (int): Requests served by spamd at the same time.
+        **options: Attributes of :py:class:`isbg.isbg.ISBG` (e.g. ``delete``
+            or ``maxsize``).
+
+    Returns:
+        dict: The ``messages`` processed, the ``spams``, the ``seconds``, the
+        ``rate`` (messages per second), the ``p99_ms`` latency of the
+        messages, the ``imap_p99_ms`` of every IMAP command, the
+        ``peak_rss_kb`` of isbg and of spamc (``spamc_peak_rss_kb``), the
+        requests of the IMAP server (``imap_commands``) and of spamd
+        (``spamd_requests``), and the ``error`` that has aborted the run
+        (e.g. an error injected in the IMAP server) or ``None``.
+
+    """
+    imapd = fakes.FakeImapServer([INBOX, SPAMBOX, LEARNSPAM, LEARNHAM],
+                                 extensions, imap_faults).start()
+    spamd = fakes.FakeSpamd(faults=spamd_faults, children=children).start()
+    environ = {name: os.environ.get(name) for name in ('PATH',
+                                                       fakespamc.ENVIRON)}
+    try:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            fill(imapd, INBOX, messages, size, spamratio, seed)
+            fill(imapd, LEARNSPAM, learn, size, 1.0, seed)
+            fill(imapd, LEARNHAM, learn, size, 0.0, seed)
+            fakespamc.install(tmpdir)
+            os.environ['PATH'] = tmpdir + os.pathsep + environ['PATH']
+            os.environ[fakespamc.ENVIRON] = "127.0.0.1:{}".format(spamd.port)
+
+            sbg = isbg.ISBG()
+            sbg.logger.setLevel(logging.WARNING)
+            sbg.imapsets.host, sbg.imapsets.port = ('127.0.0.1', imapd.port)
+            sbg.imapsets.nossl, sbg.imapsets.user = (True, 'load')
+            sbg.imapsets.passwd = 'load'
+            sbg.imapsets.spaminbox = SPAMBOX
+            if learn:
+                sbg.imapsets.learnspambox = LEARNSPAM
+                sbg.imapsets.learnhambox = LEARNHAM
+            sbg.spamc, sbg.partialrun, sbg.maxsize = (True, None, 10 ** 9)
+            sbg.ignorelockfile, sbg.nostats = (True, True)
+            sbg.trackfile = os.path.join(tmpdir, 'track')
+            sbg.ledgerfile = os.path.join(tmpdir, 'ledger.jsonl')
+            for name, value in options.items():
+                setattr(sbg, name, value)
+            stream = io.StringIO()
+            sbg.eventlog = eventlog.EventLog(stream)
+            try:
+                sbg.do_isbg()
+            except isbg.ISBGError as exc:
+                error = str(exc).strip()
+            else:
+                error = None
+    finally:
+        for name, value in environ.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+        imapd.stop()
+        spamd.stop()
+
+    latency = timing.Histogram()
+    for line in stream.getvalue().splitlines():
+        event = json.loads(line)
+        if event['event'] == 'message':
+            latency.observe(sum(event.get(name + '_ms') or 0 for name in
+                                ('fetch', 'unwrap', 'scan', 'action')) / 1000)
+    run = sbg.timings.phase('run')
+    spams = sbg.results[INBOX].numspam if INBOX in sbg.results else 0
+    rss, spamc_rss = _peak_rss()
+    return {'messages': run.count, 'spams': spams,
+            'seconds': run.seconds, 'rate': run.rate,
+            'p99_ms': latency.quantile(0.99) * 1000,
+            'imap_p99_ms': {command: stats.latency.quantile(0.99) * 1000
+                            for command, stats in
+                            sbg.imap.stats.commands.items()},
+            'peak_rss_kb': rss, 'spamc_peak_rss_kb': spamc_rss,
+            'imap_commands': dict(imapd.commands),
+            'spamd_requests': spamd.requests, 'error': error}
+
+
+def report(result):
+    """Get the lines of text of a :py:func:`run_load` result."""
+    lines = ["{messages} messages ({spams} spams) in {seconds:.3f}s, "
+             "{rate:.1f} msgs/s, p99 {p99_ms:.1f}ms".format(**result),
+             "peak RSS {peak_rss_kb} KiB, spamc {spamc_peak_rss_kb} KiB, "
+             "{spamd_requests} spamd requests".format(**result)]
+    lines += ["{}: p99 {:.1f}ms".format(command, millis) for command, millis
+              in sorted(result['imap_p99_ms'].items())]
+    if result['error'] is not None:
+        lines.append("Aborted: {}".format(result['error']))
+    return lines
+
+
+def main(argv=None):
+    """Run the load test from the command line."""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument('--messages', type=int, default=500)
+    parser.add_argument('--size', type=int, default=4096,
+                        help="mean size of the messages in bytes")
+    parser.add_argument('--spamratio', type=float, default=0.2)
+    parser.add_argument('--learn', type=int, default=0,
+                        help="messages of every learn folder")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--no-extensions', action='store_true',
+                        help="announce only IMAP4rev1")
+    parser.add_argument('--children', type=int, default=5,
+                        help="requests served by spamd at the same time")
+    for server in ('imap', 'spamd'):
+        for fault, kind in (('latency', float), ('jitter', float),
+                            ('errors', float), ('drops', float),
+                            ('rate', float)):
+            parser.add_argument('--{}-{}'.format(server, fault), type=kind,
+                                default=None if fault == 'rate' else 0.0)
+    parser.add_argument('--record', help="record the sessions to a file, "
+                        "to replay them with isbg --replay")
+    parser.add_argument('--recordbodies', default='keep')
+    parser.add_argument('--json', action='store_true')
+    args = parser.parse_args(argv)
+
+    def faults(server):
+        return fakes.Faults(seed=args.seed, **{
+            fault: getattr(args, '{}_{}'.format(server, fault))
+            for fault in ('latency', 'jitter', 'errors', 'drops', 'rate')})
+
+    result = run_load(args.messages, args.size, args.spamratio, args.learn,
+                      args.seed, faults('imap'), faults('spamd'),
+                      [] if args.no_extensions else fakes.EXTENSIONS,
+                      args.children, recordfile=args.record,
+                      recordbodies=args.recordbodies)
+    if args.json:
+        sys.stdout.write(json.dumps(result, sort_keys=True) + "\n")
+    else:
+        sys.stdout.write("".join(line + "\n" for line in report(result)))
+    return result
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  test_bench_imaputils.py
+#  This file is part of isbg.
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+
+
+"""Benchmarks of imaputils module."""
+
+import pytest
+
+from isbg import imaputils
+
+pytest.importorskip("pytest_benchmark")
+
+
+@pytest.mark.benchmark(group="new_message")
+def test_new_message(benchmark, message):
+    """Benchmark new_message from bytes."""
+    mail = benchmark(imaputils.new_message, message)
+    assert mail.is_multipart()
+
+
+@pytest.mark.benchmark(group="new_message")
+def test_new_message_str(benchmark, message):
+    """Benchmark new_message from str."""
+    mail = benchmark(imaputils.new_message, message.decode())
+    assert mail.is_multipart()
+
+
+@pytest.mark.benchmark(group="mail_content")
+def test_mail_content(benchmark, message):
+    """Benchmark mail_content."""
+    mail = imaputils.new_message(message)
+    assert len(benchmark(imaputils.mail_content, mail)) >= len(message)
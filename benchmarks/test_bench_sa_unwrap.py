@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  test_bench_sa_unwrap.py
+#  This file is part of isbg.
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+
+
+"""Benchmarks of sa_unwrap module."""
+
+import email
+
+import pytest
+
+from isbg import sa_unwrap
+
+pytest.importorskip("pytest_benchmark")
+
+
+@pytest.mark.benchmark(group="unwrap")
+def test_unwrap_bytes(benchmark, report):
+    """Benchmark unwrap of the bytes of a report."""
+    assert len(benchmark(sa_unwrap.unwrap, report)) == 1
+
+
+@pytest.mark.benchmark(group="unwrap")
+def test_unwrap_message(benchmark, report):
+    """Benchmark unwrap of a report already parsed."""
+    mail = email.message_from_bytes(report)
+    assert len(benchmark(sa_unwrap.unwrap, mail)) == 1
+
+
+@pytest.mark.benchmark(group="unwrap")
+def test_unwrap_not_wrapped(benchmark, message):
+    """Benchmark unwrap of a message without report."""
+    mail = email.message_from_bytes(message)
+    assert benchmark(sa_unwrap.unwrap, mail) is None
@@ -0,0 +1,42 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  test_bench_spamproc.py
+#  This file is part of isbg.
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+
+
+"""Benchmarks of spamproc module."""
+
+import pytest
+
+from isbg import spamproc
+
+pytest.importorskip("pytest_benchmark")
+
+
+@pytest.mark.benchmark(group="get_formated_uids")
+def test_get_formated_uids(benchmark, search_response):
+    """Benchmark get_formated_uids, with all but the 100 newest uids past.
+
+    It's a mailbox already tracked, that has received 100 new messages.
+    """
+    pastuids = list(range(1, len(search_response[0].split()) - 99))
+    uids, newpastuids = benchmark(spamproc.SpamAssassin.get_formated_uids,
+                                  search_response, pastuids, 50)
+    assert len(uids) == 50
+    assert newpastuids == pastuids
@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  test_bench_utils.py
+#  This file is part of isbg.
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+
+
+"""Benchmarks of utils module."""
+
+import pytest
+
+from isbg import utils
+
+from conftest import UIDS, make_message, wrap_report
+
+pytest.importorskip("pytest_benchmark")
+
+
+def _fetch_response(num):
+    """Get a response of IMAP like that of a UID FETCH of `num` flags."""
+    return [(b"%d (UID %d FLAGS (\\Seen))" % (uid, uid), b")")
+            for uid in range(1, num + 1)]
+
+
+@pytest.mark.benchmark(group="get_ascii_or_value")
+@pytest.mark.parametrize("num", UIDS[:3], ids=lambda num: "{}uids".format(num))
+def test_get_ascii_or_value(benchmark, num):
+    """Benchmark get_ascii_or_value of a FETCH response."""
+    response = _fetch_response(num)
+    assert len(benchmark(utils.get_ascii_or_value, response)) == num
+
+
+@pytest.mark.benchmark(group="score_from_mail")
+def test_score_from_mail(benchmark, message):
+    """Benchmark score_from_mail of the output of spamassassin."""
+    result = wrap_report(message).decode()
+    assert benchmark(utils.score_from_mail, result) == "12.3/5.0\n"
+
+
+@pytest.mark.benchmark(group="shorten")
+@pytest.mark.parametrize("size", [1024, 1024 * 1024],
+                         ids=lambda size: "{}KB".format(size // 1024))
+def test_shorten(benchmark, size):
+    """Benchmark shorten of the nested values logged with --verbose."""
+    body = make_message(size).decode()
+    value = {'uid': [body, (body, {'flags': [body] * 10})] * 10}
+    short = benchmark(utils.shorten, value, 140)
+    assert len(short['uid'][0]) <= 140
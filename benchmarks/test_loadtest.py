@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  test_loadtest.py
+#  This file is part of isbg.
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+
+
+"""Small end-to-end runs of the load test harness."""
+
+import imaplib
+import json
+
+import fakes
+import loadtest
+from isbg import imaputils, isbg
+
+
+def test_fake_imap_server():
+    """Test the commands of the fake IMAP server used by isbg."""
+    server = fakes.FakeImapServer(['INBOX', 'Spam']).start()
+    try:
+        loadtest.fill(server, 'INBOX', 3, 512, 0.0, seed=1)
+        imap = imaputils.IsbgImap4('127.0.0.1', server.port, True)
+        imap.login('user', 'passwd')
+        assert imap.get_uidvalidity('Spam') == 2
+        imap.select('INBOX')
+        assert imap.uid("SEARCH", None, "ALL")[1] == ['1 2 3']
+        assert imap.uid("SEARCH", None, "SMALLER", "1") == ('OK', [''])
+        res = imap.uid("FETCH", "2", "(BODY.PEEK[])")
+        assert "UID 2" in res[1][0][0]
+        assert res[1][0][1].encode() == \
+            server.mailboxes['INBOX'].messages[2][0]
+        imap.uid("STORE", "2", "+FLAGS.SILENT", "(\\Seen,\\Deleted)")
+        assert imap.uid("SEARCH", None, "(DELETED)")[1] == ['2']
+        assert imap.uid("COPY", "2", "Spam")[0] == 'OK'
+        imap.expunge()
+        assert sorted(server.mailboxes['INBOX'].messages) == [1, 3]
+        assert len(server.mailboxes['Spam'].messages) == 1
+        imap.logout()
+    finally:
+        server.stop()
+
+
+def test_fake_imap_server_faults():
+    """Test the errors injected in the fake IMAP server."""
+    server = fakes.FakeImapServer().start()
+    try:
+        imap = imaplib.IMAP4('127.0.0.1', server.port)
+        server.faults = fakes.Faults(errors=1.0)
+        assert imap.noop()[0] == 'NO'
+        imap.logout()
+    finally:
+        server.stop()
+
+
+def test_run_load():
+    """Test a run of isbg against the fake servers."""
+    result = loadtest.run_load(messages=20, spamratio=0.5, learn=2)
+    assert result['error'] is None
+    assert result['messages'] == 20
+    assert 0 < result['spams'] < 20
+    assert result['rate'] > 0
+    assert result['p99_ms'] > 0
+    assert result['peak_rss_kb'] > 0
+    # The messages scanned and the learned ones
+    assert result['spamd_requests'] == 24
+    assert 'FETCH' in result['imap_p99_ms']
+    assert len(loadtest.report(result)) > 2
+
+
+def test_run_load_faults():
+    """Test a run with dropped connections and spamd errors."""
+    result = loadtest.run_load(
+        messages=20, imap_faults=fakes.Faults(drops=0.05, seed=3),
+        spamd_faults=fakes.Faults(errors=0.2, latency=0.001, seed=3),
+        extensions=[])
+    assert result['error'] is None
+    # The messages with scan errors are deferred to the next run
+    assert 0 < result['messages'] < 20
+
+
+def test_record_replay(tmpdir):
+    """Test a run recorded against the fake servers is replayed.
+
+    The replay doesn't use nor change the trackfile of the account, nor
+    writes to the ledger.
+    """
+    filename = str(tmpdir.join("recording"))
+    tmpdir.join("trackinbox").write(json.dumps(
+        {'uidvalidity': 1, 'uids': list(range(1, 11))}))
+    result = loadtest.run_load(messages=10, spamratio=0.5, learn=1,
+                               recordfile=filename, recordbodies='redact')
+    sbg = isbg.ISBG()
+    sbg.imapsets.user, sbg.imapsets.spaminbox = ('load', loadtest.SPAMBOX)
+    sbg.imapsets.learnspambox = loadtest.LEARNSPAM
+    sbg.imapsets.learnhambox = loadtest.LEARNHAM
+    sbg.spamc, sbg.partialrun, sbg.maxsize = (True, None, 10 ** 9)
+    sbg.ignorelockfile, sbg.nostats = (True, True)
+    sbg.trackfile = str(tmpdir.join("track"))
+    sbg.ledgerfile = str(tmpdir.join("ledger.jsonl"))
+    sbg.replayfile, sbg.replayspeed = (filename, 0)
+    sbg.do_isbg()
+    assert sbg.results[loadtest.INBOX].nummsg == result['messages']
+    assert sbg.results[loadtest.INBOX].numspam == result['spams']
+    assert sbg.trackfile == str(tmpdir.join("track"))
+    assert json.loads(tmpdir.join("trackinbox").read())['uids'] == \
+        list(range(1, 11))
+    assert sorted(tmpdir.listdir()) == [tmpdir.join("recording"),
+                                        tmpdir.join("trackinbox")]
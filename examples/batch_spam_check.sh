@@ -17,5 +17,9 @@ for username in "${!usernames[@]}"
 do
     isbg --delete --expunge --imaphost $hostname --imapuser $username \
     --imappasswd ${usernames[$username]} --imapinbox INBOX \
-    --spaminbox INBOX.Spam --noninteractive
+    --spaminbox INBOX.Spam --noninteractive &
 done
+
+# Every account has its own lock file, so they can be processed at the
+# same time
+wait
@@ -17,5 +17,9 @@ for username in "${!usernames[@]}"
 do
     isbg --teachonly --imaphost $hostname --imapuser $username \
     --imappasswd ${usernames[$username]} --learnhambox INBOX \
-    --learnspambox INBOX.Spam --noninteractive
+    --learnspambox INBOX.Spam --noninteractive &
 done
+
+# Every account has its own lock file, so they can be processed at the
+# same time
+wait
@@ -46,7 +46,11 @@ if __package__ is None and not hasattr(sys, 'frozen'):
     # direct call of __main__.py
     path = os.path.realpath(os.path.abspath(__file__))
     sys.path.insert(0, os.path.dirname(os.path.dirname(path)))
+from isbg import fuzzy  # noqa: E402
 from isbg import isbg  # noqa: E402
+from isbg import learnlocal  # noqa: E402
+from isbg import ledger  # noqa: E402
+from isbg import recording  # noqa: E402
 
 
 def __cmd_opts__():  # noqa: D207
@@ -74,45 +78,113 @@ Command line Options::
   --dryrun               Do not actually make any changes.
   --delete               The spams will be marked for deletion from
                          your inbox.
+  --backlogshare frac    Fraction of --partialrun used to scan the oldest
+                         unscanned messages instead of the newest ones
+                         [default: 0.0].
+  --bulklearn num        Learn sending 'num' messages at the same time to
+                         spamd (started with --allow-tell), instead of
+                         calling spamc for every message.
+  --checkpoint num       Sync to disk the journal of processed messages
+                         every 'num' messages [default: 10].
+  --checkpointinterval secs
+                         Sync to disk the journal of processed messages at
+                         least every 'secs' seconds [default: 5.0].
   --deletehigherthan #   Delete any spam with a score higher than #.
+  --eventlog file        Write an event of every message, and of the run,
+                         as JSON lines to 'file' ('-' for stderr).
   --exitcodes            Use exitcodes to detail  what happened.
+  --exportmbox dir       Export the learn folders to 'dir'/spam.mbox and
+                         'dir'/ham.mbox, to learn them with
+                         'isbg learn-local'.
   --expunge              Cause marked for deletion messages to also be
                          deleted (only useful if --delete is
                          specified).
   --flag                 The spams will be flagged in your inbox.
+  --fuzzydistance bits   Consider spam, without scanning them, the messages
+                         which differ in 'bits' bits or less of the
+                         fingerprint of a recently found spam. 3 is the
+                         sane range, at most 10 is accepted.
   --gmail                Delete by copying to '[Gmail]/Trash' folder.
   --ignorelockfile       Don't stop if lock file is present.
   --imappasswd passwd    IMAP account password.
   --imapport port        Use a custom port.
   --imapinbox mbox       Name of your inbox folder [Default: INBOX].
+  --keywords             Mark the messages scanned and learned with IMAP
+                         keywords, and search them besides using the
+                         track files.
   --learnspambox mbox    Name of your learn spam folder.
   --learnhambox mbox     Name of your learn ham folder.
   --learnthendestroy     Mark learnt messages for deletion.
   --learnthenflag        Flag learnt messages.
+  --learnspamd host      The 'host[:port]' of the spamd used by --bulklearn
+                         [default: localhost].
+  --learnsync            Sync the Bayes journal once the messages are
+                         learned, if the spamd that learns them is local.
   --learnunflagged       Only learn if unflagged
                          (for  --learnthenflag).
   --learnflagged         Only learn flagged.
+  --leasefile file       Claim the account in this SQLite database, shared
+                         between nodes, instead of using the lock file.
+  --leasettl secs        Seconds that the claim of --leasefile lasts if
+                         its node stops renewing it [default: 300].
+  --ledger file          Append a record of every run to 'file', by
+                         default the ledger in the cache directory, to
+                         summarize them with 'isbg stats'.
+  --localspamd host      The 'host[:port]' of a spamd started with --local
+                         used for the local scans of --tierband with
+                         --spamc.
   --lockfilegrace=<min>  Set the lifetime of the lock file
                          [default: 240.0].
   --lockfilename file    Override the lock file name.
+  --max-runtime secs     Stop scanning and learning after 'secs' seconds,
+                         leaving the remaining messages for the next run.
+                         Meanwhile, scan batches of --partialrun messages
+                         while the time left is enough for another one.
+  --metrics-file file    Write the Prometheus metrics of every run to 'file'
+                         (a .prom file of the node_exporter textfile
+                         collector).
   --maxsize numbytes     Messages larger than this will be ignored as
                          they are unlikely to be spam.
   --movehamto mbox       Move ham to folder.
   --noninteractive       Prevent interactive requests.
   --noreport             Don't include the SpamAssassin report in the
                          message copied to your spam folder.
+  --nofsync              Don't sync to disk the journal of processed
+                         messages: it only survives crashes of isbg.
   --nostats              Don't print stats.
+  --parallel             Learn with another IMAP connection while the inbox
+                         is scanned, giving way to the inbox scan.
   --partialrun num       Stop operation after scanning 'num' unseen
-                         emails. Use 0 to run without partial run
-                         [default: 50].
+                         emails (or every batch of --max-runtime). Use 0
+                         to run without partial run [default: 50].
   --passwdfilename fn    Use a file to supply the password.
+  --profile dir          Profile every phase of the run with cProfile and
+                         write 'dir'/<phase>.pstats and the collapsed
+                         stacks 'dir'/<phase>.collapsed for flame graphs.
+  --record file          Record the IMAP and scanner sessions, with their
+                         timings, to 'file' to replay them with --replay.
+  --recordbodies mode    Record the message bodies as they are ('keep'),
+                         only their SHA-256 ('hash') or 'redact' them
+                         [default: keep].
+  --replay file          Replay the sessions recorded in 'file' instead of
+                         connecting to the IMAP server and the scanner,
+                         without changing the state of the account.
+  --replayspeed factor   Replay 'factor' times faster than recorded, 0 to
+                         not wait [default: 1.0].
   --savepw               Store the password to be used in future runs.
+  --scantimeout secs     Kill the scan of a message after 'secs' seconds
+                         and leave it for the next run.
+  --slowest num          Show with the stats the 'num' slowest messages of
+                         every phase [default: 5].
   --spamc                Use spamc instead of standalone SpamAssassin
                          binary.
   --spaminbox mbox       Name of your spam folder
                          [Default: INBOX.Spam].
   --nossl                Don't use SSL to connect to the IMAP server.
   --teachonly            Don't search spam, just learn from folders.
+  --tierband score       Scan first only with the local tests, and scan
+                         again with all the tests only the messages whose
+                         score is within 'score' points of the threshold.
   --trackfile file       Override the trackfile name.
   --verbose              Show IMAP stuff happening.
   --verbose-mails        Show mail bodies (extra-verbose).
@@ -192,6 +264,96 @@ def parse_args(sbg):
             raise isbg.ISBGError(isbg.__exitcodes__['flags'],
                                  "Size " + repr(sbg.maxsize) + " is too small")
 
+    if opts.get("--fuzzydistance") is not None:
+        try:
+            sbg.fuzzydistance = int(opts["--fuzzydistance"])
+        except (TypeError, ValueError):
+            raise isbg.ISBGError(isbg.__exitcodes__['flags'],
+                                 "Unrecognised distance - " +
+                                 opts["--fuzzydistance"])
+        if not 0 <= sbg.fuzzydistance <= fuzzy.MAX_DISTANCE:
+            raise isbg.ISBGError(isbg.__exitcodes__['flags'],
+                                 "Distance " + repr(sbg.fuzzydistance) +
+                                 " must be between 0 and " +
+                                 str(fuzzy.MAX_DISTANCE))
+
+    if opts.get("--tierband") is not None:
+        try:
+            sbg.tierband = float(opts["--tierband"])
+        except ValueError:
+            raise isbg.ISBGError(isbg.__exitcodes__['flags'],
+                                 "Unrecognized score - " + opts["--tierband"])
+        if sbg.tierband < 0:
+            raise isbg.ISBGError(isbg.__exitcodes__['flags'],
+                                 "Score " + repr(sbg.tierband) +
+                                 " must be 0 or higher")
+    sbg.localspamd = opts.get('--localspamd', sbg.localspamd)
+
+    for opt, attr in [("--scantimeout", "scantimeout"),
+                      ("--max-runtime", "maxruntime")]:
+        if opts.get(opt) is not None:
+            try:
+                setattr(sbg, attr, float(opts[opt]))
+            except ValueError:
+                raise isbg.ISBGError(isbg.__exitcodes__['flags'],
+                                     "Unrecognized seconds - " + opts[opt])
+            if getattr(sbg, attr) <= 0:
+                raise isbg.ISBGError(isbg.__exitcodes__['flags'],
+                                     "Seconds " + repr(getattr(sbg, attr)) +
+                                     " must be higher than 0")
+
+    try:
+        sbg.backlogshare = float(opts.get("--backlogshare", sbg.backlogshare))
+    except ValueError:
+        raise isbg.ISBGError(isbg.__exitcodes__['flags'],
+                             "Unrecognized fraction - " +
+                             opts["--backlogshare"])
+    if not 0 <= sbg.backlogshare <= 1:
+        raise isbg.ISBGError(isbg.__exitcodes__['flags'],
+                             "Fraction " + repr(sbg.backlogshare) +
+                             " must be between 0 and 1")
+
+    try:
+        sbg.checkpointevery = int(opts.get("--checkpoint",
+                                           sbg.checkpointevery))
+        sbg.checkpointinterval = float(opts.get("--checkpointinterval",
+                                                sbg.checkpointinterval))
+    except ValueError:
+        raise isbg.ISBGError(isbg.__exitcodes__['flags'],
+                             "Unrecognized checkpoint - " +
+                             opts["--checkpoint"] + ", " +
+                             opts["--checkpointinterval"])
+    if sbg.checkpointevery < 1 or sbg.checkpointinterval < 0:
+        raise isbg.ISBGError(isbg.__exitcodes__['flags'],
+                             "Checkpoint must be 1 or higher")
+    sbg.checkpointfsync = not opts.get('--nofsync', False)
+    sbg.keywords = opts.get('--keywords', False)
+    sbg.parallel = opts.get('--parallel', False)
+
+    if opts.get("--bulklearn") is not None:
+        try:
+            sbg.bulklearn = int(opts["--bulklearn"])
+        except ValueError:
+            raise isbg.ISBGError(isbg.__exitcodes__['flags'],
+                                 "Unrecognized number - " +
+                                 opts["--bulklearn"])
+        if sbg.bulklearn < 1:
+            raise isbg.ISBGError(isbg.__exitcodes__['flags'],
+                                 "Number " + repr(sbg.bulklearn) +
+                                 " must be 1 or higher")
+    sbg.learnspamd = opts.get('--learnspamd', sbg.learnspamd)
+
+    try:
+        sbg.slowest = int(opts.get("--slowest", sbg.slowest))
+    except ValueError:
+        raise isbg.ISBGError(isbg.__exitcodes__['flags'],
+                             "Unrecognized number - " + opts["--slowest"])
+    if sbg.slowest < 0:
+        raise isbg.ISBGError(isbg.__exitcodes__['flags'],
+                             "Number " + repr(sbg.slowest) +
+                             " must be 0 or higher")
+    sbg.learnsync = opts.get('--learnsync', False)
+
     sbg.movehamto = opts.get('--movehamto')
 
     if opts["--noninteractive"] is True:
@@ -199,7 +361,18 @@ def parse_args(sbg):
 
     sbg.noreport = opts.get('--noreport', sbg.noreport)
 
-    sbg.lockfilename = opts.get('--lockfilename', sbg.lockfilename)
+    sbg.leasefile = opts.get('--leasefile', sbg.leasefile)
+    try:
+        sbg.leasettl = float(opts.get('--leasettl', sbg.leasettl))
+    except ValueError:
+        raise isbg.ISBGError(isbg.__exitcodes__['flags'],
+                             "Unrecognized seconds - " + opts["--leasettl"])
+    if sbg.leasettl <= 0:
+        raise isbg.ISBGError(isbg.__exitcodes__['flags'],
+                             "Seconds " + repr(sbg.leasettl) +
+                             " must be higher than 0")
+    if opts.get('--lockfilename') is not None:
+        sbg.lockfilename = opts['--lockfilename']
 
     sbg.trackfile = opts.get('--trackfile', sbg.trackfile)
 
@@ -224,6 +397,29 @@ def parse_args(sbg):
     sbg.passwdfilename = opts.get('--passwdfilename', sbg.passwdfilename)
 
     sbg.imaplist = opts.get('--imaplist', sbg.imaplist)
+    sbg.exportmbox = opts.get('--exportmbox', sbg.exportmbox)
+    sbg.metricsfile = opts.get('--metrics-file', sbg.metricsfile)
+    sbg.eventlogfile = opts.get('--eventlog', sbg.eventlogfile)
+    sbg.profiledir = opts.get('--profile', sbg.profiledir)
+    sbg.ledgerfile = opts.get('--ledger', sbg.ledgerfile)
+    sbg.recordfile = opts.get('--record', sbg.recordfile)
+    sbg.recordbodies = opts.get('--recordbodies', sbg.recordbodies)
+    if sbg.recordbodies not in recording.BODIES:
+        raise isbg.ISBGError(isbg.__exitcodes__['flags'],
+                             "Unrecognized mode - " + sbg.recordbodies)
+    sbg.replayfile = opts.get('--replay', sbg.replayfile)
+    try:
+        sbg.replayspeed = float(opts.get('--replayspeed', sbg.replayspeed))
+    except ValueError:
+        raise isbg.ISBGError(isbg.__exitcodes__['flags'],
+                             "Unrecognized factor - " + opts["--replayspeed"])
+    if sbg.replayspeed < 0:
+        raise isbg.ISBGError(isbg.__exitcodes__['flags'],
+                             "Factor " + repr(sbg.replayspeed) +
+                             " must be 0 or higher")
+    if sbg.recordfile is not None and sbg.replayfile is not None:
+        raise isbg.ISBGError(isbg.__exitcodes__['flags'],
+                             "--record and --replay are incompatible")
 
     sbg.learnunflagged = opts.get('--learnunflagged', sbg.learnunflagged)
     sbg.learnflagged = opts.get('--learnflagged', sbg.learnflagged)
@@ -233,6 +429,9 @@ def parse_args(sbg):
 
     sbg.teachonly = opts.get('--teachonly', sbg.teachonly)
     sbg.spamc = opts.get('--spamc', sbg.spamc)
+    if sbg.tierband is not None and sbg.spamc and sbg.localspamd is None:
+        raise isbg.ISBGError(isbg.__exitcodes__['flags'],
+                             "--tierband with --spamc requires --localspamd")
 
     sbg.exitcodes = opts.get('--exitcodes', sbg.exitcodes)
 
@@ -249,9 +448,18 @@ def main():
 
     When the main function ends, it throw a sys.exit with 0 if it has end ok
     or one of the :py:data:`isbg.isbg.__exitcodes__`
+
+    ``isbg learn-local`` runs :py:func:`isbg.learnlocal.isbg_learn_local`,
+    and ``isbg stats`` runs :py:func:`isbg.ledger.isbg_stats`.
     """
     sbg = isbg.ISBG()
     try:
+        if sys.argv[1:2] == ['learn-local']:
+            learnlocal.isbg_learn_local(sys.argv[1:])
+            return None
+        if sys.argv[1:2] == ['stats']:
+            ledger.isbg_stats(sys.argv[1:])
+            return None
         if parse_args(sbg) == 1:  # usage option
             sys.exit(0)
         return sbg.do_isbg()  # return the exit code.
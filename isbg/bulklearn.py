@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  bulklearn.py
+#  This file is part of isbg.
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+
+"""Bulk learning for isbg - IMAP Spam Begone.
+
+Instead of starting a ``spamc --learntype`` for every message,
+:py:class:`SpamdClient` sends the messages to ``spamd`` with the ``TELL``
+command of its protocol, and :py:class:`BulkLearner` sends several of them
+at the same time.
+
+``spamd`` must be started with ``--allow-tell``. To not sync the Bayes
+database after every message, ``bayes_learn_to_journal 1`` can be set in
+its configuration and the journal synced once with :py:func:`sync_bayes`.
+It syncs only the local database: the journal of a remote ``spamd`` must
+be synced in its host.
+
+.. versionadded:: 2.3.0
+"""
+
+import concurrent.futures
+import getpass
+import logging
+import socket
+
+from subprocess import TimeoutExpired
+
+from isbg import imaputils
+from isbg import utils
+
+from .utils import __
+
+#: Version of the ``spamc``/``spamd`` protocol used.
+PROTOCOL_VERSION = "1.5"
+#: Hosts of a local ``spamd``.
+LOCAL_HOSTS = ('', 'localhost', '127.0.0.1')
+
+
+class SpamdClient(object):
+    """Client of the ``TELL`` command of ``spamd``.
+
+    ``spamd`` closes the connection after every request, so a connection is
+    opened for every message.
+
+    Attributes:
+        host (str): The ``spamd`` host.
+        port (int): The ``spamd`` port.
+        user (str): The user whose Bayes database is trained, by default the
+            current user (as ``spamc`` does).
+
+    """
+
+    def __init__(self, host='localhost', port=783, user=None):
+        """Initialize a SpamdClient object."""
+        self.host = host
+        self.port = int(port)
+        self.user = user if user is not None else getpass.getuser()
+
+    def tell(self, mail, learn_type, timeout=None):
+        """Learn a message.
+
+        Args:
+            mail (email.message.Message, bytes): The message.
+            learn_type (str): ``spam``, ``ham`` or ``forget``.
+            timeout (float): Seconds to wait for ``spamd``.
+
+        Returns:
+            int, int: The same codes that :py:func:`isbg.spamproc.learn_mail`:
+            ``5`` if it has been learned, ``6`` if it was already learned,
+            ``-9999`` if ``spamd`` cannot be reached, or the error code of
+            ``spamd``. And the original ``spamd`` code.
+
+        Raises:
+            subprocess.TimeoutExpired: If ``spamd`` has not answered in
+                `timeout` seconds.
+
+        """
+        body = mail if isinstance(mail, bytes) else \
+            imaputils.mail_content(mail)
+        if isinstance(body, str):
+            body = body.encode(errors='replace')
+        if learn_type == 'forget':
+            headers = "Remove: local\r\n"
+        else:
+            headers = "Message-class: {}\r\nSet: local\r\n".format(learn_type)
+        request = ("TELL SPAMC/{}\r\n{}User: {}\r\nContent-length: {}\r\n\r\n"
+                   ).format(PROTOCOL_VERSION, headers, self.user,
+                            len(body)).encode('ascii') + body
+        try:
+            with socket.create_connection((self.host, self.port),
+                                          timeout) as sock:
+                sock.sendall(request)
+                sock.shutdown(socket.SHUT_WR)
+                response = b""
+                while True:
+                    data = sock.recv(4096)
+                    if not data:
+                        break
+                    response += data
+        except socket.timeout:
+            raise TimeoutExpired("spamd TELL", timeout)
+        except OSError:
+            return -9999, None
+
+        lines = response.decode(errors='ignore').split("\r\n")
+        try:
+            code = int(lines[0].split()[1])
+        except (IndexError, ValueError):
+            return -9999, None
+        if code != 0:
+            return code, code
+        for line in lines[1:]:
+            if line.split(':')[0] in ('DidSet', 'DidRemove'):
+                return 5, code
+        return 6, code
+
+
+class BulkLearner(object):
+    """Learn messages with a :py:class:`SpamdClient` in parallel.
+
+    Attributes:
+        client (SpamdClient): The client used.
+        workers (int): Maximum number of messages learned at the same time.
+
+    """
+
+    def __init__(self, client, workers=4):
+        """Initialize a BulkLearner object."""
+        self.client = client
+        self.workers = workers
+        self._executor = concurrent.futures.ThreadPoolExecutor(workers)
+
+    def submit(self, mail, learn_type, timeout=None):
+        """Start to learn a message.
+
+        Returns:
+            concurrent.futures.Future: The result of
+            :py:meth:`SpamdClient.tell`.
+
+        """
+        return self._executor.submit(self.client.tell, mail, learn_type,
+                                     timeout)
+
+    def close(self):
+        """Wait for the messages submitted."""
+        self._executor.shutdown(wait=True)
+
+
+def sync_bayes(timeout=None, logger=None, spamd=None):
+    """Sync the Bayes journal with ``sa-learn --sync``.
+
+    Args:
+        timeout (float): Seconds to wait for ``sa-learn``.
+        logger (logging.Logger): Where the errors are written.
+        spamd (str): The ``host[:port]`` of the ``spamd`` that has learned
+            the messages. If it's not local, ``sa-learn`` is not run: its
+            journal is in its host, where it has to be synced.
+
+    Returns:
+        int: The exit code of ``sa-learn``, ``None`` if it cannot be run or
+        ``spamd`` is not local.
+
+    """
+    if logger is None:
+        logger = logging.getLogger(__name__)
+    host = (spamd or '').partition(':')[0]
+    if host not in LOCAL_HOSTS and host != socket.gethostname():
+        logger.info(__("The Bayes journal of {} is left to be synced in "
+                       "its host".format(spamd)))
+        return None
+    try:
+        proc = utils.popen(["sa-learn", "--sync"])
+        utils.communicate(proc, b"", timeout)
+    except (OSError, TimeoutExpired) as exc:
+        logger.warning(__("Cannot sync the Bayes journal: {}".format(exc)))
+        return None
+    if proc.returncode != 0:
+        logger.warning(__("sa-learn --sync returned {}".format(
+            proc.returncode)))
+    return proc.returncode
@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  coordination.py
+#  This file is part of isbg.
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+
+"""Coordination of several isbg nodes processing the same accounts.
+
+Before processing an account, a node claims a *lease* on it. The lease
+expires after `ttl` seconds unless its owner renews it (a *heartbeat*), so
+the accounts of a node that dies are taken over by the other nodes once
+their leases expire.
+
+:py:class:`Coordinator` is the interface of the backends, and
+:py:class:`SqliteLeases` stores the leases in a SQLite database that can
+be in a shared file system.
+
+.. versionadded:: 2.3.0
+"""
+
+import contextlib
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+
+from .utils import __
+
+
+class Coordinator(object):
+    """Interface of the coordination backends.
+
+    Attributes:
+        owner (str): Who claims the leases, by default ``host:pid``.
+        ttl (float): Seconds that a lease lasts if it's not renewed.
+
+    """
+
+    #: Logger object used to show debug info.
+    logger = logging.getLogger(__name__)
+
+    def __init__(self, owner=None, ttl=300.0):
+        """Initialize a Coordinator object."""
+        if owner is None:
+            owner = "{}:{}".format(socket.gethostname(), os.getpid())
+        self.owner = owner
+        self.ttl = ttl
+        self._heartbeats = {}
+
+    def acquire(self, key):
+        """Claim the lease of `key`.
+
+        Returns:
+            bool: ``True`` if the lease is ours: it was free, expired or
+            already ours.
+
+        """
+        raise NotImplementedError
+
+    def renew(self, key):
+        """Extend our lease of `key` for another `ttl` seconds.
+
+        Returns:
+            bool: ``False`` if the lease is not ours anymore.
+
+        """
+        raise NotImplementedError
+
+    def holder(self, key):
+        """Get the owner of the lease of `key`, ``None`` if it's free."""
+        raise NotImplementedError
+
+    def _remove(self, key):
+        """Remove our lease of `key`."""
+        raise NotImplementedError
+
+    def release(self, key):
+        """Stop the heartbeat and free our lease of `key`."""
+        stop = self._heartbeats.pop(key, None)
+        if stop is not None:
+            stop.set()
+        self._remove(key)
+
+    def heartbeat(self, key, interval=None, lost=None):
+        """Renew the lease of `key` in background until it's released.
+
+        Args:
+            key (str): The lease key.
+            interval (float): Seconds between renewals, by default a third
+                of `ttl`.
+            lost (callable): If it's not None, it's called when the lease is
+                lost: it has been taken by another node, or it has not been
+                renewed for `ttl` seconds because of errors.
+
+        """
+        if interval is None:
+            interval = self.ttl / 3
+        stop = threading.Event()
+        self._heartbeats[key] = stop
+
+        def beat():
+            renewed = time.monotonic()
+            while not stop.wait(interval):
+                try:
+                    if self.renew(key):
+                        renewed = time.monotonic()
+                        continue
+                    self.logger.error(__(
+                        "The lease of {} has been taken by {}".format(
+                            key, self.holder(key))))
+                except Exception:  # pylint: disable=broad-except
+                    self.logger.exception(__(
+                        "Error renewing the lease of {}".format(key)))
+                    if time.monotonic() - renewed < self.ttl:
+                        continue
+                    self.logger.error(__(
+                        "The lease of {} has expired".format(key)))
+                if lost is not None:
+                    lost()
+                return
+
+        thread = threading.Thread(target=beat, name="lease " + key)
+        thread.daemon = True
+        thread.start()
+
+
+class SqliteLeases(Coordinator):
+    """Leases stored in a SQLite database.
+
+    The database could be in a shared file system to coordinate several
+    nodes, as long as it supports the locks used by SQLite. The expirations
+    are wall clock times, so the clocks of the nodes should be synchronized.
+
+    Attributes:
+        filename (str): The database file name.
+
+    """
+
+    def __init__(self, filename, owner=None, ttl=300.0):
+        """Initialize a SqliteLeases object."""
+        Coordinator.__init__(self, owner, ttl)
+        self.filename = filename
+        with self._transaction() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS leases (key TEXT " +
+                         "PRIMARY KEY, owner TEXT, expires REAL)")
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        """Open a connection with a transaction that locks the database.
+
+        Every thread uses its own connection.
+        """
+        conn = sqlite3.connect(self.filename, timeout=30,
+                               isolation_level=None)
+        try:
+            os.chmod(self.filename, 0o600)
+        except Exception:  # pylint: disable=broad-except
+            pass
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+        finally:
+            conn.close()
+
+    def acquire(self, key):
+        """Claim the lease of `key`, see :py:meth:`Coordinator.acquire`."""
+        now = time.time()
+        with self._transaction() as conn:
+            row = conn.execute("SELECT owner, expires FROM leases " +
+                               "WHERE key = ?", (key,)).fetchone()
+            if row is not None and row[0] != self.owner:
+                if row[1] > now:
+                    return False
+                self.logger.warning(__(
+                    "Taking over the expired lease of {} from {}".format(
+                        key, row[0])))
+            conn.execute("INSERT OR REPLACE INTO leases VALUES (?, ?, ?)",
+                         (key, self.owner, now + self.ttl))
+        return True
+
+    def renew(self, key):
+        """Extend our lease of `key`, see :py:meth:`Coordinator.renew`."""
+        with self._transaction() as conn:
+            return conn.execute(
+                "UPDATE leases SET expires = ? WHERE key = ? AND owner = ?",
+                (time.time() + self.ttl, key, self.owner)).rowcount > 0
+
+    def holder(self, key):
+        """Get the owner of the lease of `key`, ``None`` if it's free."""
+        with self._transaction() as conn:
+            row = conn.execute("SELECT owner FROM leases WHERE key = ? AND " +
+                               "expires > ?", (key, time.time())).fetchone()
+        return row[0] if row else None
+
+    def _remove(self, key):
+        """Remove our lease of `key`."""
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM leases WHERE key = ? AND owner = ?",
+                         (key, self.owner))
@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  eventlog.py
+#  This file is part of isbg.
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+
+"""Structured event log of isbg - IMAP Spam Begone.
+
+The events are written as JSON lines, one object per event with its time
+(``ts``), its type (``event``) and its fields::
+
+    {"ts": 1700000000.1, "event": "message", "folder": "INBOX", "uid": 7,
+     "size": 2048, "fetch_ms": 12.1, "unwrap_ms": 0.2, "scan_ms": 840.3,
+     "score": "3.1/5.0", "action": "ham", "action_ms": 0.0}
+
+The events are:
+
+``message``
+    A message scanned or learned.
+``folder``
+    The results of a folder at the end of the run.
+``run``
+    The end of a run.
+
+.. versionadded:: 2.3.0
+"""
+
+import json
+import sys
+import threading
+import time
+
+
+class EventLog(object):
+    """Write events as JSON lines.
+
+    Attributes:
+        stream (file): Where the events are written.
+
+    """
+
+    def __init__(self, stream):
+        """Initialize a EventLog object."""
+        self.stream = stream
+        self._lock = threading.Lock()
+
+    @classmethod
+    def open(cls, filename):
+        """Open an event log appending to a file.
+
+        Args:
+            filename (str): The file, or ``-`` to write to the standard
+                error.
+
+        Returns:
+            EventLog: The event log.
+
+        """
+        if filename == '-':
+            return cls(sys.stderr)
+        return cls(open(filename, 'a'))
+
+    def emit(self, event, **fields):
+        """Write an event.
+
+        Args:
+            event (str): The event type.
+            **fields: Its fields, they must be serializable to JSON.
+
+        """
+        record = {'ts': round(time.time(), 3), 'event': event}
+        record.update(fields)
+        line = json.dumps(record) + "\n"
+        with self._lock:
+            self.stream.write(line)
+            self.stream.flush()
+
+    def close(self):
+        """Close the file, unless it's the standard error."""
+        if self.stream is not sys.stderr:
+            self.stream.close()
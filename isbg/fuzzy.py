@@ -0,0 +1,261 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  fuzzy.py
+#  This file is part of isbg.
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+
+"""Fuzzy fingerprints of spam campaigns for isbg - IMAP Spam Begone.
+
+Spam campaigns usually send the same text with a few tokens changed for
+every recipient (names, tracking links, numbers...). A *simhash* computed
+over the normalized text of a message is stable against those changes: two
+messages of the same campaign have fingerprints that only differ in a few
+bits.
+
+:py:class:`SpamFingerprints` keeps the fingerprints of recently confirmed
+spam, so new messages of the same campaign can be recognized without
+calling *SpamAssassin* again.
+
+.. versionadded:: 2.3.0
+"""
+
+import json
+import logging
+import re
+import time
+
+from hashlib import md5
+
+from isbg import journal
+
+from .utils import __
+
+#: Number of bits of the fingerprints.
+FINGERPRINT_BITS = 64
+#: Maximum distance accepted for a campaign. Two unrelated fingerprints
+#: differ in about half of their bits, and at more than 10 bits unrelated
+#: messages start to match.
+MAX_DISTANCE = 10
+
+_RE_TAGS = re.compile(r'<[^>]*>')
+_RE_URLS = re.compile(r'(?:https?://|www\.)(\S+?)(?:[/?#]\S*)?(?=\s|$)')
+_RE_NUMS = re.compile(r'\d+')
+_RE_WORDS = re.compile(r'\w+', re.UNICODE)
+
+
+def mail_text(mail):
+    """Get the subject and the text parts of a email.
+
+    Args:
+        mail (email.message.Message): The email.
+
+    Returns:
+        str: The subject and the contents of the ``text/*`` parts.
+
+    """
+    texts = [str(mail.get('Subject', ''))]
+    for part in mail.walk():
+        if part.get_content_maintype() != 'text':
+            continue
+        payload = part.get_payload(decode=True)
+        if not payload:
+            continue
+        charset = part.get_content_charset() or 'ascii'
+        try:
+            texts.append(payload.decode(charset, errors='ignore'))
+        except LookupError:  # unknown charset
+            texts.append(payload.decode('ascii', errors='ignore'))
+    return '\n'.join(texts)
+
+
+def normalize(text):
+    """Normalize a text to remove the tokens that vary between recipients.
+
+    The html tags are removed, the urls are reduced to their host name and
+    the numbers are replaced by ``0``.
+
+    Args:
+        text (str): The text to normalize.
+
+    Returns:
+        list(str): The normalized words.
+
+    """
+    text = _RE_TAGS.sub(' ', text.lower())
+    text = _RE_URLS.sub(r'\1', text)
+    text = _RE_NUMS.sub('0', text)
+    return _RE_WORDS.findall(text)
+
+
+def simhash(mail, shingle=3, min_shingles=8):
+    """Compute the simhash fingerprint of a email.
+
+    Args:
+        mail (email.message.Message, str): The email, or its text.
+        shingle (int): Number of consecutive words hashed together.
+        min_shingles (int): Minimum number of shingles required to compute a
+            fingerprint. Very short texts are too similar between them to
+            be compared.
+
+    Returns:
+        int: The fingerprint, or ``None`` if the text is too short.
+
+    """
+    if not isinstance(mail, str):
+        mail = mail_text(mail)
+    words = normalize(mail)
+    shingles = set(' '.join(words[i:i + shingle])
+                   for i in range(max(len(words) - shingle + 1, 0)))
+    if len(shingles) < min_shingles:
+        return None
+
+    weights = [0] * FINGERPRINT_BITS
+    for sh in shingles:
+        value = int(md5(sh.encode('utf-8')).hexdigest()[:16], 16)
+        for bit in range(FINGERPRINT_BITS):
+            if value & (1 << bit):
+                weights[bit] += 1
+            else:
+                weights[bit] -= 1
+
+    fingerprint = 0
+    for bit in range(FINGERPRINT_BITS):
+        if weights[bit] > 0:
+            fingerprint |= 1 << bit
+    return fingerprint
+
+
+def distance(fp1, fp2):
+    """Get the number of different bits between two fingerprints.
+
+    Args:
+        fp1 (int): A fingerprint.
+        fp2 (int): Another fingerprint.
+
+    Returns:
+        int: The hamming distance.
+
+    """
+    return bin(fp1 ^ fp2).count('1')
+
+
+class SpamFingerprints(object):
+    """Index of the fingerprints of recently confirmed spam.
+
+    Every entry stores the fingerprint, the *SpamAssassin* score of the
+    message (as returned by :py:func:`isbg.spamproc.test_mail`) and the last
+    time that the campaign was seen.
+
+    Attributes:
+        filename (str): File where the index is stored between runs.
+        maxdistance (int): Maximum distance to consider that a fingerprint
+            belongs to a known campaign.
+        maxentries (int): Maximum number of campaigns stored. The least
+            recently seen are removed.
+        maxage (float): Seconds after which a campaign not seen is
+            forgotten.
+        entries (list): The list of ``[fingerprint, score, timestamp]``.
+
+    """
+
+    #: Logger object used to show debug info.
+    logger = logging.getLogger(__name__)
+
+    def __init__(self, filename=None, maxdistance=3, maxentries=2000,
+                 maxage=7 * 24 * 3600):
+        """Initialize a SpamFingerprints object."""
+        self.filename = filename
+        self.maxdistance = maxdistance
+        self.maxentries = maxentries
+        self.maxage = maxage
+        self.entries = []
+
+    def __len__(self):
+        """Return the number of campaigns stored."""
+        return len(self.entries)
+
+    def load(self):
+        """Load the index from `filename`, forgetting the old campaigns."""
+        self.entries = []
+        if self.filename is None:
+            return
+        try:
+            with open(self.filename, 'r') as rfile:
+                self.entries = json.load(rfile)['fingerprints']
+        except Exception:  # pylint: disable=broad-except
+            return
+        oldest = time.time() - self.maxage
+        self.entries = [e for e in self.entries if e[2] >= oldest]
+        self.logger.debug(__("Loaded {} spam fingerprints".format(
+            len(self.entries))))
+
+    def save(self):
+        """Store the index in `filename`."""
+        if self.filename is None:
+            return
+        self.entries.sort(key=lambda e: e[2], reverse=True)
+        del self.entries[self.maxentries:]
+        journal.write_atomic(self.filename,
+                             json.dumps({'fingerprints': self.entries}))
+
+    def _nearest(self, fingerprint):
+        """Get the nearest entry within `maxdistance`, or ``None``."""
+        best, best_dist = None, self.maxdistance + 1
+        for entry in self.entries:
+            dist = distance(fingerprint, entry[0])
+            if dist < best_dist:
+                best, best_dist = entry, dist
+        return best
+
+    def match(self, fingerprint):
+        """Search the campaign of a fingerprint.
+
+        Args:
+            fingerprint (int): The fingerprint to search, it could be
+                ``None``.
+
+        Returns:
+            str: The score of the campaign, or ``None`` if it's unknown.
+
+        """
+        if fingerprint is None:
+            return None
+        entry = self._nearest(fingerprint)
+        if entry is None:
+            return None
+        entry[2] = time.time()
+        return entry[1]
+
+    def add(self, fingerprint, score):
+        """Add the fingerprint of a confirmed spam.
+
+        If the fingerprint belongs to a known campaign, the campaign is
+        updated instead of adding a new entry.
+
+        Args:
+            fingerprint (int): The fingerprint, it could be ``None``.
+            score (str): The score returned by *SpamAssassin*.
+
+        """
+        if fingerprint is None:
+            return
+        entry = self._nearest(fingerprint)
+        if entry is None:
+            self.entries.append([fingerprint, score, time.time()])
+        else:
+            entry[1], entry[2] = score, time.time()
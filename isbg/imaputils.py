@@ -26,16 +26,19 @@
 import email          # To easily encapsulated emails messages
 import email.message  # required for typing.TypeVar to work in py3
 import imaplib
+import logging
 import re             # For regular expressions
 import socket         # to catch the socket.error exception
+import threading
 import time
 
 from hashlib import md5
 
+from isbg import timing
 from isbg import utils
 from .utils import __
 
-from typing import List, TypeVar, Union
+from typing import Dict, Iterator, List, Tuple, TypeVar, Union
 
 Email = TypeVar(email.message.Message)
 Uid = Union[int, str]
@@ -103,8 +106,8 @@ def new_message(body):
     return mail
 
 
-def get_message(imap, uid, append_to=None, logger=None):
-    # type: (IsbgImap4, Uid, Optional[Uids], Optional[logging.Logger]) -> Email
+def get_message(imap, uid, append_to=None, logger=None, timings=None):
+    # type: (IsbgImap4, Uid, Optional[Uids], Optional[logging.Logger], Optional[Timings]) -> Email  # noqa: E501
     """Get a message by *uid* and optionally append it to a list.
 
     Args:
@@ -115,12 +118,22 @@ def get_message(imap, uid, append_to=None, logger=None):
             *uid* is appended to this list. Defaults to *None*.
         logger (logging.Logger, optional): When a error is raised fetching the
             mail a warning is written to this logger. Defaults to *None*.
+        timings (isbg.timing.Timings, optional): If it's not *None*, the time
+            and the bytes fetched are added to its ``fetch`` phase.
 
     Returns:
         email.message.Message: The message fetched from the *imap* connection.
 
     """
-    res = imap.uid("FETCH", uid, "(BODY.PEEK[])")
+    if timings is not None:
+        with timings.span('fetch') as phase:
+            res = imap.uid("FETCH", uid, "(BODY.PEEK[])")
+            try:
+                phase.nbytes += len(res[1][0][1])
+            except (IndexError, TypeError):
+                pass
+    else:
+        res = imap.uid("FETCH", uid, "(BODY.PEEK[])")
     mail = email.message.Message()  # an empty email
     if res[0] != "OK":
         try:
@@ -140,6 +153,91 @@ def get_message(imap, uid, append_to=None, logger=None):
     return mail
 
 
+#: Header fields that identify a message when its *uid* changes.
+MESSAGE_KEY_FIELDS = ['MESSAGE-ID', 'DATE', 'FROM', 'SUBJECT']
+
+
+def message_key(mail):
+    # type: (Email) -> str
+    """Get a key that identifies a message when its *uid* changes.
+
+    It's a hash of its ``Message-ID``, ``Date``, ``From`` and ``Subject``
+    headers, so also the messages without ``Message-ID`` are identified.
+
+    Args:
+        mail (email.message.Message): The message, or only its headers.
+
+    Returns:
+        str: The key of the message.
+
+    """
+    values = [' '.join(str(mail.get(field, '')).split())
+              for field in MESSAGE_KEY_FIELDS]
+    return md5('\n'.join(values).encode('utf-8', 'replace')).hexdigest()
+
+
+def fetch_message_keys(imap, uids='1:*'):
+    # type: (IsbgImap4, str) -> Dict[int, str]
+    """Get in bulk the keys of the messages of the selected mailbox.
+
+    Only the headers in :py:data:`MESSAGE_KEY_FIELDS` are fetched.
+
+    Args:
+        imap (IsbgImap4): The imap helper object with the connection.
+        uids (str): The *uid* set of the messages, all by default.
+
+    Returns:
+        dict: The key (see :py:func:`message_key`) of every *uid*.
+
+    """
+    res = imap.uid("FETCH", uids, "(BODY.PEEK[HEADER.FIELDS ({})])".format(
+        ' '.join(MESSAGE_KEY_FIELDS)))
+    keys = {}
+    for item in res[1] if res[0] == "OK" else []:
+        if not isinstance(item, tuple):
+            continue
+        info = item[0] if isinstance(item[0], str) else item[0].decode()
+        match = re.search(r'UID (\d+)', info)
+        if match is not None:
+            if isinstance(item[1], bytes):
+                headers = email.message_from_bytes(item[1])
+            else:
+                headers = email.message_from_string(item[1])
+            keys[int(match.group(1))] = message_key(headers)
+    return keys
+
+
+def fetch_messages(imap, uids, chunk=100):
+    # type: (IsbgImap4, List[str], int) -> Iterator[Tuple[int, bytes]]
+    """Get in bulk the messages of the selected mailbox.
+
+    The messages are fetched with a ``UID FETCH`` of `chunk` messages at a
+    time instead of one command for every message.
+
+    Args:
+        imap (IsbgImap4): The imap helper object with the connection.
+        uids (list(str)): The *uids* of the messages.
+        chunk (int): Number of messages fetched with every command.
+
+    Yields:
+        int, bytes: The *uid* and the contents of every message.
+
+    """
+    for start in range(0, len(uids), chunk):
+        res = imap.uid("FETCH", ",".join(
+            str(uid) for uid in uids[start:start + chunk]), "(BODY.PEEK[])")
+        for item in res[1] if res[0] == "OK" else []:
+            if not isinstance(item, tuple):
+                continue
+            info = item[0] if isinstance(item[0], str) else item[0].decode()
+            match = re.search(r'UID (\d+)', info)
+            if match is not None:
+                body = item[1]
+                if isinstance(body, str):
+                    body = body.encode(errors='replace')
+                yield int(match.group(1)), body
+
+
 def imapflags(flaglist):
     # type: (List[str]) -> str
     """Transform a list to a string as expected for the IMAP4 standard.
@@ -182,6 +280,121 @@ def assertok(name):
     return assertok_decorator
 
 
+class ImapStats(object):
+    """Number of calls, latencies and bytes of every IMAP command.
+
+    It's shared by the threads, so the connections used at the same time can
+    add their commands.
+
+    Attributes:
+        commands (dict): The :py:class:`CommandStats` of every command.
+
+    """
+
+    def __init__(self):
+        """Initialize a ImapStats object."""
+        self.commands = {}
+        self._lock = threading.Lock()
+
+    def record(self, command, seconds, sent=0, received=0):
+        """Add a call of `command`.
+
+        Args:
+            command (str): The IMAP command, e.g. ``FETCH``.
+            seconds (float): Its latency.
+            sent (int): Bytes sent to the server.
+            received (int): Bytes received from the server.
+
+        """
+        with self._lock:
+            if command not in self.commands:
+                self.commands[command] = CommandStats()
+            stats = self.commands[command]
+            stats.latency.observe(seconds)
+            stats.sent += sent
+            stats.received += received
+
+    def report(self):
+        """Get a line of text for every command.
+
+        Returns:
+            list(str): The lines, sorted by command.
+
+        """
+        with self._lock:
+            return ["{}: {} calls, p50 {:.1f}ms, p95 {:.1f}ms, p99 {:.1f}ms, "
+                    "{} bytes sent, {} bytes received".format(
+                        command, stats.latency.count,
+                        stats.latency.quantile(0.50) * 1000,
+                        stats.latency.quantile(0.95) * 1000,
+                        stats.latency.quantile(0.99) * 1000,
+                        stats.sent, stats.received)
+                    for command, stats in sorted(self.commands.items())]
+
+
+class CommandStats(object):
+    """The calls of an IMAP command, see :py:class:`ImapStats`."""
+
+    def __init__(self):
+        """Initialize a CommandStats object."""
+        self.latency = timing.Histogram()   #: The latencies, in seconds.
+        self.sent = 0            #: Bytes sent to the server.
+        self.received = 0        #: Bytes received from the server.
+
+
+def instrument(name):
+    """Decorate to record the latency and the bytes of the command.
+
+    They are added to the `stats` of the instance. ``uid`` calls are recorded
+    by their command (``FETCH``, ``STORE``...).
+    """
+    def instrument_decorator(func):
+        def func_wrapper(cls, *args, **kwargs):
+            command = args[0].upper() if name == 'uid' else name
+            sent, received = (cls.sent, cls.received)
+            start = time.monotonic()
+            try:
+                return func(cls, *args, **kwargs)
+            finally:
+                cls.stats.record(command, time.monotonic() - start,
+                                 cls.sent - sent, cls.received - received)
+        return func_wrapper
+    return instrument_decorator
+
+
+#: ``uid`` commands that can be repeated without changing the result.
+IDEMPOTENT_UID_COMMANDS = ['FETCH', 'SEARCH', 'STORE']
+
+
+def reconnect(idempotent):
+    """Decorate with *reconnect*.
+
+    If the connection is lost, the method reconnects, authenticates again and
+    selects again the mailbox that was selected. If `idempotent` is True (or
+    a function that returns True called with the method args) the method is
+    called again, else the error is raised once reconnected.
+    """
+    def reconnect_decorator(func):
+        def func_wrapper(cls, *args, **kwargs):
+            attempt = 0
+            while True:
+                try:
+                    return func(cls, *args, **kwargs)
+                except (imaplib.IMAP4.abort, OSError) as exc:
+                    attempt += 1
+                    if cls.user is None or attempt > cls.max_reconnects:
+                        raise
+                    cls.logger.warning(__(
+                        ("IMAP connection lost: {} ... reconnect {} of {}"
+                         ).format(exc, attempt, cls.max_reconnects)))
+                    cls.reopen()
+                    if not (idempotent(*args) if callable(idempotent)
+                            else idempotent):
+                        raise
+        return func_wrapper
+    return reconnect_decorator
+
+
 class IsbgImap4(object):
     """Proxy class for :obj:`imaplib.IMAP4` and :obj:`imaplib.IMAP4_SSL`.
 
@@ -189,74 +402,202 @@ class IsbgImap4(object):
     decorators to log the calls and to try to convert the returns values to
     str.
 
-    The only original method is ``get_uidvalidity``, used to return the current
-    *uidvalidity* from a mailbox.
+    When the connection is lost, it reconnects, authenticates and selects
+    again the mailbox, and repeats the commands that are idempotent (see
+    :py:func:`reconnect`).
+
+    The only original methods are ``get_uidvalidity``, used to return the
+    current *uidvalidity* from a mailbox, ``allows_keywords`` and
+    ``reopen``.
+
+    The latency and the bytes of every command are added to `stats` (see
+    :py:func:`instrument`).
+
+    With a `session` the connections are recorded, or replayed, by it (see
+    :py:mod:`isbg.recording`).
+
+    Attributes:
+        max_reconnects (int): Times that a command is tried again on a new
+            connection.
+        retry_time (float): Seconds between connection attempts.
+        logger (logging.Logger): Where the reconnections are logged.
+        stats (ImapStats): The calls, latencies and bytes of the commands.
+        sent (int): Bytes sent to the server.
+        received (int): Bytes received from the server.
+        session (isbg.recording.Recorder): If it's not None, the recorder or
+            the replayer of the connections.
+        permanentflags (list): The ``PERMANENTFLAGS`` of the mailbox
+            selected, ``[None]`` if the server has not sent them.
 
     """
 
-    def __init__(self, host='', port=143, nossl=False, assertok=None):
+    def __init__(self, host='', port=143, nossl=False, assertok=None,
+                 session=None):
         """Create a imaplib.IMAP4[_SSL] with an assertok method."""
         self.assertok = assertok
-        self.nossl = nossl
-        if nossl:
-            self.imap = imaplib.IMAP4(host, port)
+        self.host, self.port, self.nossl = (host, port, nossl)
+        self.user, self._passwd = (None, None)
+        self.selected, self._uidvalidity = (None, None)
+        self.permanentflags = [None]
+        self.max_reconnects, self.retry_time = (3, 0.60)
+        self.logger = logging.getLogger(__name__)
+        self.stats, self.sent, self.received = (ImapStats(), 0, 0)
+        self.session = session
+        self.imap = self._connect()
+
+    def _connect(self):
+        """Open the connection, through the `session` if there is one."""
+        if self.session is None:
+            return self._open()
+        return self.session.connect(self._open, self)
+
+    def _open(self):
+        """Create the imaplib.IMAP4[_SSL] connection counting its bytes."""
+        if self.nossl:
+            imap = imaplib.IMAP4(self.host, self.port)
         else:
-            self.imap = imaplib.IMAP4_SSL(host, port)
+            imap = imaplib.IMAP4_SSL(self.host, self.port)
+        send, read, readline = (imap.send, imap.read, imap.readline)
+
+        def counted_send(data):
+            self.sent += len(data)
+            return send(data)
+
+        def counted_read(size):
+            data = read(size)
+            self.received += len(data)
+            return data
+
+        def counted_readline():
+            data = readline()
+            self.received += len(data)
+            return data
+
+        imap.send, imap.read, imap.readline = (counted_send, counted_read,
+                                               counted_readline)
+        return imap
+
+    def reopen(self):
+        """Connect again, authenticate and select the mailbox selected.
+
+        Raises:
+            imaplib.IMAP4.error: If the *uidvalidity* of the selected mailbox
+                has changed: the ``uids`` that we have are not valid.
+
+        """
+        try:
+            self.imap.shutdown()
+        except Exception:  # pylint: disable=broad-except
+            pass
+        for retry in range(1, self.max_reconnects + 1):
+            try:
+                self.imap = self._connect()
+                break
+            except OSError:
+                if retry >= self.max_reconnects:
+                    raise
+                time.sleep(self.retry_time)
+        self.imap.login(self.user, self._passwd)
+        if self.selected is not None:
+            self.imap.select(*self.selected)
+            uidvalidity = self.imap.response('UIDVALIDITY')[1]
+            if uidvalidity != self._uidvalidity:
+                raise imaplib.IMAP4.error(
+                    "uidvalidity of {} has changed".format(self.selected[0]))
 
     # @assertok('append')  <-- it fails in some servers
+    @reconnect(False)
+    @instrument('APPEND')
     @bytes_to_ascii
     def append(self, mailbox, flags, date_time, message):
         """Append message to named mailbox."""
         return self.imap.append(mailbox, flags, date_time, message)
 
+    @reconnect(True)
+    @instrument('CAPABILITY')
     @assertok('cabability')
     @bytes_to_ascii
     def capability(self):
         """Fetch capabilities list from server."""
         return self.imap.capability()
 
+    @reconnect(True)
+    @instrument('EXPUNGE')
     @assertok('expunge')
     @bytes_to_ascii
     def expunge(self):
         """Permanently remove deleted items from selected mailbox."""
         return self.imap.expunge()
 
+    @reconnect(True)
+    @instrument('LIST')
     @assertok('list')
     @bytes_to_ascii
     def list(self, directory='""', pattern='*'):
         """List mailbox names in directory matching pattern."""
         return self.imap.list(directory, pattern)
 
+    @instrument('LOGIN')
     @assertok('login')
     @bytes_to_ascii
     def login(self, user, passwd):
         """Identify client using plain text password."""
+        self.user, self._passwd = (user, passwd)
         return self.imap.login(user, passwd)
 
+    @instrument('LOGOUT')
     @assertok('logout')
     @bytes_to_ascii
     def logout(self):
         """Shutdown connection to server."""
         return self.imap.logout()
 
+    @reconnect(True)
+    @instrument('STATUS')
     @assertok('status')
     @bytes_to_ascii
     def status(self, mailbox, names):
         """Request named status conditions for mailbox."""
         return self.imap.status(mailbox, names)
 
+    @reconnect(True)
+    @instrument('SELECT')
     @assertok('select')
     @bytes_to_ascii
     def select(self, mailbox='INBOX', readonly=False):
         """Select a Mailbox."""
-        return self.imap.select(mailbox, readonly)
+        res = self.imap.select(mailbox, readonly)
+        self.selected = (mailbox, readonly)
+        self._uidvalidity = self.imap.response('UIDVALIDITY')[1]
+        self.permanentflags = self.imap.response('PERMANENTFLAGS')[1]
+        return res
 
+    def allows_keywords(self, *keywords):
+        """Check if `keywords` can be stored in the mailbox selected.
+
+        They can if its ``PERMANENTFLAGS`` include ``\\*`` or all of them,
+        or if the server has not sent them (see RFC 3501).
+        """
+        flags = set()
+        for item in self.permanentflags:
+            if item is None:
+                return True
+            if isinstance(item, bytes):
+                item = item.decode(errors='replace')
+            flags.update(item.strip('()').split())
+        return '\\*' in flags or all(kw in flags for kw in keywords)
+
+    @reconnect(lambda command, *args: command.upper() in
+               IDEMPOTENT_UID_COMMANDS)
+    @instrument('uid')
     @assertok('uid')
     @bytes_to_ascii
     def uid(self, command, *args):
         """Execute "command arg ..." with messages identified by UID."""
         return self.imap.uid(command, *args)
 
+    @reconnect(True)
+    @instrument('STATUS')
     def get_uidvalidity(self, mailbox):
         """Validate a mailbox.
 
@@ -278,8 +619,12 @@ class IsbgImap4(object):
         return uidvalidity
 
 
-def login_imap(imapsets, logger=None, assertok=None):
-    """Login to the imap server."""
+def login_imap(imapsets, logger=None, assertok=None, session=None):
+    """Login to the imap server.
+
+    The connection is recorded, or replayed, by `session` if it's not None
+    (see :py:class:`IsbgImap4`).
+    """
     if not isinstance(imapsets, ImapSettings):
         raise TypeError("imapsets is not a ImapSettings")
 
@@ -288,7 +633,9 @@ def login_imap(imapsets, logger=None, assertok=None):
     for retry in range(1, max_retry + 1):
         try:
             imap = IsbgImap4(imapsets.host, imapsets.port, imapsets.nossl,
-                             assertok)
+                             assertok, session)
+            if logger:
+                imap.logger = logger
             break   # ok, exit from loop
         except socket.error as exc:
             if logger:
@@ -20,20 +20,42 @@ original marked or deleted.
 import os
 import sys     # Because sys.stderr.write() is called bellow
 
+from isbg import bulklearn
+from isbg import coordination
+from isbg import eventlog
+from isbg import fuzzy
 from isbg import imaputils
+from isbg import journal
+from isbg import ledger
+from isbg import metrics
+from isbg import profiling
+from isbg import recording
 from isbg import secrets
 from isbg import spamproc
+from isbg import timing
 from isbg import utils
 
 from .utils import __
 
 import atexit
+import concurrent.futures
+import contextlib
+import errno
+import functools
 import getpass
 import json
 import logging
+import mailbox
 import re
+import tempfile
+import threading
 import time
 
+try:
+    import fcntl
+except ImportError:  # Not available in Windows
+    fcntl = None  # pylint: disable=invalid-name
+
 # xdg base dir specification (only xdg_cache_home is used)
 try:
     from xdg.BaseDirectory import xdg_cache_home
@@ -45,7 +67,7 @@ if xdg_cache_home == "":
     """str: From the `XDG Base Directory specification`_.
 
 We used this directory to create a `isbg/` one to store cached data:
-    * lock file.
+    * lock files.
     * password file.
     * chached lists of ``uids``.
 
@@ -105,6 +127,12 @@ Key              Val cmd? [1]_ Description
 """
 
 
+@contextlib.contextmanager
+def _unprofiled():
+    """Do nothing, it's the context manager of the phases not profiled."""
+    yield
+
+
 class ISBGError(Exception):
     """Class for the ISBG exceptions.
 
@@ -189,6 +217,47 @@ class ISBG(object):
         exitcodes (bool): If True returns more exit codes. Defaults to
             ``True``.
         imaplist (bool): If True shows the folder list. Default to ``False``.
+        metricsfile (str): If it's not None, the file where the Prometheus
+            metrics are written after every run (see :py:meth:`do_metrics`).
+            Default to ``None``.
+        eventlogfile (str): If it's not None, the file (or ``-`` for the
+            standard error) where the events of every message and of the run
+            are written as JSON lines. Default to ``None``.
+        eventlog (isbg.eventlog.EventLog): The event log opened by
+            :py:meth:`do_isbg` when `eventlogfile` is not None.
+        profiledir (str): If it's not None, the directory where the profile
+            of every phase of the run is written (see
+            :py:mod:`isbg.profiling`). Default to ``None``.
+        slowest (int): Number of the slowest messages of every phase kept in
+            `outliers` and shown with the stats, ``0`` to keep none. Default
+            to ``5``.
+        outliers (isbg.timing.Outliers): The slowest messages of every phase
+            of the last run.
+        ledgerfile (str): The ledger where a record of every run is appended
+            (see :py:mod:`isbg.ledger`). If it's None,
+            :py:func:`isbg.ledger.default_filename` is used. Default to
+            ``None``.
+        recordfile (str): If it's not None, the file where the IMAP and the
+            scanner sessions are recorded (see :py:mod:`isbg.recording`).
+            Default to ``None``.
+        recordbodies (str): How the message bodies are recorded: ``keep``,
+            ``hash`` or ``redact``. Default to ``keep``.
+        replayfile (str): If it's not None, a recording served instead of
+            connecting to the IMAP server and running the scanner. The
+            replay does not change the state of the account: its `trackfile`
+            and `fuzzyfile` are in a temporary directory, it does not take
+            the lock of the account and it's not written to the ledger.
+            Default to ``None``.
+        replayspeed (float): How faster than recorded the calls are
+            replayed, ``0`` to not wait. Default to ``1.0``.
+        session (isbg.recording.Recorder): The recorder, or the replayer,
+            opened by :py:meth:`do_isbg`.
+        results (dict): The results of the last run of every folder
+            processed: a :py:class:`isbg.spamproc.Sa_Learn` for the learn
+            folders and a :py:class:`isbg.spamproc.Sa_Process` for the inbox.
+        exportmbox (str): If it's not None, the directory where the learn
+            folders are exported to mbox files, instead of processing the
+            account. Default to ``None``.
         noreport (bool): If True not adds SpamAssassin report to mails.
             Default to ``False``.
         nostats (bool): If True no shows stats. Default to ``False``.
@@ -196,6 +265,10 @@ class ISBG(object):
             ``False``.
         verbose: a property that if it's set to True show more information.
             Default to ``False``.
+        timings (isbg.timing.Timings): The time, messages and bytes of every
+            phase of the last run, initialized by :py:meth:`do_isbg`. They
+            are shown with the stats, and also the latencies and the bytes of
+            every IMAP command (see :py:class:`isbg.imaputils.ImapStats`).
 
     These are attributes derived for the command line, and needed for
     `SpamAssassin` operations:
@@ -208,6 +281,22 @@ class ISBG(object):
             ``False``.
         spamc (bool): If True use spamc instead of standalone SpamAssassin.
             Default to ``False``.
+        tierband (float): If it's not None, messages are scanned first only
+            with the local tests, and only those whose score is within
+            `tierband` points of the threshold are scanned again with all the
+            tests. Default to ``None``.
+        localspamd (str): ``host[:port]`` of the ``spamd`` started with
+            ``--local`` used for the local scans when `spamc` is True.
+            Default to ``None``.
+        scantimeout (float): If it's not None, seconds that a message scan or
+            learn can last. The scanner is killed and the message is left
+            for the next run. Default to ``None``.
+        maxruntime (float): If it's not None, seconds that a run can last.
+            When they are consumed, the remaining messages are left for the
+            next run. Default to ``None``.
+        deadline (float): The :py:func:`time.monotonic` time when the run
+            must end. It's initialized from `maxruntime` by
+            :py:meth:`do_isbg`.
         gmail (bool): If True Delete by copying to `[Gmail]/Trash` folder.
             Default to ``False``.
         deletehigherthan (float): If it's not None, the minimum score from a
@@ -226,8 +315,17 @@ class ISBG(object):
             Default to ``False``.
         learnthenflag (bool): If True flag learned messages. Default to
             ``False``.
+        backlogshare (float): Fraction of `partialrun` used to process the
+            oldest unprocessed messages instead of the newest ones. Default
+            to ``0.0``.
         movehamto (str): If it's not None, IMAP folder where the ham mail will
             be moved. Default to ``None``.
+        fuzzydistance (int): If it's not None, messages whose fingerprint is
+            at this distance or less of a recently found spam are considered
+            spam without scanning them. Default to ``None``.
+        fuzzy (isbg.fuzzy.SpamFingerprints): The fingerprints of the recently
+            found spam. It's loaded in :py:meth:`do_spamassassin` when
+            `fuzzydistance` is not ``None``.
 
     These are attributes derived from the command line and related to the lock
     file:
@@ -235,13 +333,26 @@ class ISBG(object):
     Attributes:
         ignorelockfile (bool): If True and there is the lock file a error is
             raised.
-        lockfile (str): Full path and name of the lock file.
+        lockfilename (str): Full path and name of the lock file.
 
-            The path it's initialized with the xdg cache home specification
-            plus `/isbg/` and with the name ``lock``.
+            By default, it's the xdg cache home specification plus `/isbg/`
+            and the name ``lock`` with the hash of the IMAP account, so
+            different accounts can be processed at the same time.
 
-        lockfilegrace (float): Lifetime of the lock file in seconds. Default to
+        lockfilegrace (float): Lifetime of the lock file in seconds, only
+            used where the lock file cannot be locked. Default to
             240.0
+        leasefile (str): If it's not None, the SQLite database of
+            :py:class:`isbg.coordination.SqliteLeases` where a lease of the
+            account is claimed instead of using the lock file, to coordinate
+            several nodes. Default to ``None``.
+        leasettl (float): Seconds that the lease lasts if it's not renewed.
+            Default to ``300.0``.
+        leases (isbg.coordination.Coordinator): The coordination backend. It's
+            created from `leasefile` in :py:meth:`do_isbg` if it's ``None``.
+        stop (threading.Event): It's set when the lease of the account is
+            lost, the run stops as if the `deadline` had been reached and
+            :py:meth:`do_isbg` raises a error.
 
     These are attributes derived for the command line, related to the
     `IMAP` password and files:
@@ -254,6 +365,43 @@ class ISBG(object):
         trackfile (str): Base name where the processed ``uids`` will be stored
             to not reprocess them. Default to ``None`` when initialized and
             initialized the first time that is needed.
+        fuzzyfile (str): File where the spam fingerprints are stored. Default
+            to ``None`` when initialized and initialized in :py:meth:`do_isbg`.
+        checkpointevery (int): The processed ``uids`` are written to a journal
+            as soon as they are processed, and synced to the disk every
+            `checkpointevery` messages. Default to ``10``.
+        checkpointinterval (float): Maximum seconds between syncs of the
+            journal. Default to ``5.0``.
+        checkpointfsync (bool): If False, the journal is not synced to the
+            disk, it survives a crash of isbg but not of the system. Default
+            to ``True``.
+        keywords (bool): If True, the messages scanned and learned are
+            marked with IMAP keywords (see :py:data:`isbg.spamproc.
+            KEYWORD_SCANNED`) and the messages to process are searched by
+            them, skipping also the ``uids`` stored in `trackfile`. If the
+            server does not allow keywords only `trackfile` is used. Default
+            to ``False``.
+        bulklearn (int): If it's not None, the messages are learned sending
+            them to ``spamd``, `bulklearn` at the same time, instead of
+            calling ``spamc`` for every one. Default to ``None``.
+        learnspamd (str): The ``host[:port]`` of the ``spamd`` used by
+            `bulklearn`. Default to ``localhost``.
+        learnsync (bool): If True, the Bayes journal is synced once the
+            messages are learned, if they are learned by a local ``spamd``
+            (see :py:func:`isbg.bulklearn.sync_bayes`). Default to
+            ``False``.
+        learner (isbg.bulklearn.BulkLearner): The learner created in
+            :py:meth:`do_spamassassin` with `bulklearn`.
+        parallel (bool): If True, the messages to learn are fetched and
+            unwrapped at the same time that the inbox is scanned, with their
+            own IMAP connection, and they are sent to the scanner once the
+            inbox scan ends. Default to ``False``.
+        gate (threading.Event): With `parallel`, it's set when the inbox scan
+            has ended.
+        actions (isbg.journal.ActionJournal): Write-ahead journal of the
+            changes done in the IMAP account, to replay those left by a run
+            that has not ended. It's initialized in :py:meth:`do_spamassassin`
+            and stored in `trackfile` + ``actions``.
 
     """
 
@@ -270,26 +418,51 @@ class ISBG(object):
             os.makedirs(os.path.join(xdg_cache_home, "isbg"))
 
         self.imaplist, self.nostats = (False, False)
+        self.exportmbox = None
+        self.timings = timing.Timings()
+        self.slowest = 5
+        self.outliers = timing.Outliers(self.slowest)
+        self.metricsfile, self.results = (None, {})
+        self.eventlogfile, self.eventlog = (None, None)
+        self.profiledir, self.profiler = (None, None)
+        self.ledgerfile = None
+        self.recordfile, self.recordbodies = (None, 'keep')
+        self.replayfile, self.replayspeed = (None, 1.0)
+        self.session = None
         self.noreport, self.exitcodes = (False, True)
         self.verbose_mails, self._verbose = (False, False)
         self._set_loglevel(logging.INFO)
         # Processing options:
         self.dryrun, self.maxsize, self.teachonly = (False, 120000, False)
         self.spamc, self.gmail = (False, False)
+        self.tierband, self.localspamd = (None, None)
+        self.scantimeout, self.maxruntime, self.deadline = (None, None, None)
         # spamassassin options:
         self.movehamto, self.delete = (None, False)
         self.deletehigherthan, self.flag, self.expunge = (None, False, False)
         # Learning options:
         self.learnflagged, self.learnunflagged = (False, False)
         self.learnthendestroy, self.learnthenflag = (False, False)
+        # Spam campaigns options:
+        self.fuzzy, self.fuzzydistance, self.fuzzyfile = (None, None, None)
         # Lockfile options:
         self.ignorelockfile = False
-        self.lockfilename = os.path.join(xdg_cache_home, "isbg", "lock")
+        self._lockfilename, self._lockfile = (None, None)
         self.lockfilegrace = 240.0
+        self.leasefile, self.leasettl, self.leases = (None, 300.0, None)
+        self.stop = threading.Event()
         # Password options (a vague level of obfuscation):
         self.passwdfilename, self.savepw = (None, False)
         # Trackfile options:
         self.trackfile, self.partialrun = (None, 50)
+        self.backlogshare = 0.0
+        self.checkpointevery, self.checkpointinterval = (10, 5.0)
+        self.checkpointfsync = True
+        self.actions, self._journals = (None, {})
+        self.keywords = False
+        self.parallel, self.gate = (False, None)
+        self.bulklearn, self.learnspamd = (None, 'localhost')
+        self.learnsync, self.learner = (False, None)
 
         try:
             self.interactive = sys.stdin.isatty()
@@ -323,6 +496,24 @@ class ISBG(object):
             filename = os.path.join(xdg_cache_home, "isbg", filetype)
         return filename + imapsets.hash.hexdigest()
 
+    @property
+    def lockfilename(self):
+        """Get the lock file name.
+
+        :getter: Gets the lock file name, by default built from the IMAP
+            account with :py:meth:`set_filename`.
+        :setter: Sets the lock file name.
+        :type: str
+        """
+        if self._lockfilename is None:
+            return ISBG.set_filename(self.imapsets, "lock")
+        return self._lockfilename
+
+    @lockfilename.setter
+    def lockfilename(self, newval):
+        """Set the lock file name."""
+        self._lockfilename = newval
+
     @property
     def verbose(self):
         """Get the verbose property.
@@ -349,9 +540,12 @@ class ISBG(object):
             handler.setLevel(level)
 
     def removelock(self):
-        """Remove the lockfile."""
+        """Remove the lockfile (and release our lock)."""
         if os.path.exists(self.lockfilename):
             os.remove(self.lockfilename)
+        if self._lockfile is not None:
+            self._lockfile.close()
+            self._lockfile = None
 
     def assertok(self, res, *args):
         """Check that the return code is OK.
@@ -380,29 +574,62 @@ class ISBG(object):
         code (makes loading it here real easy since we just source
         the file)
         """
+        pastuids = self._trackfile_read(uidvalidity, folder).get('uids', [])
+        # Add the uids processed by a run that has not ended
+        return list(set(pastuids +
+                        self._uid_journal(uidvalidity, folder).read()))
+
+    def _uid_journal(self, uidvalidity, folder):
+        """Get the journal of the uids processed in a folder.
+
+        It's used to not lose the progress of a run that does not end: the
+        uids processed are added to it until they are stored by
+        :py:meth:`pastuid_write`.
+        """
+        if self.trackfile is None:
+            self.trackfile = ISBG.set_filename(self.imapsets, "track")
+        jrnl = self._journals.get(folder)
+        if jrnl is None or jrnl.uidvalidity != uidvalidity:
+            if jrnl is not None:
+                jrnl.close()
+            jrnl = journal.UidJournal(self.trackfile + folder + ".journal",
+                                      uidvalidity, self.checkpointevery,
+                                      self.checkpointinterval,
+                                      self.checkpointfsync)
+            self._journals[folder] = jrnl
+        return jrnl
+
+    def backlog_cursor(self, uidvalidity, folder='inbox'):
+        """Read where the walk through the backlog of a folder stopped.
+
+        See :py:meth:`isbg.spamproc.SpamAssassin.schedule_uids`.
+        """
+        return self._trackfile_read(uidvalidity, folder).get('cursor')
+
+    def _trackfile_read(self, uidvalidity, folder):
+        """Read the track file of a folder if its uidvalidity is the same."""
         if self.trackfile is None:
             self.trackfile = ISBG.set_filename(self.imapsets, "track")
-        pastuids = []
         try:
             with open(self.trackfile + folder, 'r') as rfile:
                 struct = json.load(rfile)
                 if struct['uidvalidity'] == uidvalidity:
-                    pastuids = struct['uids']
+                    return struct
         except Exception:  # pylint: disable=broad-except
             pass
-        return pastuids
+        return {}
 
     def pastuid_write(self, uidvalidity, origpastuids, newpastuids,
-                      folder='inbox'):
-        """Write the uids in a file for the folder."""
+                      folder='inbox', cursor=None, keys=None):
+        """Write the uids (and the backlog cursor) in a file for the folder.
+
+        The message keys of the uids (see
+        :py:func:`isbg.imaputils.message_key`) are also stored, to recover
+        the uids processed if the uidvalidity changes.
+        """
         if self.trackfile is None:
             self.trackfile = ISBG.set_filename(self.imapsets, "track")
 
-        wfile = open(self.trackfile + folder, "w+")
-        try:
-            os.chmod(self.trackfile + folder, 0o600)
-        except Exception:  # pylint: disable=broad-except
-            pass
         self.logger.debug(__(('Writing pastuids for folder {}: {} ' +
                               'origpastuids, newpastuids: {}').format(
             folder, len(origpastuids), newpastuids)))
@@ -410,24 +637,143 @@ class ISBG(object):
             'uidvalidity': uidvalidity,
             'uids': list(set(newpastuids + origpastuids))
         }
-        json.dump(struct, wfile)
-        wfile.close()
+        if cursor is not None:
+            struct['cursor'] = cursor
+        allkeys = self._trackfile_read(uidvalidity, folder).get('keys', {})
+        allkeys.update((str(uid), key) for uid, key in (keys or {}).items())
+        struct['keys'] = {str(uid): allkeys[str(uid)] for uid in struct['uids']
+                          if str(uid) in allkeys}
+        journal.write_atomic(self.trackfile + folder, json.dumps(struct))
+        # The journal has been stored, we can empty it:
+        self._uid_journal(uidvalidity, folder).clear()
+
+    def remap_pastuids(self, uidvalidity, mailbox, folder='inbox',
+                       imap=None):
+        """Recover the uids processed when the uidvalidity of a folder changes.
+
+        The message keys of the messages of the mailbox are fetched in bulk
+        and compared with the keys stored in the track file: the messages
+        already processed are stored with their new uids, so they are not
+        processed again.
+
+        Returns:
+            int: The number of uids recovered.
+
+        """
+        if self.trackfile is None:
+            self.trackfile = ISBG.set_filename(self.imapsets, "track")
+        try:
+            with open(self.trackfile + folder, 'r') as rfile:
+                struct = json.load(rfile)
+        except Exception:  # pylint: disable=broad-except
+            return 0
+        if struct.get('uidvalidity') == uidvalidity or not struct.get('keys'):
+            return 0
+
+        if imap is None:
+            imap = self.imap
+        known = set(struct['keys'].values())
+        imap.select(mailbox, 1)
+        keys = {uid: key for uid, key in
+                imaputils.fetch_message_keys(imap).items() if key in known}
+        self.logger.info(__(
+            ("Uidvalidity of {} has changed, {}/{} processed messages " +
+             "found").format(mailbox, len(keys), len(struct['uids']))))
+        self.pastuid_write(uidvalidity, [], list(keys), folder, keys=keys)
+        return len(keys)
 
     def _do_lockfile_or_raise(self):
-        """Create the lockfile or raise a error if it exists."""
-        if (os.path.exists(self.lockfilename) and
-                (os.path.getmtime(self.lockfilename) +
-                    (self.lockfilegrace * 60) > time.time())):
+        """Create the lockfile or raise a error if it's locked.
+
+        The lock file is locked with :py:func:`fcntl.flock`, so the lock is
+        released when the process ends, even if it's killed. Where it cannot
+        be locked, a lock file younger than `lockfilegrace` minutes is
+        considered locked unless the process that created it is not running.
+        """
+        if fcntl is None or not self._do_lockfile_flock_or_raise():
+            self._do_lockfile_pid_or_raise()
+
+        # Make sure to delete lock file
+        atexit.register(self.removelock)
+
+    def _do_lease_or_raise(self):
+        """Claim the lease of the account or raise a error if it's taken.
+
+        The lease is renewed in background and released at exit. If it's
+        lost, `stop` is set.
+        """
+        if self.leases is None:
+            self.leases = coordination.SqliteLeases(self.leasefile,
+                                                    ttl=self.leasettl)
+        key = self.imapsets.hash.hexdigest()
+        if not self.leases.acquire(key):
             raise ISBGError(__exitcodes__['locked'],
-                            "Lock file is present. Guessing isbg is " +
-                            "already running. Exit.")
-        else:
-            lockfile = open(self.lockfilename, 'w')
-            lockfile.write(repr(os.getpid()))
+                            ("The account is being processed by {}. " +
+                             "Exit.").format(self.leases.holder(key)))
+        self.stop.clear()
+        self.leases.heartbeat(key, lost=self.stop.set)
+        atexit.register(self.leases.release, key)
+
+    def _raise_locked(self, pid):
+        """Raise the error of a locked lock file."""
+        raise ISBGError(__exitcodes__['locked'],
+                        "Lock file is present. Guessing isbg is " +
+                        "already running (pid {}). Exit.".format(pid or '?'))
+
+    def _do_lockfile_flock_or_raise(self):
+        """Lock the lockfile with flock.
+
+        Returns:
+            bool: ``False`` if the file system does not support ``flock``.
+
+        """
+        while True:
+            lockfile = open(self.lockfilename, 'a+')
+            try:
+                fcntl.flock(lockfile.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError as exc:
+                lockfile.seek(0)
+                pid = lockfile.read().strip()
+                lockfile.close()
+                if exc.errno in (errno.EAGAIN, errno.EACCES):
+                    self._raise_locked(pid)
+                self.logger.debug(__("Cannot lock {}: {}".format(
+                    self.lockfilename, exc)))
+                return False
+            # If its owner has removed it meanwhile, we lock a new one
+            try:
+                if os.fstat(lockfile.fileno()).st_ino == \
+                        os.stat(self.lockfilename).st_ino:
+                    break
+            except OSError:
+                pass
             lockfile.close()
 
-            # Make sure to delete lock file
-            atexit.register(self.removelock)
+        lockfile.seek(0)
+        lockfile.truncate()
+        lockfile.write(repr(os.getpid()))
+        lockfile.flush()
+        self._lockfile = lockfile
+        return True
+
+    def _do_lockfile_pid_or_raise(self):
+        """Create the lockfile, checking its age and its process."""
+        if (os.path.exists(self.lockfilename) and
+                (os.path.getmtime(self.lockfilename) +
+                    (self.lockfilegrace * 60) > time.time())):
+            try:
+                with open(self.lockfilename, 'r') as lockfile:
+                    pid = int(lockfile.read().strip())
+            except (IOError, OSError, ValueError):
+                pid = None
+            if pid is None or utils.pid_running(pid):
+                self._raise_locked(pid)
+            self.logger.warning(__(
+                "Removing the stale lock file of the pid {}".format(pid)))
+
+        lockfile = open(self.lockfilename, 'w')
+        lockfile.write(repr(os.getpid()))
+        lockfile.close()
 
     def _do_get_password(self):
         """Get the password from file or prompt for it."""
@@ -470,46 +816,251 @@ class ISBG(object):
             x = re.sub(r'\(.*" (?=[a-zA-Z0-9])', "", x) # string formatting with
             self.logger.info(x)                         # lookbehind regex
 
-    def do_spamassassin(self):
-        """Do the spamassassin procesing.
+    def do_export_mbox(self, chunk=100):
+        """Export the learn folders to mbox files in `exportmbox`.
 
-        It creates a instance of :py:class:`~isbg.spamproc.SpamAssassin`
-        every time that this method is called. The ``SpamAssasssin`` object
-        would contact to the IMAP server to get the emails and to
-        ``SpamAssassin`` command line to process them.
+        The messages of `learnspambox` and `learnhambox` are appended to
+        ``spam.mbox`` and ``ham.mbox``, to learn them offline with
+        :py:func:`isbg.learnlocal.learn_local`. They are fetched in bulk,
+        `chunk` messages at a time.
+
+        Returns:
+            dict: The number of messages exported to every file.
 
         """
-        sa = spamproc.SpamAssassin.create_from_isbg(self)
-        proc = None
+        if not os.path.isdir(self.exportmbox):
+            os.makedirs(self.exportmbox)
+        exported = {}
+        for learn_type, folder in [('spam', self.imapsets.learnspambox),
+                                   ('ham', self.imapsets.learnhambox)]:
+            if folder is None:
+                continue
+            filename = os.path.join(self.exportmbox, learn_type + ".mbox")
+            self.imap.select(folder, True)
+            _, uids = self.imap.uid("SEARCH", None, "ALL")
+            uids = uids[0].split() if uids and uids[0] else []
+            box = mailbox.mbox(filename)
+            box.lock()
+            try:
+                exported[filename] = 0
+                for _, body in imaputils.fetch_messages(self.imap, uids,
+                                                        chunk):
+                    box.add(body)
+                    exported[filename] += 1
+                box.flush()
+            finally:
+                box.unlock()
+                box.close()
+            self.logger.info(__("{} messages of {} exported to {}".format(
+                exported[filename], folder, filename)))
+        return exported
+
+    def _do_process_inbox(self, sa, uidvalidity, origpastuids, cursor=None):
+        """Process the inbox in batches of `partialrun` messages.
+
+        The processed ``uids`` are stored after every batch. Without
+        `maxruntime` only one batch is processed, with it new batches are
+        processed while there are messages left and, at the throughput
+        measured, the time left is enough for another batch. A batch stopped
+        by the deadline ends them, the messages deferred for other reasons
+        (e.g. a scan timeout) are skipped by the next batches.
+
+        Returns:
+            isbg.spamproc.Sa_Process: The results of all the batches.
 
+        """
+        proc = spamproc.Sa_Process()
+        start = time.monotonic()
+        # The uids deferred by a batch (e.g. a scan timeout) are skipped by
+        # the next ones, and left for the next run
+        skip = set()
+        while True:
+            batch = sa.process_inbox(origpastuids, cursor,
+                                     self._uid_journal(uidvalidity, 'inbox'),
+                                     skip)
+            self.pastuid_write(uidvalidity, batch.newpastuids, batch.uids,
+                               cursor=batch.cursor, keys=batch.keys)
+            if self.fuzzy is not None and not self.dryrun:
+                self.fuzzy.save()
+            proc.add(batch)
+            origpastuids = list(set(batch.newpastuids + batch.uids))
+            cursor = batch.cursor
+            skip.update(batch.deferred)
+
+            if self.deadline is None or self.dryrun or not batch.pending \
+                    or batch.expired or not batch.nummsg:
+                break
+            # Leave a 20% margin for the estimation errors:
+            needed = (time.monotonic() - start) / proc.nummsg * 1.2 * \
+                min(int(self.partialrun), batch.pending)
+            if time.monotonic() + needed > self.deadline:
+                self.logger.debug(__(
+                    "No time left for another batch ({:.1f}s needed)".format(
+                        needed)))
+                break
+            self.logger.debug(__(
+                "Processing another batch, {} mails left".format(
+                    batch.pending)))
+        return proc
+
+    def _do_learn(self, sa):
+        """Learn the spam and the ham folders.
+
+        Returns:
+            tuple(isbg.spamproc.Sa_Learn): The results of learning spam and
+            ham.
+
+        """
         # SpamAssassin training: Learn spam
         s_learned = spamproc.Sa_Learn()
         if self.imapsets.learnspambox:
-            uidvalidity = self.imap.get_uidvalidity(self.imapsets.learnspambox)
+            uidvalidity = sa.imap.get_uidvalidity(self.imapsets.learnspambox)
+            self.remap_pastuids(uidvalidity, self.imapsets.learnspambox,
+                                'spam', sa.imap)
             origpastuids = self.pastuid_read(uidvalidity, 'spam')
             s_learned = sa.learn(self.imapsets.learnspambox, 'spam', None,
-                                 origpastuids)
+                                 origpastuids,
+                                 self._uid_journal(uidvalidity, 'spam'))
             self.pastuid_write(uidvalidity, s_learned.newpastuids,
-                               s_learned.uids, 'spam')
+                               s_learned.uids, 'spam', keys=s_learned.keys)
 
         # SpamAssassin training: Learn ham
         h_learned = spamproc.Sa_Learn()
         if self.imapsets.learnhambox:
-            uidvalidity = self.imap.get_uidvalidity(self.imapsets.learnhambox)
+            uidvalidity = sa.imap.get_uidvalidity(self.imapsets.learnhambox)
+            self.remap_pastuids(uidvalidity, self.imapsets.learnhambox, 'ham',
+                                sa.imap)
             origpastuids = self.pastuid_read(uidvalidity, 'ham')
             h_learned = sa.learn(self.imapsets.learnhambox, 'ham',
-                                 self.movehamto, origpastuids)
+                                 self.movehamto, origpastuids,
+                                 self._uid_journal(uidvalidity, 'ham'))
             self.pastuid_write(uidvalidity, h_learned.newpastuids,
-                               h_learned.uids, 'ham')
+                               h_learned.uids, 'ham', keys=h_learned.keys)
 
-        if not self.teachonly:
-            # check spaminbox exists by examining it
-            self.imap.select(self.imapsets.spaminbox, 1)
+        # Sync once the Bayes journal
+        if self.learnsync and (s_learned.learned or h_learned.learned):
+            bulklearn.sync_bayes(sa.timeout(), self.logger,
+                                 self.learnspamd if self.bulklearn else None)
+        return s_learned, h_learned
+
+    def _start_learning(self):
+        """Start learning in background, with its own IMAP connection.
+
+        The messages are fetched and unwrapped meanwhile the inbox is
+        scanned, but they are learned once its scan ends (the `gate` is set),
+        so the scanner is not shared.
 
-            uidvalidity = self.imap.get_uidvalidity(self.imapsets.inbox)
-            origpastuids = self.pastuid_read(uidvalidity)
-            proc = sa.process_inbox(origpastuids)
-            self.pastuid_write(uidvalidity, proc.newpastuids, proc.uids)
+        Returns:
+            (concurrent.futures.Future, spamproc.SpamAssassin): The result of
+            :py:meth:`_do_learn` and the object that learns, its `deadline`
+            stops it.
+
+        """
+        self.gate = threading.Event()
+        sa = spamproc.SpamAssassin.create_from_isbg(self)
+        sa.imap = imaputils.login_imap(self.imapsets, logger=self.logger,
+                                       assertok=self.assertok,
+                                       session=self.session)
+        # Its commands are shown with those of the main connection
+        sa.imap.stats = self.imap.stats
+
+        def learn():
+            try:
+                return self._do_learn(sa)
+            finally:
+                sa.imap.logout()
+
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        learning = executor.submit(learn)
+        executor.shutdown(wait=False)
+        return learning, sa
+
+    def do_spamassassin(self):
+        """Do the spamassassin procesing.
+
+        It creates a instance of :py:class:`~isbg.spamproc.SpamAssassin`
+        every time that this method is called. The ``SpamAssasssin`` object
+        would contact to the IMAP server to get the emails and to
+        ``SpamAssassin`` command line to process them.
+
+        """
+        if self.fuzzydistance is not None:
+            self.fuzzy = fuzzy.SpamFingerprints(self.fuzzyfile,
+                                                self.fuzzydistance)
+            self.fuzzy.load()
+
+        self.actions = journal.ActionJournal(
+            self.trackfile + "actions", self.checkpointevery,
+            self.checkpointinterval, self.checkpointfsync)
+
+        if self.bulklearn is not None:
+            host, _, port = self.learnspamd.partition(':')
+            client = bulklearn.SpamdClient(host, port or 783)
+            if self.session is not None:
+                client.tell = functools.partial(self.session.scan, 'tell',
+                                                client.tell)
+            self.learner = bulklearn.BulkLearner(client, self.bulklearn)
+
+        sa = spamproc.SpamAssassin.create_from_isbg(self)
+        proc = None
+
+        # Finish the changes of a previous run that has not ended
+        replayed = sa.replay_actions()
+        if replayed:
+            self.logger.info(__(
+                "{} actions of a previous run replayed".format(replayed)))
+
+        learning = None
+        if self.parallel and not self.teachonly and \
+                (self.imapsets.learnspambox or self.imapsets.learnhambox):
+            learning, learner_sa = self._start_learning()
+        else:
+            with self._profile('learn'):
+                s_learned, h_learned = self._do_learn(sa)
+
+        if not self.teachonly:
+            try:
+                # check spaminbox exists by examining it
+                self.imap.select(self.imapsets.spaminbox, 1)
+
+                uidvalidity = self.imap.get_uidvalidity(self.imapsets.inbox)
+                self.remap_pastuids(uidvalidity, self.imapsets.inbox)
+                origpastuids = self.pastuid_read(uidvalidity)
+                with self._profile('inbox'):
+                    proc = self._do_process_inbox(
+                        sa, uidvalidity, origpastuids,
+                        self.backlog_cursor(uidvalidity))
+            except BaseException:
+                if learning is not None:
+                    # The learning stops, what is left is deferred
+                    learner_sa.deadline = time.monotonic()
+                    self.gate.set()
+                    concurrent.futures.wait([learning])
+                raise
+            finally:
+                if learning is not None:
+                    self.gate.set()
+
+        if learning is not None:
+            s_learned, h_learned = learning.result()
+
+        if self.learner is not None:
+            self.learner.close()
+        for jrnl in list(self._journals.values()) + [self.actions]:
+            jrnl.close()
+
+        self.timings.merge(s_learned.timings, 'learn spam ')
+        self.timings.merge(h_learned.timings, 'learn ham ')
+        self.outliers.merge(s_learned.outliers, 'learn spam ')
+        self.outliers.merge(h_learned.outliers, 'learn ham ')
+        if self.imapsets.learnspambox:
+            self.results[self.imapsets.learnspambox] = s_learned
+        if self.imapsets.learnhambox:
+            self.results[self.imapsets.learnhambox] = h_learned
+        if proc is not None:
+            self.timings.merge(proc.timings, 'inbox ')
+            self.outliers.merge(proc.outliers, 'inbox ')
+            self.results[self.imapsets.inbox] = proc
 
         if self.nostats is False:
             if self.imapsets.learnspambox is not None:
@@ -526,19 +1077,232 @@ class ISBG(object):
                                                            proc.nummsg)))
                 self.logger.info(__("{}/{} was automatically deleted".format(
                     proc.spamdeleted, proc.numspam)))
+                if self.fuzzy is not None:
+                    self.logger.info(__(
+                        "{}/{} matched a known spam campaign".format(
+                            proc.numfuzzy, proc.numspam)))
+                if proc.pending:
+                    self.logger.info(__(
+                        ("{} messages in the backlog, about {:.0f}s of " +
+                         "scanning to drain it").format(
+                             proc.pending,
+                             proc.pending * proc.seconds / max(proc.nummsg,
+                                                               1))))
+                if proc.deferred:
+                    self.logger.info(__(
+                        "{} messages deferred to the next run".format(
+                            len(proc.deferred))))
+                if self.tierband is not None:
+                    self.logger.info(__(
+                        ("{} local scans in {:.2f}s, {} full scans in " +
+                         "{:.2f}s").format(*(proc.tiers['local'] +
+                                             proc.tiers['full']))))
 
         return proc
 
+    def do_metrics(self):
+        """Get the Prometheus metrics of the last run.
+
+        Their labels are the ``account`` (the hash of the IMAP settings) and
+        the ``folder``, ``phase`` or IMAP ``command``.
+
+        Returns:
+            isbg.metrics.Metrics: The metrics.
+
+        """
+        account = self.imapsets.hash.hexdigest()
+        mtr = metrics.Metrics()
+        mtr.counter("isbg_runs_total", "Runs of isbg.", 1, account=account)
+        run = self.timings.phases.get('run')
+        if run is not None:
+            mtr.gauge("isbg_run_duration_seconds",
+                      "Duration of the last run.", run.seconds,
+                      account=account)
+        mtr.gauge("isbg_last_run_timestamp_seconds",
+                  "Time when the last run ended.", time.time(),
+                  account=account)
+        for folder, result in self.results.items():
+            if isinstance(result, spamproc.Sa_Process):
+                mtr.counter("isbg_messages_scanned_total",
+                            "Messages scanned.", result.nummsg,
+                            account=account, folder=folder)
+                mtr.counter("isbg_spam_found_total", "Spams found.",
+                            result.numspam, account=account, folder=folder)
+                mtr.gauge("isbg_backlog_messages",
+                          "Messages left to scan in the backlog.",
+                          result.pending, account=account, folder=folder)
+            else:
+                mtr.counter("isbg_messages_learned_total",
+                            "Messages learned.", result.learned,
+                            account=account, folder=folder)
+            mtr.counter("isbg_scanner_errors_total",
+                        "Errors and timeouts scanning or learning.",
+                        result.errors, account=account, folder=folder)
+            for name, phase in result.timings.phases.items():
+                mtr.histogram("isbg_phase_seconds",
+                              "Seconds spent by every message or call of "
+                              "a phase (scan is the scanner latency).",
+                              phase.latency, account=account,
+                              folder=folder, phase=name)
+        if self.imap is not None:
+            for command, stats in sorted(self.imap.stats.commands.items()):
+                mtr.histogram("isbg_imap_command_seconds",
+                              "Latency of the IMAP commands.",
+                              stats.latency, account=account,
+                              command=command)
+                mtr.counter("isbg_imap_sent_bytes_total",
+                            "Bytes sent to the IMAP server.", stats.sent,
+                            account=account, command=command)
+                mtr.counter("isbg_imap_received_bytes_total",
+                            "Bytes received from the IMAP server.",
+                            stats.received, account=account,
+                            command=command)
+        return mtr
+
+    def _do_run_events(self, exitcode=None, error=None):
+        """Write the ``folder`` and ``run`` events of the last run.
+
+        Args:
+            exitcode (int): Its exit code.
+            error (str): The error that ended it, if any.
+
+        """
+        for folder, result in self.results.items():
+            fields = {'folder': folder, 'errors': result.errors,
+                      'deferred': len(result.deferred),
+                      'phases_ms': {name: round(phase.seconds * 1000, 3)
+                                    for name, phase in
+                                    result.timings.phases.items()}}
+            if isinstance(result, spamproc.Sa_Process):
+                fields.update(messages=result.nummsg, spam=result.numspam,
+                              deleted=result.spamdeleted,
+                              backlog=result.pending)
+            else:
+                fields.update(messages=result.tolearn,
+                              learned=result.learned)
+            self.eventlog.emit('folder', **fields)
+        run = self.timings.phases.get('run')
+        self.eventlog.emit(
+            'run', account=self.imapsets.hash.hexdigest(),
+            exitcode=exitcode, error=error,
+            duration_ms=round(run.seconds * 1000, 3) if run else None,
+            phases_ms={name: round(phase.seconds * 1000, 3)
+                       for name, phase in self.timings.phases.items()})
+
+    def _ledger_record(self, started, exitcode, error=None):
+        """Get the record of the last run for the ledger.
+
+        Args:
+            started (float): When the run started, as :py:func:`time.time`.
+            exitcode (int): Its exit code.
+            error (str): The error that ended it, if any.
+
+        Returns:
+            dict: The record, see :py:mod:`isbg.ledger`.
+
+        """
+        folders = {}
+        for folder, result in self.results.items():
+            fetch = result.timings.phases.get('fetch')
+            fields = {'errors': result.errors,
+                      'deferred': len(result.deferred),
+                      'bytes': fetch.nbytes if fetch is not None else 0,
+                      'seconds': round(sum(
+                          phase.seconds for phase in
+                          result.timings.phases.values()), 3)}
+            if isinstance(result, spamproc.Sa_Process):
+                fields.update(messages=result.nummsg, spam=result.numspam,
+                              backlog=result.pending)
+            else:
+                fields.update(messages=result.tolearn,
+                              learned=result.learned)
+            folders[folder] = fields
+        commands = self.imap.stats.commands.values() \
+            if self.imap is not None else []
+        end = time.time()
+        run = self.timings.phases.get('run')
+        return {'start': round(started, 3), 'end': round(end, 3),
+                'account': self.imapsets.hash.hexdigest(),
+                'duration': round(run.seconds if run is not None
+                                  else end - started, 3),
+                'exitcode': exitcode, 'error': error,
+                'sent': sum(stats.sent for stats in commands),
+                'received': sum(stats.received for stats in commands),
+                'folders': folders}
+
+    def _do_ledger(self, started, exitcode, error=None):
+        """Append the record of the last run to the ledger.
+
+        The errors writing it are logged, they don't stop isbg. The replays
+        are not written.
+        """
+        if self.replayfile is not None:
+            return
+        try:
+            ledger.Ledger(self.ledgerfile).append(
+                self._ledger_record(started, exitcode, error))
+        except OSError as exc:
+            self.logger.warning(__(
+                "Ledger {} not written: {}".format(self.ledgerfile, exc)))
+
     def do_imap_login(self):
         """Login to the imap."""
         self.imap = imaputils.login_imap(self.imapsets,
                                          logger=self.logger,
-                                         assertok=self.assertok)
+                                         assertok=self.assertok,
+                                         session=self.session)
 
     def do_imap_logout(self):
         """Sign off from the imap connection."""
         self.imap.logout()
 
+    def _profile(self, name):
+        """Get a context manager that profiles the phase `name`.
+
+        It does nothing if there is no :py:attr:`profiler`.
+        """
+        if self.profiler is None:
+            return _unprofiled()
+        return self.profiler.phase(name)
+
+    def _do_run(self):
+        """Login, process the account and logout.
+
+        Returns:
+            isbg.spamproc.Sa_Process: The results of the inbox, ``None`` if
+            it has not been processed.
+
+        """
+        # Connection with the imaplib server
+        with self.timings.span('login'), self._profile('login'):
+            self.do_imap_login()
+
+        # Should we save it?
+        if self.savepw:
+            self._do_save_password()
+
+        proc = None
+        if self.imaplist:
+            # List imap directories
+            with self._profile('list'):
+                self.do_list_imap()
+        elif self.exportmbox is not None:
+            # Export the learn folders for offline learning
+            with self._profile('export'):
+                self.do_export_mbox()
+        else:
+            # Spamassasin training and processing:
+            proc = self.do_spamassassin()
+
+        # sign off
+        with self.timings.span('logout'), self._profile('logout'):
+            self.do_imap_logout()
+        if self.stop.is_set():
+            raise ISBGError(__exitcodes__['locked'],
+                            "The lease of the account has been lost, the "
+                            "run has been stopped.")
+        return proc
+
     def do_isbg(self):
         """Execute the main isbg process.
 
@@ -546,16 +1310,32 @@ class ISBG(object):
         exitcode if its called from the command line and have the --exitcodes
         param.
         """
+        if self.maxruntime is not None:
+            self.deadline = time.monotonic() + self.maxruntime
+
         if self.delete and not self.gmail and \
                 "\\Deleted" not in self.spamflags:
             self.spamflags.append("\\Deleted")
 
+        replaydir, statefiles = (None, (self.trackfile, self.fuzzyfile))
+        if self.replayfile is not None:
+            # The replay starts from an empty state, and it's thrown away
+            replaydir = tempfile.TemporaryDirectory(prefix="isbg-replay-")
+            self.trackfile = os.path.join(replaydir.name, "track")
+            self.fuzzyfile = os.path.join(replaydir.name, "fuzzy")
+
         if self.trackfile is None:
             self.trackfile = ISBG.set_filename(self.imapsets, "track")
 
         if self.passwdfilename is None:
             self.passwdfilename = ISBG.set_filename(self.imapsets, "password")
 
+        if self.fuzzyfile is None:
+            self.fuzzyfile = ISBG.set_filename(self.imapsets, "fuzzy")
+
+        if self.ledgerfile is None:
+            self.ledgerfile = ledger.default_filename()
+
         self.logger.debug(__("Lock file is {}".format(self.lockfilename)))
         self.logger.debug(__("Trackfile starts with {}".format(self.trackfile))
                           )
@@ -563,41 +1343,84 @@ class ISBG(object):
             "Password file is {}".format(self.passwdfilename)))
         self.logger.debug(__("SpamFlags are {}".format(self.spamflags)))
 
-        # Acquire lockfilename or exit
-        if self.ignorelockfile:
+        # Acquire lockfilename (or the lease of the account) or exit
+        if self.ignorelockfile or self.replayfile is not None:
             self.logger.debug("Lock file is ignored. Continue.")
+        elif self.leasefile is not None or self.leases is not None:
+            self._do_lease_or_raise()
         else:
             self._do_lockfile_or_raise()
 
-        # Figure out the password
-        if self.imapsets.passwd is None:
+        # Figure out the password (not needed to replay a recording)
+        if self.imapsets.passwd is None and self.replayfile is None:
             self._do_get_password()
 
         # ***** Main code starts here *****
 
-        # Connection with the imaplib server
-        self.do_imap_login()
-
-        # Should we save it?
-        if self.savepw:
-            self._do_save_password()
-
-        if self.imaplist:
-            # List imap directories
-            self.do_list_imap()
-        else:
-            # Spamassasin training and processing:
-            proc = self.do_spamassassin()
-
-        # sign off
-        self.do_imap_logout()
-
-        if self.exitcodes and __name__ == '__main__':
-            if not self.teachonly:
+        self.timings, self.results = (timing.Timings(), {})
+        self.outliers = timing.Outliers(self.slowest)
+        start, started = (time.monotonic(), time.time())
+        if self.eventlogfile is not None and self.eventlog is None:
+            self.eventlog = eventlog.EventLog.open(self.eventlogfile)
+        if self.profiledir is not None:
+            self.profiler = profiling.Profiler(self.profiledir)
+        if self.replayfile is not None:
+            self.session = recording.Replayer.open(self.replayfile,
+                                                   self.replayspeed)
+        elif self.recordfile is not None:
+            self.session = recording.Recorder.open(self.recordfile,
+                                                   self.recordbodies)
+
+        proc, exitcode, error = (None, None, None)
+        try:
+            try:
+                proc = self._do_run()
+            finally:
+                self.timings.add('run', time.monotonic() - start,
+                                 proc.nummsg if proc is not None else 0)
+                if self.session is not None:
+                    self.session.close()
+                    self.session = None
+                if replaydir is not None:
+                    self.trackfile, self.fuzzyfile = statefiles
+                    self._journals = {}
+                    replaydir.cleanup()
+
+            if self.nostats is False:
+                for line in self.timings.report() + \
+                        self.imap.stats.report() + self.outliers.report():
+                    self.logger.info(line)
+            if self.metricsfile is not None:
+                self.do_metrics().write(self.metricsfile)
+
+            exitcode = __exitcodes__['ok']
+            if proc is not None and not self.teachonly:
                 if proc.numspam == 0:
-                    return __exitcodes__['newmsgs']
-                if proc.numspam == proc.nummsg:
-                    return __exitcodes__['newspam']
-                return __exitcodes__['newmsgspam']
+                    exitcode = __exitcodes__['newmsgs']
+                elif proc.numspam == proc.nummsg:
+                    exitcode = __exitcodes__['newspam']
+                else:
+                    exitcode = __exitcodes__['newmsgspam']
+        except BaseException as exc:
+            exitcode = getattr(exc, 'exitcode', __exitcodes__['error'])
+            error = str(exc) or type(exc).__name__
+            if isinstance(exc, Exception):
+                self._do_ledger(started, exitcode, error)
+            raise
+        finally:
+            # The run events and the profiles are written even if it fails
+            try:
+                if self.eventlog is not None:
+                    self._do_run_events(exitcode, error)
+            finally:
+                if self.eventlog is not None and \
+                        self.eventlogfile is not None:
+                    self.eventlog.close()
+                    self.eventlog = None
+                if self.profiler is not None:
+                    self.profiler.dump()
+                    self.profiler = None
+        self._do_ledger(started, exitcode)
 
-            return __exitcodes__['ok']
+        if self.exitcodes and __name__ == '__main__':
+            return exitcode
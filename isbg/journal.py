@@ -0,0 +1,298 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  journal.py
+#  This file is part of isbg.
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+
+"""Journals used to keep the progress of a run for isbg.
+
+The journals are append-only files with a json record by line. Every record
+is flushed to the operating system when it's written, and synced to the
+disk (with :py:func:`os.fsync`) every `every` records or `interval`
+seconds. A record partially written when the process was killed is
+ignored when it's read.
+
+.. versionadded:: 2.3.0
+"""
+
+import base64
+import json
+import logging
+import os
+import threading
+import time
+
+from .utils import __
+
+
+def write_atomic(filename, data):
+    """Write a file replacing it atomically.
+
+    The data is written to a temporary file that, once synced, replaces
+    `filename`. A crash leaves the old or the new file, but not a partial
+    one.
+
+    Args:
+        filename (str): The file name.
+        data (str): The contents.
+
+    """
+    tmpname = filename + ".tmp"
+    with open(tmpname, "w") as wfile:
+        try:
+            os.chmod(tmpname, 0o600)
+        except Exception:  # pylint: disable=broad-except
+            pass
+        wfile.write(data)
+        wfile.flush()
+        os.fsync(wfile.fileno())
+    os.replace(tmpname, filename)
+
+
+class Journal(object):
+    """Append-only file of json records.
+
+    It can be shared between threads.
+
+    Attributes:
+        filename (str): The journal file name.
+        every (int): Number of records written between syncs.
+        interval (float): Maximum seconds between syncs.
+        fsync (bool): If False, the records are only flushed to the operating
+            system, they survive a crash of isbg but not of the system.
+
+    """
+
+    #: Logger object used to show debug info.
+    logger = logging.getLogger(__name__)
+
+    def __init__(self, filename, every=10, interval=5.0, fsync=True):
+        """Initialize a Journal object."""
+        self.filename = filename
+        self.every = every
+        self.interval = interval
+        self.fsync = fsync
+        self._file = None
+        self._unsynced = 0
+        self._synced_at = time.monotonic()
+        self._lock = threading.RLock()
+
+    def _open(self):
+        """Open the journal file for append, if it's not opened."""
+        if self._file is None:
+            self._file = open(self.filename, "a")
+            try:
+                os.chmod(self.filename, 0o600)
+            except Exception:  # pylint: disable=broad-except
+                pass
+        return self._file
+
+    def write(self, record):
+        """Append a record to the journal.
+
+        Args:
+            record: A json serializable object.
+
+        """
+        with self._lock:
+            jfile = self._open()
+            jfile.write(json.dumps(record) + "\n")
+            jfile.flush()
+            self._unsynced += 1
+            if self._unsynced >= self.every or \
+                    time.monotonic() - self._synced_at >= self.interval:
+                self.sync()
+
+    def sync(self):
+        """Sync the records written to the disk."""
+        with self._lock:
+            if self._file is not None and self._unsynced:
+                self._file.flush()
+                if self.fsync:
+                    os.fsync(self._file.fileno())
+            self._unsynced = 0
+            self._synced_at = time.monotonic()
+
+    def records(self):
+        """Read the records of the journal.
+
+        Returns:
+            list: The records, without the partially written ones.
+
+        """
+        records = []
+        try:
+            with open(self.filename, "r") as rfile:
+                for line in rfile:
+                    try:
+                        records.append(json.loads(line))
+                    except ValueError:
+                        self.logger.warning(__(
+                            "Ignored partial record in journal {}".format(
+                                self.filename)))
+        except (IOError, OSError):
+            pass
+        return records
+
+    def clear(self, header=None):
+        """Empty the journal, once its records are stored elsewhere.
+
+        Args:
+            header: If it's not None, the first record of the emptied journal.
+
+        """
+        with self._lock:
+            jfile = self._open()
+            jfile.seek(0)
+            jfile.truncate()
+            self._unsynced = 0
+            if header is not None:
+                jfile.write(json.dumps(header) + "\n")
+                self._unsynced = 1
+            self.sync()
+
+    def close(self):
+        """Sync and close the journal file."""
+        with self._lock:
+            if self._file is not None:
+                self.sync()
+                self._file.close()
+                self._file = None
+
+
+class UidJournal(Journal):
+    """Journal of the ``uids`` processed in a folder.
+
+    It's used as a checkpoint of the track file: the ``uids`` are written
+    as soon as they are processed, and the journal is emptied once the track
+    file is written. Its first record is the *uidvalidity* of the folder.
+
+    """
+
+    def __init__(self, filename, uidvalidity, every=10, interval=5.0,
+                 fsync=True):
+        """Initialize a UidJournal object."""
+        Journal.__init__(self, filename, every, interval, fsync)
+        self.uidvalidity = uidvalidity
+
+    def append(self, uid):
+        """Record a processed ``uid``."""
+        if self._file is None and \
+                self.records()[:1] != [{'uidvalidity': self.uidvalidity}]:
+            self.clear()
+        self.write(int(uid))
+
+    def read(self):
+        """Get the ``uids`` recorded.
+
+        Returns:
+            list(int): The ``uids``, empty if the journal is from another
+            *uidvalidity*.
+
+        """
+        records = self.records()
+        if not records or records[0] != {'uidvalidity': self.uidvalidity}:
+            return []
+        return [r for r in records[1:] if isinstance(r, int)]
+
+    def clear(self, header=None):
+        """Empty the journal, keeping the *uidvalidity*."""
+        Journal.clear(self, {'uidvalidity': self.uidvalidity})
+
+
+class ActionJournal(Journal):
+    """Write-ahead journal of the actions done in the IMAP server.
+
+    Every action is recorded (as a *intent*) before doing it, and marked as
+    done once it has been done. If a run ends before doing its actions, the
+    next one can replay the pending ones instead of scanning the messages
+    again. Once all the actions are done, the journal is emptied.
+
+    The records are dicts with:
+        * ``id``: the action id.
+        * ``op``: ``append``, ``copy``, ``store`` or ``expunge``.
+        * ``mailbox``: the mailbox where the message is appended, or the
+          mailbox of the ``uid``.
+        * ``uid`` and ``uidvalidity``: the message, for ``copy`` and
+          ``store``.
+        * ``args``: the other args of the command.
+        * ``message``: the message to append, base64 encoded.
+        * ``msgid``: the ``Message-ID`` of the message appended or copied,
+          used to not duplicate it.
+
+    Or ``{'done': id}`` when the action has been done.
+
+    """
+
+    def __init__(self, filename, every=10, interval=5.0, fsync=True):
+        """Initialize a ActionJournal object."""
+        Journal.__init__(self, filename, every, interval, fsync)
+        self._pending = {}
+        self._next_id = 1
+        for record in self.records():
+            if 'done' in record:
+                self._pending.pop(record['done'], None)
+            elif 'id' in record:
+                self._pending[record['id']] = record
+                self._next_id = max(self._next_id, record['id'] + 1)
+
+    def intend(self, op, mailbox, uid=None, args=(), message=None,
+               msgid=None, uidvalidity=None):
+        """Record a action before doing it.
+
+        Returns:
+            int: The action id, to mark it as done.
+
+        """
+        record = {'op': op, 'mailbox': mailbox, 'uid': uid,
+                  'uidvalidity': uidvalidity, 'args': list(args),
+                  'msgid': msgid, 'message': None}
+        if message is not None:
+            if isinstance(message, str):
+                message = message.encode(errors='replace')
+            record['message'] = base64.b64encode(message).decode('ascii')
+        with self._lock:
+            record['id'] = self._next_id
+            self._next_id += 1
+            self._pending[record['id']] = record
+            self.write(record)
+        return record['id']
+
+    def done(self, action_id):
+        """Mark a action as done."""
+        with self._lock:
+            self._pending.pop(action_id, None)
+            if self._pending:
+                self.write({'done': action_id})
+            else:
+                self.clear()
+
+    def pending(self):
+        """Get the actions not done, in the order that they were recorded.
+
+        Returns:
+            list(dict): The action records, with the ``message`` decoded.
+
+        """
+        actions = []
+        for action_id in sorted(self._pending):
+            action = dict(self._pending[action_id])
+            if action.get('message') is not None:
+                action['message'] = base64.b64decode(action['message'])
+            actions.append(action)
+        return actions
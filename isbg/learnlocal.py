@@ -0,0 +1,282 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  learnlocal.py
+#  This file is part of isbg.
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+
+"""Offline learning from local mbox files and Maildir directories.
+
+The messages are read from the files (for example, those exported with
+``isbg --exportmbox``), unwrapped as :py:func:`isbg.sa_unwrap.unwrap` does,
+in several processes, and learned with a
+:py:class:`~isbg.bulklearn.BulkLearner`.
+
+Examples:
+    To learn the spams of a mbox file and a Maildir::
+
+        $ isbg learn-local --spam exported/spam.mbox ~/Maildir/.Junk
+
+.. versionadded:: 2.3.0
+"""
+
+import collections
+import concurrent.futures
+import itertools
+import logging
+import mailbox
+import os
+import sys
+
+from subprocess import TimeoutExpired
+
+from isbg import bulklearn
+from isbg import isbg
+from isbg import sa_unwrap
+from isbg import spamproc
+
+from .utils import __
+
+try:
+    # Creating command-line interface
+    from docopt import docopt, DocoptExit, printable_usage
+except ImportError:
+    sys.stderr.write("Missing dependency: docopt\n")
+    raise
+
+#: Number of messages read before they are parsed by the processes.
+BATCH_SIZE = 500
+
+
+def iter_messages(path):
+    """Read the messages of a mbox file or a Maildir directory.
+
+    Args:
+        path (str): The file or directory. A directory with ``cur`` and
+            ``new`` subdirectories is a Maildir, any other path a mbox file.
+
+    Yields:
+        bytes: The contents of every message.
+
+    """
+    if os.path.isdir(os.path.join(path, 'cur')) and \
+            os.path.isdir(os.path.join(path, 'new')):
+        box = mailbox.Maildir(path, factory=None, create=False)
+    elif os.path.isfile(path):
+        box = mailbox.mbox(path, create=False)
+    else:
+        raise isbg.ISBGError(isbg.__exitcodes__['flags'],
+                             "{} is not a mbox file or a Maildir".format(path))
+    try:
+        for key in box.iterkeys():
+            yield box.get_bytes(key)
+    finally:
+        box.close()
+
+
+def unwrap_message(data):
+    """Unwrap a message from a SpamAssassin report if it's wrapped.
+
+    It's run in the parsing processes, so it gets and returns ``bytes``.
+
+    Args:
+        data (bytes): The contents of the message.
+
+    Returns:
+        bytes: The original message.
+
+    """
+    unwrapped = sa_unwrap.unwrap(data)
+    if unwrapped is not None and unwrapped:  # len(unwrapped) > 0
+        return unwrapped[0].as_bytes()
+    return data
+
+
+def learn_local(paths, learn_type, learner, processes=None, timeout=None,
+                logger=None):
+    """Learn the messages of mbox files and Maildir directories.
+
+    The messages are unwrapped in `processes` processes and sent to the
+    `learner` at the same time.
+
+    Args:
+        paths (list(str)): The mbox files and Maildir directories.
+        learn_type (str): ``spam``, ``ham`` or ``forget``.
+        learner (isbg.bulklearn.BulkLearner): The learner used.
+        processes (int): Number of parsing processes, by default the number
+            of processors. With ``1`` they are parsed in this process.
+        timeout (float): Seconds to wait for ``spamd`` for every message.
+        logger (logging.Logger): Where the errors are written.
+
+    Returns:
+        isbg.spamproc.Sa_Learn: The results.
+
+    Raises:
+        isbg.ISBGError: If ``spamd`` refuses to learn (it has not been
+            started with ``--allow-tell``).
+
+    """
+    if logger is None:
+        logger = logging.getLogger(__name__)
+    result = spamproc.Sa_Learn()
+    sent = collections.deque()
+
+    def learned(future):
+        try:
+            code, spamd_code = future.result()
+        except TimeoutExpired:
+            logger.warning("Timeout learning a message")
+            return
+        if code == 5:
+            result.learned += 1
+        elif code in (69, 74):
+            raise isbg.ISBGError(
+                isbg.__exitcodes__['spamc'],
+                "spamd has refused to learn (code {}), is it started with "
+                "--allow-tell?".format(spamd_code))
+        elif code != 6:
+            logger.warning(__("Error learning a message: {}".format(code)))
+
+    messages = itertools.chain.from_iterable(iter_messages(path)
+                                             for path in paths)
+    pool = None
+    if processes != 1:
+        pool = concurrent.futures.ProcessPoolExecutor(processes)
+    try:
+        while True:
+            batch = list(itertools.islice(messages, BATCH_SIZE))
+            if not batch:
+                break
+            if pool is None:
+                parsed = map(unwrap_message, batch)
+            else:
+                parsed = pool.map(unwrap_message, batch, chunksize=50)
+            for mail in parsed:
+                result.tolearn += 1
+                sent.append(learner.submit(mail, learn_type, timeout))
+                if len(sent) >= 2 * learner.workers:
+                    learned(sent.popleft())
+        while sent:
+            learned(sent.popleft())
+    finally:
+        if pool is not None:
+            pool.shutdown()
+    return result
+
+
+def __isbg_learn_local_opts__():  # noqa: D207
+    """isbg learn-local learns the messages of mbox files and Maildirs.
+
+The messages are sent to spamd with the TELL command, so it must be started
+with --allow-tell.
+
+Command line Options::
+
+ Usage:
+  isbg learn-local (--spam | --ham | --forget) [options] <path>...
+  isbg learn-local (-h | --help)
+  isbg learn-local --usage
+  isbg learn-local --version
+
+ Options:
+  -h, --help            Show the help screen.
+  --usage               Show the usage information.
+  --version             Show the version information.
+
+  --spam                Learn the messages as spam.
+  --ham                 Learn the messages as ham.
+  --forget              Forget the messages.
+  --bulklearn num       Number of messages learned at the same time
+                        [default: 4].
+  --learnspamd host     The host[:port] of spamd [default: localhost].
+  --learnsync           Sync the Bayes journal once the messages are
+                        learned, if spamd is local.
+  --processes num       Number of processes unwrapping the messages, by
+                        default the number of processors.
+  --scantimeout secs    Seconds to wait for spamd for every message.
+  --verbose             Show the errors learning every message.
+
+"""
+
+
+def isbg_learn_local(argv=None):
+    """Run when ``isbg learn-local`` is called from the command line.
+
+    Args:
+        argv (list(str)): The arguments, by default :py:data:`sys.argv`.
+
+    Returns:
+        isbg.spamproc.Sa_Learn: The results, ``None`` with ``--usage``.
+
+    """
+    try:
+        opts = docopt(__isbg_learn_local_opts__.__doc__, argv,
+                      version="isbg learn-local v" + isbg.__version__ +
+                      ", from: " + os.path.abspath(__file__) + "\n\n" +
+                      isbg.__license__)
+    except DocoptExit:
+        sys.stderr.write('Error with options!!!\n')
+        raise
+
+    if opts.get("--usage"):
+        sys.stdout.write(
+            "{}\n".format(printable_usage(__isbg_learn_local_opts__.__doc__)))
+        return None
+
+    logger = logging.getLogger(__name__)
+    logger.addHandler(logging.StreamHandler())
+    logger.setLevel(logging.DEBUG if opts["--verbose"] else logging.INFO)
+
+    try:
+        workers = int(opts["--bulklearn"])
+        processes = None if opts["--processes"] is None \
+            else int(opts["--processes"])
+        timeout = None if opts["--scantimeout"] is None \
+            else float(opts["--scantimeout"])
+    except ValueError:
+        raise isbg.ISBGError(isbg.__exitcodes__['flags'],
+                             "Use numbers in --bulklearn, --processes and " +
+                             "--scantimeout")
+    if workers < 1 or (processes is not None and processes < 1):
+        raise isbg.ISBGError(isbg.__exitcodes__['flags'],
+                             "--bulklearn and --processes must be 1 or more")
+
+    if opts["--spam"]:
+        learn_type = 'spam'
+    elif opts["--ham"]:
+        learn_type = 'ham'
+    else:
+        learn_type = 'forget'
+
+    host, _, port = opts["--learnspamd"].partition(':')
+    learner = bulklearn.BulkLearner(
+        bulklearn.SpamdClient(host, int(port) if port else 783), workers)
+    try:
+        result = learn_local(opts["<path>"], learn_type, learner, processes,
+                             timeout, logger)
+    finally:
+        learner.close()
+    if opts["--learnsync"] and result.learned:
+        bulklearn.sync_bayes(timeout, logger, opts["--learnspamd"])
+
+    logger.info(__("{}/{} messages learned as {}".format(
+        result.learned, result.tolearn, learn_type)))
+    return result
+
+
+if __name__ == '__main__':
+    isbg_learn_local()
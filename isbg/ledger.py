@@ -0,0 +1,328 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  ledger.py
+#  This file is part of isbg.
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+
+"""Ledger of the runs of isbg - IMAP Spam Begone.
+
+Every run appends a record to the ledger, a file of JSON lines::
+
+    {"start": 1700000000.1, "end": 1700000042.5, "account": "9f1c...",
+     "duration": 42.4, "exitcode": 1, "error": null, "sent": 1520,
+     "received": 2481033, "folders": {"INBOX": {"messages": 50, "spam": 3,
+     "backlog": 120, "errors": 0, "deferred": 0, "bytes": 2420311,
+     "seconds": 40.1}}}
+
+When the ledger reaches :py:data:`MAX_BYTES` it's rotated, keeping
+:py:data:`BACKUPS` old files (``ledger.jsonl.1``, ``ledger.jsonl.2``...).
+The ledger is shared by all the accounts, so the records are appended, and
+the ledger rotated, holding the lock of ``ledger.jsonl.lock``.
+
+``isbg stats`` summarizes the throughput, the error rates and the backlog
+trends of the runs recorded (see :py:func:`summarize`).
+
+.. versionadded:: 2.3.0
+"""
+
+import contextlib
+import json
+import logging
+import os
+import sys
+import time
+
+import isbg
+
+from .utils import __
+
+try:
+    # Creating command-line interface
+    from docopt import docopt, DocoptExit, printable_usage
+except ImportError:
+    sys.stderr.write("Missing dependency: docopt\n")
+    raise
+
+try:
+    import fcntl
+except ImportError:  # Not available in Windows
+    fcntl = None  # pylint: disable=invalid-name
+
+#: Size of the ledger when it's rotated.
+MAX_BYTES = 1024 * 1024
+#: Number of rotated ledgers kept.
+BACKUPS = 3
+
+
+def default_filename():
+    """Get the ledger used by default, in ``xdg_cache_home``/isbg/."""
+    return os.path.join(isbg.isbg.xdg_cache_home, "isbg", "ledger.jsonl")
+
+
+class Ledger(object):
+    """A ledger of JSON lines, rotated by size.
+
+    Attributes:
+        filename (str): The ledger.
+        maxbytes (int): Size of the ledger when it's rotated.
+        backups (int): Number of rotated ledgers kept.
+
+    """
+
+    #: Logger object used to show debug info.
+    logger = logging.getLogger(__name__)
+
+    def __init__(self, filename, maxbytes=MAX_BYTES, backups=BACKUPS):
+        """Initialize a Ledger object."""
+        self.filename = filename
+        self.maxbytes = maxbytes
+        self.backups = backups
+
+    def _backup(self, num):
+        """Get the file name of a rotated ledger."""
+        return "{}.{}".format(self.filename, num)
+
+    @contextlib.contextmanager
+    def _locked(self):
+        """Hold the lock of the ledger, where :py:func:`fcntl.flock` exists.
+
+        It's a file apart, as the ledger is renamed when it's rotated.
+        """
+        if fcntl is None:
+            yield
+            return
+        with open(self.filename + ".lock", 'a') as lockfile:
+            fcntl.flock(lockfile.fileno(), fcntl.LOCK_EX)
+            yield
+
+    def rotate(self):
+        """Rename the ledger to ``.1``, the ``.1`` to ``.2``, and so on."""
+        for num in range(self.backups - 1, 0, -1):
+            if os.path.exists(self._backup(num)):
+                os.replace(self._backup(num), self._backup(num + 1))
+        if self.backups > 0:
+            os.replace(self.filename, self._backup(1))
+        else:
+            os.remove(self.filename)
+
+    def append(self, record):
+        """Append a record, rotating the ledger if it's full.
+
+        Other processes appending to the ledger wait meanwhile.
+
+        Args:
+            record (dict): The record, it must be serializable to JSON.
+
+        """
+        line = json.dumps(record, sort_keys=True) + "\n"
+        with self._locked():
+            try:
+                if os.path.getsize(self.filename) + len(line) > \
+                        self.maxbytes:
+                    self.rotate()
+            except FileNotFoundError:
+                pass
+            with open(self.filename, 'a') as fhandle:
+                fhandle.write(line)
+
+    def read(self, account=None):
+        """Read the records, the oldest first, rotated ledgers included.
+
+        Args:
+            account (str): If it's not None, only the records of this
+                account hash are read.
+
+        Yields:
+            dict: The records. The lines that are not JSON are skipped.
+
+        """
+        filenames = [self._backup(num)
+                     for num in range(self.backups, 0, -1)] + [self.filename]
+        for filename in filenames:
+            try:
+                fhandle = open(filename)
+            except FileNotFoundError:
+                continue
+            with fhandle:
+                for line in fhandle:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        self.logger.debug(__(
+                            "Invalid line in {}: {!r}", filename, line))
+                        continue
+                    if account is None or record.get('account') == account:
+                        yield record
+
+
+def _rate(records):
+    """Get the messages per second of some runs."""
+    messages = sum(folder.get('messages', 0) for record in records
+                   for folder in record.get('folders', {}).values())
+    seconds = sum(record.get('duration') or 0 for record in records)
+    return messages / seconds if seconds > 0 else 0.0
+
+
+def summarize(records):
+    """Summarize the runs of a ledger.
+
+    Args:
+        records (list(dict)): The records, the oldest first.
+
+    Returns:
+        dict: The number of ``runs``, the ``first`` start and the ``last``
+        end, the runs ``failed``, the ``messages``, the ``seconds`` and the
+        ``bytes`` of all the runs, their ``rate`` (messages per second),
+        the rates of the first and of the second half of the runs
+        (``trend``), the scanner ``errors``, and the ``folders`` with their
+        ``messages``, ``spam``, ``learned``, ``errors`` and their first and
+        last ``backlog``.
+
+    """
+    records = list(records)
+    summary = {'runs': len(records), 'failed': 0, 'messages': 0,
+               'seconds': 0.0, 'bytes': 0, 'errors': 0, 'folders': {},
+               'first': records[0].get('start') if records else None,
+               'last': records[-1].get('end') if records else None,
+               'rate': _rate(records),
+               'trend': (_rate(records[:len(records) // 2]),
+                         _rate(records[len(records) // 2:]))}
+    for record in records:
+        if record.get('error') is not None:
+            summary['failed'] += 1
+        summary['seconds'] += record.get('duration') or 0
+        for name, folder in record.get('folders', {}).items():
+            total = summary['folders'].setdefault(name, {
+                'messages': 0, 'spam': 0, 'learned': 0, 'errors': 0,
+                'backlog': None})
+            for key in ('messages', 'spam', 'learned', 'errors'):
+                total[key] += folder.get(key, 0)
+            if 'backlog' in folder:
+                total['backlog'] = [folder['backlog'] if total['backlog']
+                                    is None else total['backlog'][0],
+                                    folder['backlog']]
+            summary['messages'] += folder.get('messages', 0)
+            summary['bytes'] += folder.get('bytes', 0)
+            summary['errors'] += folder.get('errors', 0)
+    return summary
+
+
+def report(summary):
+    """Get the lines of text of a :py:func:`summarize` summary.
+
+    Returns:
+        list(str): The lines.
+
+    """
+    if not summary['runs']:
+        return ["No runs recorded"]
+
+    def date(stamp):
+        return time.strftime("%Y-%m-%d %H:%M", time.localtime(stamp or 0))
+
+    lines = [
+        "{} runs from {} to {}, {} failed ({:.1%})".format(
+            summary['runs'], date(summary['first']), date(summary['last']),
+            summary['failed'], summary['failed'] / summary['runs']),
+        ("{} messages in {:.1f}s, {:.1f} msgs/s (first half {:.1f}, " +
+         "second half {:.1f} msgs/s)").format(
+             summary['messages'], summary['seconds'], summary['rate'],
+             *summary['trend']),
+        "{} scanner errors ({:.2%} of the messages), {} bytes fetched".format(
+            summary['errors'], summary['errors'] / max(summary['messages'], 1),
+            summary['bytes'])]
+    for name, folder in sorted(summary['folders'].items()):
+        line = "{}: {} messages, {} spams, {} learned, {} errors".format(
+            name, folder['messages'], folder['spam'], folder['learned'],
+            folder['errors'])
+        if folder['backlog'] is not None:
+            line += ", backlog {} -> {}".format(*folder['backlog'])
+        lines.append(line)
+    return lines
+
+
+def __isbg_stats_opts__():  # noqa: D207
+    """isbg stats summarizes the runs recorded in the ledger of isbg.
+
+Command line Options::
+
+ Usage:
+  isbg stats [options]
+  isbg stats (-h | --help)
+  isbg stats --usage
+  isbg stats --version
+
+ Options:
+  -h, --help            Show the help screen.
+  --usage               Show the usage information.
+  --version             Show the version information.
+
+  --account hash        Only the runs of the account with this hash.
+  --json                Show the summary as JSON.
+  --last num            Only the last 'num' runs.
+  --ledger file         The ledger, by default the ledger of isbg in its
+                        cache directory.
+
+"""
+
+
+def isbg_stats(argv=None):
+    """Run when ``isbg stats`` is called from the command line.
+
+    Args:
+        argv (list(str)): The arguments, by default :py:data:`sys.argv`.
+
+    Returns:
+        dict: The :py:func:`summarize` summary, ``None`` with ``--usage``.
+
+    """
+    try:
+        opts = docopt(__isbg_stats_opts__.__doc__, argv,
+                      version="isbg stats v" + isbg.__version__ +
+                      ", from: " + os.path.abspath(__file__) + "\n\n" +
+                      isbg.__license__)
+    except DocoptExit:
+        sys.stderr.write('Error with options!!!\n')
+        raise
+
+    if opts.get("--usage"):
+        sys.stdout.write(
+            "{}\n".format(printable_usage(__isbg_stats_opts__.__doc__)))
+        return None
+
+    try:
+        last = None if opts["--last"] is None else int(opts["--last"])
+    except ValueError:
+        raise isbg.ISBGError(isbg.__exitcodes__['flags'],
+                             "Unrecognized number - " + opts["--last"])
+    if last is not None and last < 1:
+        raise isbg.ISBGError(isbg.__exitcodes__['flags'],
+                             "--last must be 1 or more")
+
+    records = list(Ledger(opts["--ledger"] or default_filename()).read(
+        opts["--account"]))
+    summary = summarize(records[-last:] if last is not None else records)
+    if opts["--json"]:
+        sys.stdout.write(json.dumps(summary, sort_keys=True) + "\n")
+    else:
+        sys.stdout.write("".join(line + "\n" for line in report(summary)))
+    return summary
+
+
+if __name__ == '__main__':
+    isbg_stats()
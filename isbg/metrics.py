@@ -0,0 +1,307 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  metrics.py
+#  This file is part of isbg.
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+
+"""Prometheus metrics of isbg - IMAP Spam Begone.
+
+:py:class:`Metrics` holds the metrics in the Prometheus text format, so
+they can be written to a *textfile* read by the ``node_exporter`` (see
+:py:meth:`Metrics.write`) or served by HTTP (see :py:func:`serve`).
+
+isbg runs once and ends, so the counters and histograms written to a file
+are added to those already in it: they grow from run to run as Prometheus
+expects.
+
+.. versionadded:: 2.3.0
+"""
+
+import collections
+import contextlib
+import http.server
+import logging
+import os
+import re
+import socketserver
+import threading
+
+from .utils import __
+
+try:
+    import fcntl
+except ImportError:  # Not available in Windows
+    fcntl = None  # pylint: disable=invalid-name
+
+#: Content type of the Prometheus text format.
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+_SAMPLE_RE = re.compile(r'^([a-zA-Z_:][a-zA-Z0-9_:]*)(?:\{(.*)\})? (\S+)$')
+_LABEL_RE = re.compile(r'([a-zA-Z_][a-zA-Z0-9_]*)="((?:[^"\\]|\\.)*)"')
+
+
+def _escape(value):
+    """Escape a label value."""
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace(
+        '\n', '\\n')
+
+
+def _unescape(value):
+    """Unescape a label value."""
+    return re.sub(r'\\(.)', lambda m: '\n' if m.group(1) == 'n'
+                  else m.group(1), value)
+
+
+@contextlib.contextmanager
+def _locked(filename):
+    """Hold the lock of `filename`, where :py:func:`fcntl.flock` exists.
+
+    It's the file `filename` + ``.lock``, as `filename` is replaced when
+    it's written.
+    """
+    if fcntl is None:
+        yield
+        return
+    with open(filename + ".lock", 'a') as lockfile:
+        fcntl.flock(lockfile.fileno(), fcntl.LOCK_EX)
+        yield
+
+
+def _labels(labels):
+    """Get the labels of a sample as a sorted tuple of pairs."""
+    return tuple(sorted((key, str(val)) for key, val in labels.items()))
+
+
+def _format_value(value):
+    """Format a sample value."""
+    if value == float('inf'):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+class Metrics(object):
+    """A set of metrics in the Prometheus text format.
+
+    Every family has a type (``counter``, ``gauge`` or ``histogram``), a help
+    text and its samples, identified by their name and labels.
+
+    """
+
+    #: Logger object used to show debug info.
+    logger = logging.getLogger(__name__)
+
+    def __init__(self):
+        """Initialize a Metrics object."""
+        self._families = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def _family(self, name, mtype, doc):
+        """Get the samples of a family, creating it if it's needed."""
+        if name not in self._families:
+            self._families[name] = [mtype, doc, collections.OrderedDict()]
+        return self._families[name][2]
+
+    def counter(self, name, doc, value, **labels):
+        """Increase a counter.
+
+        Args:
+            name (str): The metric name, it should end with ``_total``.
+            doc (str): Its help text.
+            value (float): The increment.
+            **labels: The labels of the sample.
+
+        """
+        with self._lock:
+            samples = self._family(name, 'counter', doc)
+            key = (name, _labels(labels))
+            samples[key] = samples.get(key, 0) + value
+
+    def gauge(self, name, doc, value, **labels):
+        """Set a gauge, see :py:meth:`counter`."""
+        with self._lock:
+            samples = self._family(name, 'gauge', doc)
+            samples[(name, _labels(labels))] = value
+
+    def histogram(self, name, doc, hist, **labels):
+        """Add the values of a histogram.
+
+        Args:
+            name (str): The metric name.
+            doc (str): Its help text.
+            hist (isbg.timing.Histogram): The values.
+            **labels: The labels of the sample.
+
+        """
+        with self._lock:
+            samples = self._family(name, 'histogram', doc)
+            labels = _labels(labels)
+            cumulative = 0
+            for bound, count in zip(hist.buckets + (float('inf'),),
+                                    hist.counts):
+                cumulative += count
+                key = (name + '_bucket', labels + (('le', bound),))
+                samples[key] = samples.get(key, 0) + cumulative
+            for suffix, value in (('_sum', hist.sum), ('_count', hist.count)):
+                key = (name + suffix, labels)
+                samples[key] = samples.get(key, 0) + value
+
+    def render(self):
+        """Get the metrics in the Prometheus text format.
+
+        Returns:
+            str: The metrics.
+
+        """
+        lines = []
+        with self._lock:
+            for name, (mtype, doc, samples) in self._families.items():
+                lines.append("# HELP {} {}".format(name, doc))
+                lines.append("# TYPE {} {}".format(name, mtype))
+                for (sample, labels), value in samples.items():
+                    if labels:
+                        sample += "{" + ",".join(
+                            '{}="{}"'.format(key, _escape(
+                                _format_value(val) if key == 'le' else val))
+                            for key, val in labels) + "}"
+                    lines.append("{} {}".format(sample, _format_value(value)))
+        return "\n".join(lines) + "\n"
+
+    def load(self, filename):
+        """Add the metrics of a file written by :py:meth:`write`.
+
+        The counters and the histograms are added to those of this object,
+        so they are kept between runs. The gauges are kept only if they are
+        not set again.
+
+        Args:
+            filename (str): The file. If it does not exist nothing is done.
+
+        """
+        try:
+            with open(filename) as fhandle:
+                text = fhandle.read()
+        except FileNotFoundError:
+            return
+        with self._lock:
+            loaded = collections.OrderedDict()
+            family = None
+            for line in text.splitlines():
+                if line.startswith("# HELP "):
+                    name, _, doc = line[7:].partition(' ')
+                    family = loaded.setdefault(
+                        name, ['untyped', doc, collections.OrderedDict()])
+                elif line.startswith("# TYPE ") and family is not None:
+                    family[0] = line[7:].partition(' ')[2]
+                elif family is not None and not line.startswith('#'):
+                    match = _SAMPLE_RE.match(line)
+                    if match is None:
+                        continue
+                    labels = tuple(
+                        (key, float(_unescape(val)) if key == 'le'
+                         else _unescape(val))
+                        for key, val in _LABEL_RE.findall(match.group(2) or
+                                                          ''))
+                    family[2][(match.group(1), labels)] = float(
+                        match.group(3))
+            for name, (mtype, doc, samples) in loaded.items():
+                current = self._family(name, mtype, doc)
+                for key, value in samples.items():
+                    if mtype == 'gauge':
+                        current.setdefault(key, value)
+                    else:
+                        current[key] = current.get(key, 0) + value
+
+    def write(self, filename, load=True):
+        """Write the metrics to a file atomically.
+
+        The file is written with another name and renamed, so the
+        ``node_exporter`` never reads a partial file. The runs of several
+        accounts can write the same file: it's loaded, merged and replaced
+        holding the lock of `filename` + ``.lock``.
+
+        Args:
+            filename (str): The file, it should end with ``.prom``.
+            load (bool): If True the metrics already in the file are added
+                first (see :py:meth:`load`).
+
+        """
+        with _locked(filename):
+            if load:
+                self.load(filename)
+            tmpname = "{}.{}.tmp".format(filename, os.getpid())
+            with open(tmpname, 'w') as fhandle:
+                fhandle.write(self.render())
+            os.replace(tmpname, filename)
+        self.logger.debug(__("Metrics written to {}".format(filename)))
+
+
+class _MetricsHandler(http.server.BaseHTTPRequestHandler):
+    """Serve ``/metrics``."""
+
+    def do_GET(self):  # noqa: N802 pylint: disable=invalid-name
+        """Answer a GET request."""
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = self.server.collect().render().encode('utf-8')
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        """Log the requests as debug messages."""
+        Metrics.logger.debug(__(format % args))
+
+
+class _Server(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    """An HTTP server with a thread per request.
+
+    It's :py:class:`http.server.ThreadingHTTPServer`, that is new in Python
+    3.7.
+    """
+
+    daemon_threads = True
+
+
+def serve(collect, port, host='127.0.0.1'):
+    """Serve the metrics in ``http://host:port/metrics`` in background.
+
+    It is meant for the programs that run isbg for a long time (e.g. calling
+    :py:meth:`isbg.ISBG.do_isbg` in a loop).
+
+    Args:
+        collect (callable): Returns the :py:class:`Metrics` to serve, it's
+            called for every request.
+        port (int): The TCP port, ``0`` to use a free one.
+        host (str): The address to listen on.
+
+    Returns:
+        http.server.HTTPServer: The server. It's stopped with its
+        ``shutdown`` method.
+
+    """
+    server = _Server((host, port), _MetricsHandler)
+    server.collect = collect
+    thread = threading.Thread(target=server.serve_forever, name="metrics")
+    thread.daemon = True
+    thread.start()
+    return server
@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  profiling.py
+#  This file is part of isbg.
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+
+"""Profiling of the phases of isbg - IMAP Spam Begone.
+
+Every phase is profiled with its own :py:class:`cProfile.Profile`, and
+:py:meth:`Profiler.dump` writes for every phase:
+
+``<phase>.pstats``
+    The stats, to be read with :py:mod:`pstats` or tools like *snakeviz*.
+``<phase>.collapsed``
+    The collapsed stacks (``a;b;c microseconds``) for *flamegraph.pl* or
+    *speedscope*. cProfile only records the callers of every function, so
+    the time of a function is split between its callers in proportion to
+    the time of every call edge.
+
+Only the thread that starts a phase is profiled.
+
+.. versionadded:: 2.3.0
+"""
+
+import cProfile
+import collections
+import contextlib
+import logging
+import os
+import pstats
+
+from .utils import __
+
+#: Maximum depth of the collapsed stacks.
+MAX_DEPTH = 64
+
+
+def _label(func):
+    """Get the frame label of a function of :py:class:`pstats.Stats`."""
+    filename, line, name = func
+    if filename == '~':
+        label = name
+    else:
+        label = "{}:{}:{}".format(os.path.basename(filename), line, name)
+    return label.replace(';', ',').replace(' ', '_')
+
+
+def collapsed_stacks(stats):
+    """Get the collapsed stacks of a profile.
+
+    Args:
+        stats (pstats.Stats): The profile stats.
+
+    Returns:
+        dict: The microseconds spent in every stack, a string of frames
+        separated by ``;`` from the root.
+
+    """
+    # pylint: disable=invalid-name
+    callees = collections.defaultdict(list)
+    roots = []
+    for func, (_, _, _, ct, callers) in stats.stats.items():
+        if not callers:
+            roots.append(func)
+        for caller, edge in callers.items():
+            callees[caller].append((func, edge[3]))
+    stacks = collections.Counter()
+
+    def walk(func, seconds, stack):
+        _, _, tt, ct, _ = stats.stats[func]
+        if ct <= 0 or seconds <= 0:
+            return
+        stack = stack + (func,)
+        scale = min(seconds / ct, 1.0)
+        name = ';'.join(_label(f) for f in stack)
+        stacks[name] += int(tt * scale * 1e6)
+        if len(stack) >= MAX_DEPTH:
+            return
+        for callee, edge_seconds in callees.get(func, []):
+            if callee not in stack:
+                walk(callee, edge_seconds * scale, stack)
+
+    for root in roots:
+        walk(root, stats.stats[root][3], ())
+    return {name: micros for name, micros in stacks.items() if micros > 0}
+
+
+class Profiler(object):
+    """Profile the phases of a run.
+
+    Attributes:
+        directory (str): Where the profiles are written.
+        profiles (dict): The :py:class:`cProfile.Profile` of every phase.
+
+    """
+
+    #: Logger object used to show debug info.
+    logger = logging.getLogger(__name__)
+
+    def __init__(self, directory):
+        """Initialize a Profiler object."""
+        self.directory = directory
+        self.profiles = collections.OrderedDict()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Profile a phase, adding it to the previous profiles of `name`.
+
+        If another profiler is running (e.g. a phase in another thread) the
+        phase is not profiled.
+        """
+        profile = self.profiles.setdefault(name, cProfile.Profile())
+        try:
+            profile.enable()
+        except ValueError as exc:
+            self.logger.warning(__("Phase {} not profiled: {}".format(
+                name, exc)))
+            yield
+            return
+        try:
+            yield
+        finally:
+            profile.disable()
+
+    def dump(self):
+        """Write the ``.pstats`` and ``.collapsed`` file of every phase.
+
+        Returns:
+            list(str): The files written.
+
+        """
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        files = []
+        for name, profile in self.profiles.items():
+            try:
+                stats = pstats.Stats(profile)
+            except TypeError:  # Nothing has been profiled
+                continue
+            filename = os.path.join(self.directory, name + ".pstats")
+            stats.dump_stats(filename)
+            files.append(filename)
+            filename = os.path.join(self.directory, name + ".collapsed")
+            with open(filename, 'w') as fhandle:
+                for stack, micros in sorted(collapsed_stacks(stats).items()):
+                    fhandle.write("{} {}\n".format(stack, micros))
+            files.append(filename)
+        self.logger.info(__("Profiles written to {}".format(self.directory)))
+        return files
@@ -0,0 +1,451 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  recording.py
+#  This file is part of isbg.
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+
+"""Record and replay the IMAP and scanner sessions of isbg.
+
+A :py:class:`Recorder` writes every call to the IMAP connections (made by
+:py:class:`isbg.imaputils.IsbgImap4`) and to the scanner (``spamc``,
+``spamassassin`` or ``spamd``) as JSON lines, with its result, the seconds
+it has taken and the bytes transferred::
+
+    {"type": "session", "version": 1, "bodies": "redact", "start": 1.7e9}
+    {"type": "imap", "conn": 0, "op": "uid", "args": ["SEARCH", ...],
+     "result": ..., "seconds": 0.012, "sent": 31, "received": 64}
+    {"type": "scan", "op": "test", "key": "9f1c...", "result": ...,
+     "seconds": 0.84}
+
+The message bodies can be kept, hashed (only their SHA-256 and their size
+are recorded) or redacted (the headers but those of MIME and SpamAssassin,
+and the text but the MIME boundaries, are replaced by ``x`` keeping their
+size), see :py:data:`BODIES`. The passwords are never recorded.
+
+A :py:class:`Replayer` serves a recording instead of connecting to the IMAP
+server and running the scanner, waiting the seconds recorded, so a slow run
+can be reproduced, and profiled, with the same traffic pattern:
+
+* The IMAP connections are served in the order they were opened, and the
+  calls of every connection in the order they were recorded.
+* The scans are served by the SHA-256 of the message scanned, or in the
+  order they were recorded if it was not recorded (e.g. with its body
+  hashed or redacted).
+
+.. versionadded:: 2.3.0
+"""
+
+import collections
+import hashlib
+import imaplib
+import json
+import logging
+import re
+import threading
+import time
+
+from subprocess import TimeoutExpired
+
+import isbg
+
+from .utils import __
+
+#: Ways to record the message bodies.
+BODIES = ('keep', 'hash', 'redact')
+#: Version of the recordings.
+VERSION = 1
+
+#: Headers kept by the redaction, with those starting with ``X-Spam-``.
+KEPT_HEADERS = ('content-type', 'content-transfer-encoding',
+                'content-disposition', 'mime-version')
+
+_ERRORS = collections.OrderedDict([
+    ('abort', imaplib.IMAP4.abort), ('readonly', imaplib.IMAP4.readonly),
+    ('error', imaplib.IMAP4.error), ('timeout', TimeoutExpired),
+    ('oserror', OSError)])
+
+_HEADER_RE = re.compile(br'^([!-9;-~]+):')
+_PART_HEADER_RE = re.compile(br'^content-[\w-]+:', re.IGNORECASE)
+
+
+def _mask(data):
+    """Replace all but the white spaces by ``x``."""
+    return re.sub(br'\S', b'x', data)
+
+
+def redact(data):
+    """Redact a message keeping its size, its lines and its MIME structure.
+
+    Args:
+        data (bytes): The message.
+
+    Returns:
+        bytes: The message redacted.
+
+    """
+    lines = data.splitlines(True)
+    redacted, in_head, keep = ([], True, False)
+    for line in lines:
+        if in_head:
+            if not line.strip():
+                in_head = False
+                redacted.append(line)
+                continue
+            match = _HEADER_RE.match(line)
+            if match is not None:
+                name = match.group(1).decode('ascii').lower()
+                keep = name in KEPT_HEADERS or name.startswith('x-spam-')
+                redacted.append(line if keep else match.group(0) + _mask(
+                    line[match.end():]))
+                continue
+            redacted.append(line if keep else _mask(line))
+        elif line.startswith(b'--') or _PART_HEADER_RE.match(line):
+            redacted.append(line)
+        else:
+            redacted.append(_mask(line))
+    return b"".join(redacted)
+
+
+def _body(data, bodies):
+    """Encode to JSON a message body, as required by `bodies`."""
+    if isinstance(data, str):
+        data = data.encode('latin-1', errors='replace')
+    if bodies == 'hash':
+        return {'sha256': hashlib.sha256(data).hexdigest(), 'size': len(data)}
+    if bodies == 'redact':
+        data = redact(data)
+    return {'bytes': data.decode('latin-1')}
+
+
+def encode(value, bodies='keep', literal=False):
+    """Encode to JSON an argument or a result of imaplib or of the scanner.
+
+    Args:
+        value: The value, with ``bytes``, ``str``, numbers, ``None``, and
+            lists or tuples of them.
+        bodies (str): How the message bodies are recorded, see
+            :py:data:`BODIES`.
+        literal (bool): If `value` is a message body (e.g. the second item of
+            the tuples of a FETCH response).
+
+    Returns:
+        The value with the ``bytes`` and the tuples as dicts.
+
+    """
+    if literal and isinstance(value, (bytes, str)):
+        return _body(value, bodies)
+    if isinstance(value, bytes):
+        return {'bytes': value.decode('latin-1')}
+    if isinstance(value, tuple):
+        return {'tuple': [encode(item, bodies, literal=num == 1 and
+                                 len(value) == 2 and
+                                 isinstance(item, bytes))
+                          for num, item in enumerate(value)]}
+    if isinstance(value, list):
+        return [encode(item, bodies) for item in value]
+    return value
+
+
+def decode(value):
+    """Decode a value encoded with :py:func:`encode`.
+
+    The hashed bodies are decoded to as many ``x`` as their size.
+    """
+    if isinstance(value, list):
+        return [decode(item) for item in value]
+    if isinstance(value, dict):
+        if 'tuple' in value:
+            return tuple(decode(item) for item in value['tuple'])
+        if 'sha256' in value:
+            return b"x" * value['size']
+        return value['bytes'].encode('latin-1')
+    return value
+
+
+def _error(exc):
+    """Get the name of the type of an exception, see :py:func:`_raise`."""
+    for name, error in _ERRORS.items():
+        if isinstance(exc, error):
+            return name
+    return 'error'
+
+
+def _raise(record):
+    """Raise the exception recorded."""
+    name, message = record['error']
+    if name == 'timeout':
+        raise TimeoutExpired(message, record.get('timeout'))
+    raise _ERRORS[name](message)
+
+
+def digest(mail):
+    """Get the key of the scans of a message, its SHA-256."""
+    return hashlib.sha256(isbg.imaputils.mail_content(mail)).hexdigest()
+
+
+class Recorder(object):
+    """Record the IMAP and scanner sessions as JSON lines.
+
+    Attributes:
+        stream (file): Where the recording is written.
+        bodies (str): How the message bodies are recorded, see
+            :py:data:`BODIES`.
+
+    """
+
+    def __init__(self, stream, bodies='keep'):
+        """Initialize a Recorder object."""
+        if bodies not in BODIES:
+            raise ValueError("bodies must be one of {}".format(BODIES))
+        self.stream, self.bodies = (stream, bodies)
+        self._lock = threading.Lock()
+        self._conns = 0
+        self._write({'type': 'session', 'version': VERSION,
+                     'bodies': bodies, 'start': time.time()})
+
+    @classmethod
+    def open(cls, filename, bodies='keep'):
+        """Create a recorder that writes to `filename`."""
+        return cls(open(filename, 'w'), bodies)
+
+    def close(self):
+        """Close the stream."""
+        self.stream.close()
+
+    def _write(self, record):
+        line = json.dumps(record, sort_keys=True) + "\n"
+        with self._lock:
+            self.stream.write(line)
+            self.stream.flush()
+
+    def connect(self, factory, owner):
+        """Open an IMAP connection recording its calls.
+
+        Args:
+            factory (callable): Opens the :py:class:`imaplib.IMAP4`
+                connection.
+            owner (isbg.imaputils.IsbgImap4): Counts the bytes transferred,
+                in its `sent` and `received`.
+
+        Returns:
+            RecordingTransport: The connection.
+
+        """
+        imap = factory()
+        with self._lock:
+            conn, self._conns = (self._conns, self._conns + 1)
+        return RecordingTransport(imap, self, conn, owner)
+
+    def record(self, record, result=None, exc=None):
+        """Write a call, with its result or its exception."""
+        if exc is not None:
+            record['error'] = [_error(exc), str(exc)]
+            if isinstance(exc, TimeoutExpired):
+                record['error'][1], record['timeout'] = (exc.cmd, exc.timeout)
+        else:
+            record['result'] = result
+        self._write(record)
+
+    def scan(self, op, func, mail, *args, **kwargs):
+        """Call the scanner recording its result.
+
+        Args:
+            op (str): The call: ``test``, ``learn`` or ``tell``.
+            func (callable): The scanner, called with `mail`, `args` and
+                `kwargs`.
+            mail (email.message.Message): The message.
+
+        Returns:
+            The result of `func`.
+
+        """
+        record = {'type': 'scan', 'op': op, 'key': digest(mail)}
+        start = time.monotonic()
+        try:
+            result = func(mail, *args, **kwargs)
+        except (TimeoutExpired, OSError) as exc:
+            record['seconds'] = time.monotonic() - start
+            self.record(record, exc=exc)
+            raise
+        record['seconds'] = time.monotonic() - start
+        self.record(record, [encode(item, self.bodies,
+                                    literal=isinstance(item, bytes))
+                             for item in result])
+        return result
+
+
+class RecordingTransport(object):
+    """An :py:class:`imaplib.IMAP4` connection that records its calls."""
+
+    def __init__(self, imap, recorder, conn, owner):
+        """Initialize a RecordingTransport object."""
+        self._imap, self._recorder = (imap, recorder)
+        self._conn, self._owner = (conn, owner)
+
+    def __getattr__(self, name):
+        """Get an attribute of the connection, recording its calls."""
+        attr = getattr(self._imap, name)
+        if not callable(attr):
+            return attr
+
+        def call(*args):
+            recorded = list(args)
+            if name == 'login':
+                recorded[1:] = ['xxxxxxxx']
+            recorded = [encode(arg, self._recorder.bodies,
+                               literal=name == 'append' and num == 3)
+                        for num, arg in enumerate(recorded)]
+            record = {'type': 'imap', 'conn': self._conn, 'op': name,
+                      'args': recorded}
+            sent, received = (self._owner.sent, self._owner.received)
+            start = time.monotonic()
+            try:
+                result = attr(*args)
+            except Exception as exc:
+                record.update(seconds=time.monotonic() - start,
+                              sent=self._owner.sent - sent,
+                              received=self._owner.received - received)
+                self._recorder.record(record, exc=exc)
+                raise
+            record.update(seconds=time.monotonic() - start,
+                          sent=self._owner.sent - sent,
+                          received=self._owner.received - received)
+            self._recorder.record(record, encode(result,
+                                                 self._recorder.bodies))
+            return result
+        return call
+
+
+class Replayer(object):
+    """Serve a recording of :py:class:`Recorder`.
+
+    Attributes:
+        filename (str): The recording.
+        speed (float): How faster than recorded the calls are served, ``0``
+            to not wait.
+
+    """
+
+    #: Logger object used to show debug info.
+    logger = logging.getLogger(__name__)
+
+    def __init__(self, records, speed=1.0, filename=None):
+        """Initialize a Replayer object.
+
+        Args:
+            records (list(dict)): The records of the recording.
+
+        """
+        self.filename, self.speed = (filename, speed)
+        self._lock = threading.Lock()
+        self._imap = collections.OrderedDict()
+        self._scans = collections.defaultdict(list)
+        for record in records:
+            if record.get('type') == 'imap':
+                self._imap.setdefault(record['conn'], collections.deque(
+                    )).append(record)
+            elif record.get('type') == 'scan':
+                self._scans[record['op']].append(record)
+
+    @classmethod
+    def open(cls, filename, speed=1.0):
+        """Create a replayer of the recording `filename`."""
+        with open(filename) as fhandle:
+            records = [json.loads(line) for line in fhandle if line.strip()]
+        if not records or records[0].get('type') != 'session':
+            raise isbg.ISBGError(isbg.__exitcodes__['error'],
+                                 "{} is not a recording".format(filename))
+        return cls(records, speed, filename)
+
+    def close(self):
+        """Do nothing, like :py:meth:`Recorder.close`."""
+
+    def wait(self, record):
+        """Wait the seconds recorded of a call."""
+        if self.speed > 0 and record.get('seconds'):
+            time.sleep(record['seconds'] / self.speed)
+
+    def diverged(self, message):
+        """Get the error raised when the run diverges from the recording."""
+        return isbg.ISBGError(isbg.__exitcodes__['error'],
+                              "Replay of {} diverged: {}".format(
+                                  self.filename, message))
+
+    def connect(self, factory, owner):
+        """Serve the next IMAP connection recorded.
+
+        Args:
+            factory (callable): Not called, see :py:meth:`Recorder.connect`.
+            owner (isbg.imaputils.IsbgImap4): It gets the bytes recorded.
+
+        Returns:
+            ReplayTransport: The connection.
+
+        """
+        with self._lock:
+            if not self._imap:
+                raise self.diverged("no more IMAP connections recorded")
+            _, records = self._imap.popitem(last=False)
+        return ReplayTransport(self, records, owner)
+
+    def scan(self, op, func, mail, *args, **kwargs):
+        """Serve a scan recorded, without calling `func`.
+
+        See :py:meth:`Recorder.scan`.
+        """
+        key = digest(mail)
+        with self._lock:
+            scans = self._scans[op]
+            if not scans:
+                raise self.diverged("no more '{}' scans recorded".format(op))
+            found = [num for num, record in enumerate(scans)
+                     if record.get('key') == key]
+            record = scans.pop(found[0] if found else 0)
+        if not found:
+            self.logger.debug(__("Scan of {} served in order", key))
+        self.wait(record)
+        if 'error' in record:
+            _raise(record)
+        return tuple(decode(record['result']))
+
+
+class ReplayTransport(object):
+    """An :py:class:`imaplib.IMAP4` connection served from a recording."""
+
+    def __init__(self, replayer, records, owner):
+        """Initialize a ReplayTransport object."""
+        self._replayer, self._records = (replayer, records)
+        self._owner = owner
+
+    def __getattr__(self, name):
+        """Get a call that serves the next record of the connection."""
+        def call(*args):
+            if not self._records:
+                raise self._replayer.diverged(
+                    "{} called, nothing else recorded".format(name))
+            if self._records[0]['op'] != name:
+                raise self._replayer.diverged("{} called, {} recorded".format(
+                    name, self._records[0]['op']))
+            record = self._records.popleft()
+            self._replayer.wait(record)
+            self._owner.sent += record.get('sent', 0)
+            self._owner.received += record.get('received', 0)
+            if 'error' in record:
+                _raise(record)
+            return decode(record['result'])
+        return call
@@ -26,13 +26,21 @@
 
 import isbg
 
+from isbg import fuzzy
 from isbg import imaputils
 from isbg import sa_unwrap
+from isbg import timing
 from isbg import utils
 
 from .utils import __
 
+import collections
+import functools
+import imaplib
 import logging
+import time
+
+from subprocess import TimeoutExpired
 
 #: Used to detect already our successfully (un)learned messages.
 __spamc_msg__ = {
@@ -40,14 +48,35 @@ __spamc_msg__ = {
     'success': 'Message successfully un/learned'
 }
 
+#: Keyword of the messages scanned, with ``--keywords``.
+KEYWORD_SCANNED = '$IsbgScanned'
+#: Keywords of the messages learned, with ``--keywords``.
+KEYWORD_LEARNED = {'spam': '$IsbgLearnedSpam', 'ham': '$IsbgLearnedHam'}
+#: Keyword with the score (rounded down, from 0 to 20) of the messages
+#: scanned, with ``--keywords``.
+KEYWORD_SCORE = '$IsbgScore{}'
+#: Messages to learn fetched, at most, meanwhile the inbox is scanned.
+MAX_PREFETCH = 50
+
+
+def score_keyword(score):
+    """Get the keyword of a score returned by :py:func:`test_mail`."""
+    try:
+        points = int(float(score.split('/')[0]))
+    except ValueError:
+        return None
+    return KEYWORD_SCORE.format(max(0, min(points, 20)))
+
 
-def learn_mail(mail, learn_type):
+def learn_mail(mail, learn_type, timeout=None):
     """Process a email and try to learn or unlearn it.
 
     Args:
         mail (email.message.Message): email to learn.
         learn_type (str): ```spam``` to learn spam, ```ham``` to learn
             nonspam or ```forget```.
+        timeout (float): Seconds to wait for ``spamc``. ``None`` to wait
+            forever.
     Returns:
         int, int: It returns a pair of `int`
 
@@ -60,6 +89,10 @@ def learn_mail(mail, learn_type):
         The second integer:
             It's the original exit code from ``spamc``
 
+    Raises:
+        subprocess.TimeoutExpired: If ``spamc`` has not ended in `timeout`
+            seconds. It has been killed.
+
     Notes:
         See `Exit Codes` section of the man page of ``spamc`` for more
         information about other exit codes.
@@ -69,9 +102,11 @@ def learn_mail(mail, learn_type):
     orig_code = None
     proc = utils.popen(["spamc", "--learntype=" + learn_type])
     try:
-        out = proc.communicate(imaputils.mail_content(mail))
+        out = utils.communicate(proc, imaputils.mail_content(mail), timeout)
         code = int(proc.returncode)
         orig_code = code
+    except TimeoutExpired:
+        raise
     except Exception:  # pylint: disable=broad-except
         code = -9999
 
@@ -87,8 +122,14 @@ def learn_mail(mail, learn_type):
     return code, orig_code
 
 
-def test_mail(mail, spamc=False, cmd=False):
-    """Test a email with spamassassin."""
+def test_mail(mail, spamc=False, cmd=False, timeout=None):
+    """Test a email with spamassassin.
+
+    Raises:
+        subprocess.TimeoutExpired: If the command has not ended in `timeout`
+            seconds. It has been killed.
+
+    """
     score = "0/0\n"
     orig_code = None
     spamassassin_result = None
@@ -105,11 +146,14 @@ def test_mail(mail, spamc=False, cmd=False):
     proc = utils.popen(satest)
 
     try:
-        spamassassin_result = proc.communicate(imaputils.mail_content(mail))[0]
+        spamassassin_result = utils.communicate(
+            proc, imaputils.mail_content(mail), timeout)[0]
         returncode = proc.returncode
         proc.stdin.close()
         score = utils.score_from_mail(spamassassin_result.decode(errors='ignore'))
 
+    except TimeoutExpired:
+        raise
     except Exception:  # pylint: disable=broad-except
         score = "-9999"
 
@@ -125,6 +169,11 @@ class Sa_Learn(object):
         self.learned = 0         #: Number of messages learned.
         self.uids = []           #: The list of ``uids``.
         self.newpastuids = []    #: The new past ``uids``.
+        self.deferred = []       #: ``uids`` left for the next run.
+        self.keys = {}           #: The message key of every ``uid`` fetched.
+        self.errors = 0          #: Number of errors or timeouts learning.
+        self.timings = timing.Timings()  #: The time spent by every phase.
+        self.outliers = timing.Outliers()  #: The slowest messages.
 
 
 class Sa_Process(object):
@@ -135,8 +184,47 @@ class Sa_Process(object):
         self.nummsg = 0          #: Number of processed messages.
         self.numspam = 0         #: Number of spams found.
         self.spamdeleted = 0     #: Number of deleted spam.
+        self.numfuzzy = 0        #: Number of spams found by fingerprint.
+        self.errors = 0          #: Number of errors or timeouts scanning.
         self.uids = []           #: The list of ``uids``.
         self.newpastuids = []    #: The new past ``uids``.
+        self.deferred = []       #: ``uids`` left for the next run.
+        self.expired = False     #: If the run deadline has been reached.
+        self.keys = {}           #: The message key of every ``uid`` fetched.
+        self.pending = 0         #: ``uids`` not taken due to `partialrun`.
+        self.cursor = None       #: Where the backlog walk has stopped.
+        self.seconds = 0.0       #: Seconds spent processing.
+        self.timings = timing.Timings()  #: The time spent by every phase.
+        self.outliers = timing.Outliers()  #: The slowest messages.
+        #: Number of scans and seconds spent by every tier of a tiered scan.
+        self.tiers = {'local': [0, 0.0], 'full': [0, 0.0]}
+
+    def add(self, other):
+        """Add the results of other `Sa_Process`, e.g. of another batch.
+
+        The counters and the lists of ``uids`` are added, `newpastuids`,
+        `pending` and the size of `outliers` are taken from `other`, and
+        `expired` is set if it's set in `other`.
+        """
+        self.nummsg += other.nummsg
+        self.numspam += other.numspam
+        self.spamdeleted += other.spamdeleted
+        self.numfuzzy += other.numfuzzy
+        self.errors += other.errors
+        self.uids.extend(other.uids)
+        self.deferred.extend(other.deferred)
+        self.keys.update(other.keys)
+        self.newpastuids = other.newpastuids
+        self.pending = other.pending
+        self.cursor = other.cursor
+        self.expired = self.expired or other.expired
+        self.seconds += other.seconds
+        self.timings.merge(other.timings)
+        self.outliers.size = other.outliers.size
+        self.outliers.merge(other.outliers)
+        for tier in self.tiers:
+            self.tiers[tier][0] += other.tiers[tier][0]
+            self.tiers[tier][1] += other.tiers[tier][1]
 
 
 class SpamAssassin(object):
@@ -159,7 +247,10 @@ class SpamAssassin(object):
     _kwargs = ['imap', 'spamc', 'logger', 'partialrun', 'dryrun',
                'learnthendestroy', 'gmail', 'learnthenflag', 'learnunflagged',
                'learnflagged', 'deletehigherthan', 'imapsets', 'maxsize',
-               'noreport', 'spamflags', 'delete', 'expunge']
+               'noreport', 'spamflags', 'delete', 'expunge', 'fuzzy',
+               'tierband', 'localspamd', 'scantimeout', 'deadline',
+               'backlogshare', 'actions', 'keywords', 'gate', 'learner',
+               'eventlog', 'slowest', 'session', 'stop']
 
     def __init__(self, **kwargs):
         """Initialize a SpamAssassin object."""
@@ -183,6 +274,11 @@ class SpamAssassin(object):
 
         # what we use to set flags on the original spam in imapbox
         self.spamflagscmd = "+FLAGS.SILENT"
+        self._uidvalidities = {}
+        # The timings and the slowest messages of the learning or the
+        # processing running
+        self._timings = timing.Timings()
+        self._outliers = timing.Outliers(0)
 
     @property
     def cmd_save(self):
@@ -198,6 +294,21 @@ class SpamAssassin(object):
             return ["spamc", "-E", "--max-size=268435450"]
         return ["spamassassin", "--exit-code"]
 
+    @property
+    def cmd_test_local(self):
+        """Is the command to use to test a message only with local tests.
+
+        With ``spamc`` it uses the ``spamd`` instance at `localspamd`
+        (``host[:port]``), that should be started with ``--local``.
+        """
+        if self.spamc:  # pylint: disable=no-member
+            host, _, port = self.localspamd.partition(':')
+            cmd = self.cmd_test + ["-d", host]
+            if port:
+                cmd += ["-p", port]
+            return cmd
+        return self.cmd_test + ["--local"]
+
     @classmethod
     def create_from_isbg(cls, sbg):
         """Return a instance with the required args from ```ISBG```.
@@ -215,6 +326,246 @@ class SpamAssassin(object):
             kw[k] = getattr(sbg, k)
         return SpamAssassin(**kw)
 
+    def _uidvalidity(self, mailbox):
+        """Get the uidvalidity of a mailbox, asking it only once."""
+        if mailbox not in self._uidvalidities:
+            self._uidvalidities[mailbox] = self.imap.get_uidvalidity(mailbox)
+        return self._uidvalidities[mailbox]
+
+    def _intend(self, op, mailbox, uid=None, args=(), message=None,
+                msgid=None):
+        """Record a IMAP action in the `actions` journal before doing it.
+
+        The journal is synced, so the action is on disk before it's done.
+
+        Returns:
+            int: The action id, or ``None`` if there is no journal.
+
+        """
+        if self.actions is None or self.dryrun:
+            return None
+        uidvalidity = None
+        if uid is not None:
+            uidvalidity = self._uidvalidity(mailbox)
+        action_id = self.actions.intend(op, mailbox, uid, args, message,
+                                        msgid, uidvalidity)
+        self.actions.sync()
+        return action_id
+
+    def _run_action(self, action_id, op, mailbox, uid=None, args=(),
+                    message=None):
+        """Do a IMAP action and mark it as done in the `actions` journal.
+
+        The ``uid`` actions are done in the mailbox selected.
+        """
+        with self._timings.span(op, nbytes=len(message or '')):
+            if op == 'append':
+                res = self.imap.append(mailbox, None, None, message)
+            elif op == 'expunge':
+                res = self.imap.expunge()
+            else:
+                res = self.imap.uid(op.upper(), uid, *args)
+        if action_id is not None:
+            self.actions.done(action_id)
+        return res
+
+    def _imap_action(self, op, mailbox, uid=None, args=(), message=None,
+                     msgid=None):
+        """Record a IMAP action in the journal, do it and mark it as done."""
+        action_id = self._intend(op, mailbox, uid, args, message, msgid)
+        try:
+            return self._run_action(action_id, op, mailbox, uid, args,
+                                    message)
+        except (imaplib.IMAP4.abort, OSError):
+            # The connection has been lost and reopened (see
+            # isbg.imaputils.reconnect), the copy or the append is repeated
+            # if the message has not reached its mailbox.
+            if op not in ('append', 'copy') or msgid is None:
+                raise
+            selected = self.imap.selected
+            done = self._exists(mailbox if op == 'append' else args[0], msgid)
+            if selected is not None:
+                self.imap.select(*selected)
+            if not done:
+                return self._run_action(action_id, op, mailbox, uid, args,
+                                        message)
+            if action_id is not None:
+                self.actions.done(action_id)
+            return ('OK', [])
+
+    def _snapshot(self):
+        """Get the seconds and bytes of every phase, to time a message.
+
+        Returns:
+            dict: The seconds and bytes, ``None`` if there is no `eventlog`
+            and the slowest messages are not kept.
+
+        """
+        if self.eventlog is None and not self._outliers.size:
+            return None
+        return {name: (phase.seconds, phase.nbytes)
+                for name, phase in self._timings.phases.items()}
+
+    def _elapsed(self, before):
+        """Get the bytes fetched and the time spent since a snapshot.
+
+        Args:
+            before (dict): The :py:meth:`_snapshot`.
+
+        Returns:
+            dict: The ``size`` fetched, and the ``fetch_ms``, ``unwrap_ms``,
+            ``scan_ms`` (scanning or learning) and ``action_ms``.
+
+        """
+        def millis(*names):
+            return round(sum(self._timings.phases[name].seconds -
+                             before.get(name, (0.0, 0))[0] for name in names
+                             if name in self._timings.phases) * 1000, 3)
+        fetch = self._timings.phases.get('fetch')
+        return {'size': (fetch.nbytes - before.get('fetch', (0.0, 0))[1]
+                         if fetch is not None else 0),
+                'fetch_ms': millis('fetch'), 'unwrap_ms': millis('unwrap'),
+                'scan_ms': millis('scan', 'fuzzy', 'learn'),
+                'action_ms': millis('append', 'copy', 'store')}
+
+    def _message_event(self, folder, uid, before, action, score=None,
+                       mail=None, **fields):
+        """Write a ``message`` event to the `eventlog`.
+
+        The message is also added to the slowest ones of every phase where
+        it's one of them (see :py:class:`isbg.timing.Outliers`).
+
+        Args:
+            folder (str): The folder of the message.
+            uid (str): Its ``uid``.
+            before (dict): The :py:meth:`_snapshot` before the message.
+            action (str): What has been done with it.
+            score (str): Its score.
+            mail (email.message.Message): The message, to get its number of
+                MIME parts and its content type.
+            **fields: Other fields of the event, they replace those of
+                :py:meth:`_elapsed`.
+
+        """
+        if before is None:
+            return
+        record = {'folder': folder, 'uid': int(uid)}
+        record.update(self._elapsed(before))
+        record.update(score=score.strip() if score is not None else None,
+                      action=action)
+        record.update(fields)
+
+        phases = [name for name in ('fetch', 'unwrap', 'scan', 'action')
+                  if self._outliers.qualifies(name, record[name + '_ms'])]
+        if phases:
+            outlier = {key: record[key] for key in
+                       ('folder', 'uid', 'size', 'score', 'action')}
+            if mail is not None:
+                outlier.update(parts=sum(1 for _ in mail.walk()),
+                               content_type=mail.get_content_type())
+            for name in phases:
+                self._outliers.add(name, record[name + '_ms'], outlier)
+
+        if self.eventlog is not None:
+            self.eventlog.emit('message', **record)
+
+    def _store_keywords(self, mailbox, keywords):
+        """Add keywords to messages of the mailbox selected.
+
+        If the mailbox does not allow them, nothing is stored and
+        `keywords` is unset: the messages processed are only in the track
+        files.
+
+        Args:
+            mailbox (str): The mailbox selected (read-write).
+            keywords (dict): The ``uids`` of every keywords string.
+
+        """
+        if not self.imap.allows_keywords(*' '.join(keywords).split()):
+            self.logger.warning(__(
+                "{} does not allow IMAP keywords, only the track files are "
+                "used".format(mailbox)))
+            self.keywords = False
+            return
+        for kws, uids in sorted(keywords.items()):
+            if uids:
+                self._imap_action('store', mailbox,
+                                  ','.join(str(u) for u in
+                                           sorted(uids, key=int)),
+                                  ("+FLAGS", "({})".format(kws)))
+
+    def _exists(self, mailbox, msgid):
+        """Check if a message with `msgid` is in the mailbox."""
+        self.imap.select(mailbox, True)
+        _, uids = self.imap.uid("SEARCH", None, "HEADER", "Message-ID",
+                                '"{}"'.format(msgid.replace('"', '')))
+        return bool(uids and uids[0] and uids[0].split())
+
+    def replay_actions(self):
+        """Do the actions left pending by a previous run.
+
+        Copies and appends of messages that are already in the target mailbox
+        are not repeated, neither the actions on ``uids`` from a mailbox whose
+        *uidvalidity* has changed.
+
+        Returns:
+            int: The number of actions done.
+
+        """
+        if self.actions is None or self.dryrun:
+            return 0
+        replayed = 0
+        for action in self.actions.pending():
+            op, mailbox, uid = action['op'], action['mailbox'], action['uid']
+            target = mailbox if op == 'append' else (action['args'] or [''])[0]
+            if uid is not None and \
+                    action['uidvalidity'] != self._uidvalidity(mailbox):
+                self.logger.warning(__(
+                    "Not replaying {} of {}: {} has changed".format(
+                        op, uid, mailbox)))
+            elif op in ['append', 'copy'] and action['msgid'] and \
+                    self._exists(target, action['msgid']):
+                self.logger.debug(__("{} of {} was already done".format(
+                    op, action['msgid'])))
+            else:
+                self.logger.debug(__("Replaying {} {} {}".format(
+                    op, mailbox, uid)))
+                if op != 'append':
+                    self.imap.select(mailbox)
+                self._run_action(None, op, mailbox, uid, action['args'],
+                                 action.get('message'))
+                replayed += 1
+            self.actions.done(action['id'])
+        return replayed
+
+    def _spam_actions(self, uid, delete):
+        """Record the actions to do at the end with a spam of the inbox.
+
+        Args:
+            uid (str): The spam ``uid``.
+            delete (bool): If it's to be deleted due to its high score.
+        Returns:
+            list(tuple): The ``(action_id, op, uid, args)`` of the actions.
+
+        """
+        actions = []
+        if delete:
+            if self.gmail is True:
+                actions.append(('copy', ("[Gmail]/Trash",)))
+            else:
+                actions.append(('store', (self.spamflagscmd, "(\\Deleted)")))
+        else:
+            # Only set message flags if there are any
+            if self.spamflags:  # len(self.smpamflgs) > 0
+                actions.append(('store', (self.spamflagscmd,
+                                          imaputils.imapflags(
+                                              self.spamflags))))
+            # If its gmail, and --delete was passed, we actually copy!
+            if self.delete and self.gmail:
+                actions.append(('copy', ("[Gmail]/Trash",)))
+        return [(self._intend(op, self.imapsets.inbox, uid, args), op, uid,
+                 args) for op, args in actions]
+
     @staticmethod
     def get_formated_uids(uids, origpastuids, partialrun):
         """Get the uids formated.
@@ -233,16 +584,142 @@ class SpamAssassin(object):
 
         """
         uids = sorted(uids[0].split(), key=int, reverse=True)
-        newpastuids = [u for u in origpastuids if str(u) in uids]
-        uids = [u for u in uids if int(u) not in newpastuids]
+        found = set(uids)
+        newpastuids = [u for u in origpastuids if str(u) in found]
+        past = set(newpastuids)
+        uids = [u for u in uids if int(u) not in past]
         # Take only X elements if partialrun is enabled
         if partialrun:
             uids = uids[:int(partialrun)]
         return uids, newpastuids
 
-    def learn(self, folder, learn_type, move_to, origpastuids):
+    def timeout(self):
+        """Get the seconds that a scan can last, or ``None`` if no limit.
+
+        It's the lower of `scantimeout` and the time left to `deadline` (a
+        :py:func:`time.monotonic` value).
+        """
+        timeout = self.scantimeout
+        if self.deadline is not None:
+            left = max(self.deadline - time.monotonic(), 0)
+            if timeout is None or left < timeout:
+                timeout = left
+        return timeout
+
+    def _expired(self):
+        """Check if the `deadline` of the run has been reached.
+
+        It's also reached when `stop` is set (e.g. the lease of the account
+        has been lost).
+        """
+        if self.stop is not None and self.stop.is_set():
+            return True
+        return self.deadline is not None and time.monotonic() >= self.deadline
+
+    def _wait_gate(self):
+        """Wait until the `gate` is set or the `deadline` is reached."""
+        while self.gate is not None and not self.gate.wait(1.0) and \
+                not self._expired():
+            pass
+
+    def _in_greyzone(self, score):
+        """Check if a score is near enough the threshold to rescan it."""
+        try:
+            value, required = [float(x) for x in score.split('/')]
+        except ValueError:
+            return True
+        return abs(value - required) <= self.tierband
+
+    def _scan(self, op, func, mail, *args, **kwargs):
+        """Call the scanner `func` with a mail.
+
+        The call is recorded, or replayed, by the `session` if it's not None
+        (see :py:meth:`isbg.recording.Recorder.scan`).
+        """
+        if self.session is None:  # pylint: disable=no-member
+            return func(mail, *args, **kwargs)
+        return self.session.scan(  # pylint: disable=no-member
+            op, func, mail, *args, **kwargs)
+
+    def _test_mail(self, mail, sa_proc):
+        """Test a mail, with a local only scan first if `tierband` is set.
+
+        Messages whose local score is within `tierband` points of the
+        threshold, or that can't be scanned locally, are escalated to a full
+        scan (with the network tests).
+        """
+        if self.tierband is None:
+            return self._scan('test', test_mail, mail, cmd=self.cmd_test,
+                              timeout=self.timeout())
+
+        start = time.monotonic()
+        score, code, spamassassin_result = self._scan(
+            'test', test_mail, mail, cmd=self.cmd_test_local,
+            timeout=self.timeout())
+        sa_proc.tiers['local'][0] += 1
+        sa_proc.tiers['local'][1] += time.monotonic() - start
+        if not self._in_greyzone(score):
+            return score, code, spamassassin_result
+
+        self.logger.debug(__("Local score {} escalated to full scan".format(
+            score.strip())))
+        start = time.monotonic()
+        score, code, spamassassin_result = self._scan(
+            'test', test_mail, mail, cmd=self.cmd_test,
+            timeout=self.timeout())
+        sa_proc.tiers['full'][0] += 1
+        sa_proc.tiers['full'][1] += time.monotonic() - start
+        return score, code, spamassassin_result
+
+    @staticmethod
+    def schedule_uids(uids, origpastuids, partialrun, backlogshare=0.0,
+                      cursor=None):
+        """Get the ``uids`` to process, including some from the backlog.
+
+        The newest ``uids`` are taken first, but a `backlogshare` fraction of
+        `partialrun` is reserved to the older ones: they are taken walking
+        down from `cursor`, and when the oldest one is reached the walk
+        starts again from the newest of the backlog. This way, the old
+        messages are processed even with a sustained inflow of new ones.
+
+        Args:
+            uids (list(str)): The new ``uids``. It's formated as:
+                ```['1 2 3 4']```
+            origpastuids (list(int)): The original past ``uids``.
+            partialrun (int): If not none the number of ``uids`` to return.
+            backlogshare (float): The fraction of `partialrun` used for the
+                backlog.
+            cursor (int): The ``uid`` where the previous walk stopped. If
+                ``None``, the walk starts from the newest of the backlog.
+        Returns:
+            tuple: The ``uids`` to process, the new past ``uids`` (see
+            :py:meth:`get_formated_uids`), the new cursor and the number of
+            ``uids`` left in the backlog.
+
+        """
+        uids, newpastuids = SpamAssassin.get_formated_uids(
+            uids, origpastuids, None)
+        if not partialrun or len(uids) <= int(partialrun):
+            return uids, newpastuids, None, 0
+
+        numold = 0
+        if backlogshare:
+            numold = max(int(int(partialrun) * backlogshare), 1)
+        numnew = int(partialrun) - numold
+        backlog = uids[numnew:]
+        older = [u for u in backlog if cursor is None or int(u) < cursor]
+        older = (older or backlog)[:numold]
+        if older:
+            cursor = int(older[-1])
+        return (uids[:numnew] + older, newpastuids, cursor,
+                len(uids) - numnew - len(older))
+
+    def learn(self, folder, learn_type, move_to, origpastuids, journal=None):
         """Learn the spams (and if requested deleted or move them).
 
+        If the `gate` is not None, the messages are fetched at once but they
+        are learned once it's set.
+
         Args:
             folder (str): The IMAP folder.
             leart_type (str): ```spam``` to learn spam, ```ham``` to learn
@@ -250,6 +727,8 @@ class SpamAssassin(object):
             move_to (str): If not ```None```, the imap folder where the emails
                 will be moved.
             origpastuids (list(int)): ``uids`` to not process.
+            journal (isbg.journal.UidJournal): If not ``None``, where the
+                ``uids`` learned are recorded as soon as they are learned.
         Returns:
             Sa_Learn:
                 It contains the information about the result of the process.
@@ -265,6 +744,10 @@ class SpamAssassin(object):
 
         """
         sa_learning = Sa_Learn()
+        if self.slowest is not None:
+            sa_learning.outliers.size = self.slowest
+        self._timings = sa_learning.timings
+        self._outliers = sa_learning.outliers
 
         # Sanity checks:
         if learn_type not in ['spam', 'ham']:
@@ -277,85 +760,203 @@ class SpamAssassin(object):
 
         self.imap.select(folder)
         if self.learnunflagged:
-            _, uids = self.imap.uid("SEARCH", None, "UNFLAGGED")
+            criteria = ["UNFLAGGED"]
         elif self.learnflagged:
-            _, uids = self.imap.uid("SEARCH", None, "(FLAGGED)")
+            criteria = ["(FLAGGED)"]
         else:
-            _, uids = self.imap.uid("SEARCH", None, "ALL")
+            criteria = ["ALL"]
+        if self.keywords:
+            # The messages learned are marked in the server
+            criteria = ["UNKEYWORD", KEYWORD_LEARNED[learn_type]] + \
+                [c for c in criteria if c != "ALL"]
+        with self._timings.span('search'):
+            _, uids = self.imap.uid("SEARCH", None, *criteria)
 
         uids, sa_learning.newpastuids = SpamAssassin.get_formated_uids(
             uids, origpastuids, self.partialrun)
 
         sa_learning.tolearn = len(uids)
+        # Messages fetched and not learned yet, and those sent to `learner`
+        ready, sent = (collections.deque(), collections.deque())
 
-        for uid in uids:
-            mail = imaputils.get_message(self.imap, uid, logger=self.logger)
+        for idx, uid in enumerate(uids):
+            if self._expired():
+                sa_learning.deferred.extend(
+                    [item[0] for item in ready] + uids[idx:])
+                self.logger.warning(__(
+                    "Run deadline reached, {} mails left to learn".format(
+                        len(ready) + len(uids) - idx)))
+                ready.clear()
+                break
+
+            before = self._snapshot()
+            mail = imaputils.get_message(self.imap, uid, logger=self.logger,
+                                         timings=self._timings)
+            sa_learning.keys[int(uid)] = imaputils.message_key(mail)
 
             # Unwrap spamassassin reports
-            unwrapped = sa_unwrap.unwrap(mail)
-            if unwrapped is not None:
+            with self._timings.span('unwrap'):
+                unwrapped = sa_unwrap.unwrap(mail)
+            if unwrapped is not None and \
+                    self.logger.isEnabledFor(logging.DEBUG):
                 self.logger.debug(__("{} Unwrapped: {}".format(
                     uid, utils.shorten(imaputils.mail_content(
                         unwrapped[0]), 140))))
 
             if unwrapped is not None and unwrapped:  # len(unwrapped)>0
                 mail = unwrapped[0]
+            # The fetch of the message, for the eventlog
+            fetched = {}
+            if before is not None:
+                fetched = {key: val for key, val in
+                           self._elapsed(before).items()
+                           if key in ('size', 'fetch_ms', 'unwrap_ms')}
 
             if self.dryrun:
                 self.logger.warning("Skipped learning due to dryrun!")
                 continue
-            else:
-                code, code_orig = learn_mail(mail, learn_type)
 
-            if code == -9999:  # error processing email, try next.
-                self.logger.exception(__(
-                    'spamc error for mail {}'.format(uid)))
-                self.logger.debug(repr(imaputils.mail_content(mail)))
-                continue
+            ready.append((uid, mail, fetched))
+            # The fetch goes on while the inbox is scanned, up to
+            # MAX_PREFETCH messages, the learning gives way to the scan
+            if len(ready) >= MAX_PREFETCH:
+                self._wait_gate()
+            if self.gate is None or self.gate.is_set():
+                self._learn_ready(folder, learn_type, move_to, ready, sent,
+                                  sa_learning, journal)
+
+        if ready:
+            self._wait_gate()
+        if ready and self._expired():
+            sa_learning.deferred.extend(item[0] for item in ready)
+            self.logger.warning(__(
+                "Run deadline reached, {} mails left to learn".format(
+                    len(ready))))
+            ready.clear()
+        self._learn_ready(folder, learn_type, move_to, ready, sent,
+                          sa_learning, journal)
+
+        for uid, mail, fetched, future in sent:
+            self._learned(folder, learn_type, move_to, uid, mail,
+                          future.result, sa_learning, journal, fetched)
+
+        if self.keywords and sa_learning.uids and not self.dryrun:
+            self.imap.select(folder)
+            self._store_keywords(folder, {KEYWORD_LEARNED[learn_type]:
+                                          sa_learning.uids})
+
+        return sa_learning
+
+    def _learn_ready(self, folder, learn_type, move_to, ready, sent,
+                     sa_learning, journal):
+        """Learn the messages fetched by :py:meth:`learn`.
 
-            if code in [69, 74]:
-                raise isbg.ISBGError(
-                    isbg.__exitcodes__['flags'],
-                    "spamassassin is misconfigured (use --allow-tell)")
+        `ready` holds the ``(uid, mail, fetched)`` of the messages fetched
+        and not learned yet, it's emptied. With a `learner` the messages are
+        sent to it, and added with their future to `sent`, keeping some of
+        them sent. The other args are those of :py:meth:`learn`.
+        """
+        while ready:
+            uid, mail, fetched = ready.popleft()
+            if self.learner is None:
+                self._learned(folder, learn_type, move_to, uid, mail,
+                              functools.partial(self._scan, 'learn',
+                                                learn_mail, mail, learn_type,
+                                                self.timeout()),
+                              sa_learning, journal, fetched)
+                continue
 
-            if code == 5:  # learned.
-                sa_learning.learned += 1
-                self.logger.debug(__(
-                    "Learned {} (spamc return code {})".format(uid,
-                                                               code_orig)))
+            # Learn in bulk, keeping some messages sent
+            sent.append((uid, mail, fetched, self.learner.submit(
+                mail, learn_type, self.timeout())))
+            if len(sent) >= 2 * self.learner.workers:
+                uid, mail, fetched, future = sent.popleft()
+                self._learned(folder, learn_type, move_to, uid, mail,
+                              future.result, sa_learning, journal, fetched)
+
+    def _learned(self, folder, learn_type, move_to, uid, mail, learn,
+                 sa_learning, journal, fetched=None):
+        """Get the result of learning a message and do the actions required.
+
+        `learn` is a function that returns the codes of :py:func:`learn_mail`,
+        `fetched` are the fields of the `eventlog` measured when the message
+        was fetched, and the other args are those of :py:meth:`learn`.
+        """
+        before = self._snapshot()
+        fetched = fetched or {}
+        try:
+            with self._timings.span('learn'):
+                code, code_orig = learn()
+        except TimeoutExpired:
+            self.logger.warning(__(
+                "spamc timeout learning mail {}, deferred".format(uid)))
+            sa_learning.deferred.append(uid)
+            sa_learning.errors += 1
+            self._message_event(folder, uid, before, 'deferred', mail=mail,
+                                learn_type=learn_type, **fetched)
+            return
+
+        if code == -9999:  # error processing email, try next.
+            sa_learning.errors += 1
+            self.logger.exception(__(
+                'spamc error for mail {}'.format(uid)))
+            if self.logger.isEnabledFor(logging.DEBUG):
+                self.logger.debug(repr(imaputils.mail_content(mail)))
+            self._message_event(folder, uid, before, 'error', mail=mail,
+                                learn_type=learn_type, **fetched)
+            return
 
-            elif code == 6:  # already learned.
-                self.logger.debug(__(
-                    "Already learned {} (spamc return code {})".format(
-                        uid, code_orig)))
+        if code in [69, 74]:
+            raise isbg.ISBGError(
+                isbg.__exitcodes__['flags'],
+                "spamassassin is misconfigured (use --allow-tell)")
 
-            elif code == 98:  # too big.
-                self.logger.warning(__(
-                    "{} is too big (spamc return code {})".format(
-                        uid, code_orig)))
+        if code == 5:  # learned.
+            sa_learning.learned += 1
+            self.logger.debug(__(
+                "Learned {} (spamc return code {})".format(uid,
+                                                           code_orig)))
 
-            else:
-                raise isbg.ISBGError(-1, ("{}: Unknown return code {} from " +
-                                          "spamc").format(uid, code_orig))
-
-            sa_learning.uids.append(int(uid))
-
-            if not self.dryrun:
-                if self.learnthendestroy:
-                    if self.gmail:
-                        self.imap.uid("COPY", uid, "[Gmail]/Trash")
-                    else:
-                        self.imap.uid("STORE", uid, self.spamflagscmd,
-                                      "(\\Deleted)")
-                elif move_to is not None:
-                    self.imap.uid("COPY", uid, move_to)
-                elif self.learnthenflag:
-                    self.imap.uid("STORE", uid, self.spamflagscmd,
-                                  "(\\Flagged)")
+        elif code == 6:  # already learned.
+            self.logger.debug(__(
+                "Already learned {} (spamc return code {})".format(
+                    uid, code_orig)))
 
-        return sa_learning
+        elif code == 98:  # too big.
+            self.logger.warning(__(
+                "{} is too big (spamc return code {})".format(
+                    uid, code_orig)))
 
-    def _process_spam(self, uid, score, mail, spamdeletelist, code, spamassassin_result):
+        else:
+            raise isbg.ISBGError(-1, ("{}: Unknown return code {} from " +
+                                      "spamc").format(uid, code_orig))
+
+        sa_learning.uids.append(int(uid))
+        if journal is not None:
+            journal.append(uid)
+
+        if not self.dryrun:
+            msgid = mail.get('Message-ID')
+            if self.learnthendestroy:
+                if self.gmail:
+                    self._imap_action('copy', folder, uid,
+                                      ("[Gmail]/Trash",), msgid=msgid)
+                else:
+                    self._imap_action('store', folder, uid,
+                                      (self.spamflagscmd, "(\\Deleted)"))
+            elif move_to is not None:
+                self._imap_action('copy', folder, uid, (move_to,),
+                                  msgid=msgid)
+            elif self.learnthenflag:
+                self._imap_action('store', folder, uid,
+                                  (self.spamflagscmd, "(\\Flagged)"))
+        self._message_event(folder, uid, before,
+                            {5: 'learned', 6: 'already learned'}.get(
+                                code, 'too big'), mail=mail,
+                            learn_type=learn_type, **fetched)
+
+    def _process_spam(self, uid, score, mail, spamdeletelist, code,
+                      spamassassin_result, report=True):
         self.logger.debug(__("{} is spam".format(uid)))
 
         if (self.deletehigherthan is not None and
@@ -363,8 +964,9 @@ class SpamAssassin(object):
             spamdeletelist.append(uid)
             return False
 
-        # do we want to include the spam report
-        if self.noreport is False:
+        # do we want to include the spam report (there is no report when the
+        # mail has not been scanned)
+        if self.noreport is False and report:
             if self.dryrun:
                 self.logger.info("Skipping report because of --dryrun")
             else:
@@ -378,8 +980,9 @@ class SpamAssassin(object):
                         spamdeletelist.remove(uid)
                     return False
 
-                res = self.imap.append(self.imapsets.spaminbox, None, None,
-                                       new_mail)
+                res = self._imap_action('append', self.imapsets.spaminbox,
+                                        message=new_mail,
+                                        msgid=mail.get('Message-ID'))
                 # The above will fail on some IMAP servers for various
                 # reasons. We print out what happened and continue
                 # processing
@@ -400,25 +1003,63 @@ class SpamAssassin(object):
                                  " of --dryrun")
             else:
                 # just copy it as is
-                self.imap.uid("COPY", uid, self.imapsets.spaminbox)
+                self._imap_action('copy', self.imapsets.inbox, uid,
+                                  (self.imapsets.spaminbox,),
+                                  msgid=mail.get('Message-ID'))
 
         return True
 
-    def process_inbox(self, origpastuids):
-        """Run spamassassin in the folder for spam."""
+    def process_inbox(self, origpastuids, cursor=None, journal=None,
+                      skip=None):
+        """Run spamassassin in the folder for spam.
+
+        Args:
+            origpastuids (list(int)): ``uids`` to not process.
+            cursor (int): Where the backlog walk stopped, see
+                :py:meth:`schedule_uids`.
+            journal (isbg.journal.UidJournal): If not ``None``, where the
+                ``uids`` are recorded as soon as they are processed.
+            skip (set(str)): If not ``None``, ``uids`` to not process that
+                are not stored as processed, e.g. those deferred by a
+                previous batch.
+        Returns:
+            Sa_Process: It contains the information about the result of the
+            process.
+
+        """
         sa_proc = Sa_Process()
+        if self.slowest is not None:
+            sa_proc.outliers.size = self.slowest
+        self._timings = sa_proc.timings
+        self._outliers = sa_proc.outliers
+        start = time.monotonic()
 
         spamlist = []
         spamdeletelist = []
+        # Actions to do at the end with the spam found
+        spamactions = []
+        # Keywords to add at the end to the messages scanned
+        keywords = {}
 
         # select inbox
         self.imap.select(self.imapsets.inbox, 1)
 
         # get the uids of all mails with a size less then the maxsize
-        _, uids = self.imap.uid("SEARCH", None, "SMALLER", str(self.maxsize))
+        with self._timings.span('search'):
+            if self.keywords:
+                # The messages scanned are marked in the server
+                _, uids = self.imap.uid("SEARCH", None, "UNKEYWORD",
+                                        KEYWORD_SCANNED, "SMALLER",
+                                        str(self.maxsize))
+            else:
+                _, uids = self.imap.uid("SEARCH", None, "SMALLER",
+                                        str(self.maxsize))
+        if skip:
+            uids = [" ".join(u for u in uids[0].split() if u not in skip)]
 
-        uids, sa_proc.newpastuids = SpamAssassin.get_formated_uids(
-            uids, origpastuids, self.partialrun)
+        uids, sa_proc.newpastuids, sa_proc.cursor, sa_proc.pending = \
+            SpamAssassin.schedule_uids(uids, origpastuids, self.partialrun,
+                                       self.backlogshare, cursor)
 
         self.logger.debug(__('Got {} mails to check'.format(len(uids))))
 
@@ -429,15 +1070,35 @@ class SpamAssassin(object):
 
         # Main loop that iterates over each new uid we haven't seen before
         for uid in uids:
+            if self._expired():
+                sa_proc.expired = True
+                sa_proc.deferred.extend(uids[uids.index(uid):])
+                self.logger.warning(__(
+                    "Run deadline reached, {} mails left to check".format(
+                        len(uids) - uids.index(uid))))
+                break
+
+            before = self._snapshot()
+
             # Retrieve the entire message
             mail = imaputils.get_message(self.imap, uid, sa_proc.uids,
-                                         logger=self.logger)
+                                         logger=self.logger,
+                                         timings=self._timings)
+            sa_proc.keys[int(uid)] = imaputils.message_key(mail)
 
             # Unwrap spamassassin reports
-            unwrapped = sa_unwrap.unwrap(mail)
+            with self._timings.span('unwrap'):
+                unwrapped = sa_unwrap.unwrap(mail)
             if unwrapped is not None and unwrapped:  # len(unwrapped) > 0
                 mail = unwrapped[0]
 
+            # Search it in the known spam campaigns
+            fingerprint, fuzzy_score = None, None
+            if self.fuzzy is not None:
+                with self._timings.span('fuzzy'):
+                    fingerprint = fuzzy.simhash(mail)
+                    fuzzy_score = self.fuzzy.match(fingerprint)
+
             # Feed it to SpamAssassin in test mode
             if self.dryrun:
                 if processednum > processmax:
@@ -453,33 +1114,81 @@ class SpamAssassin(object):
                 processednum = processednum + 1
                 spamassassin_result = None  # since dryrun doesn't run
                                             # test_mail()
+            elif fuzzy_score is not None:
+                self.logger.debug(__("{} matches a known spam campaign", uid))
+                score, code, spamassassin_result = fuzzy_score, 1, None
+                sa_proc.numfuzzy += 1
             else:
-                score, code, spamassassin_result = test_mail(mail, cmd=self.cmd_test)
+                try:
+                    with self._timings.span('scan'):
+                        score, code, spamassassin_result = self._test_mail(
+                            mail, sa_proc)
+                except TimeoutExpired:
+                    # Not marked as seen, it will be checked again next run
+                    self.logger.warning(__(
+                        "{} timeout for mail {}, deferred".format(
+                            self.cmd_test, uid)))
+                    sa_proc.uids.remove(int(uid))
+                    sa_proc.deferred.append(uid)
+                    sa_proc.errors += 1
+                    self._message_event(self.imapsets.inbox, uid, before,
+                                        'deferred', mail=mail)
+                    continue
                 if score == "-9999":
+                    sa_proc.errors += 1
                     self.logger.exception(__(
                         '{} error for mail {}'.format(self.cmd_test, uid)))
-                    self.logger.debug(repr(mail))
+                    self.logger.debug(__("{!r}", mail))
+                    self._message_event(self.imapsets.inbox, uid, before,
+                                        'error', mail=mail)
                     uids.remove(uid)
+                    if journal is not None:
+                        journal.append(uid)
+                    keywords.setdefault(KEYWORD_SCANNED, []).append(uid)
                     continue
+                if code != 0 and self.fuzzy is not None:
+                    self.fuzzy.add(fingerprint, score)
 
             if score == "0/0\n":
                 raise isbg.ISBGError(isbg.__exitcodes__['spamc'],
                                      "spamc -> spamd error - aborting")
 
-            self.logger.debug(__(
-                "Score for uid {}: {}".format(uid, score.strip())))
+            self.logger.debug(__("Score for uid {}: {}", uid, score.strip()))
+            keywords.setdefault(' '.join(
+                filter(None, [KEYWORD_SCANNED, score_keyword(score)])),
+                []).append(uid)
 
             if code != 0:
                 # Message is spam, delete it or move it to spaminbox
                 # (optionally with report)
-                if not self._process_spam(uid, score, mail, spamdeletelist, code, spamassassin_result):
+                if not self._process_spam(uid, score, mail, spamdeletelist,
+                                          code, spamassassin_result,
+                                          report=fuzzy_score is None):
+                    if uid in spamdeletelist:
+                        spamactions.extend(self._spam_actions(uid, True))
+                    if journal is not None:
+                        journal.append(uid)
+                    self._message_event(
+                        self.imapsets.inbox, uid, before,
+                        'delete' if uid in spamdeletelist else 'error',
+                        score, mail)
                     continue
                 spamlist.append(uid)
+                spamactions.extend(self._spam_actions(uid, False))
+
+            if journal is not None:
+                journal.append(uid)
+            self._message_event(self.imapsets.inbox, uid, before,
+                                'spam' if code != 0 else 'ham', score, mail)
 
-        sa_proc.nummsg = len(uids)
+        sa_proc.nummsg = len(uids) - len(sa_proc.deferred)
         sa_proc.spamdeleted = len(spamdeletelist)
         sa_proc.numspam = len(spamlist) + sa_proc.spamdeleted
 
+        if self.keywords and keywords and not self.dryrun:
+            self.imap.select(self.imapsets.inbox)
+            self._store_keywords(self.imapsets.inbox, keywords)
+
         # If we found any spams, now go and mark the original messages
         if sa_proc.numspam or sa_proc.spamdeleted:
             if self.dryrun:
@@ -487,24 +1196,15 @@ class SpamAssassin(object):
                                  ' because of --dryrun')
             else:
                 self.imap.select(self.imapsets.inbox)
-                # Only set message flags if there are any
-                if self.spamflags:  # len(self.smpamflgs) > 0
-                    for uid in spamlist:
-                        self.imap.uid("STORE", uid, self.spamflagscmd,
-                                      imaputils.imapflags(self.spamflags))
-                        sa_proc.newpastuids.append(uid)
-                # If its gmail, and --delete was passed, we actually copy!
-                if self.delete and self.gmail:
-                    for uid in spamlist:
-                        self.imap.uid("COPY", uid, "[Gmail]/Trash")
-                # Set deleted flag for spam with high score
-                for uid in spamdeletelist:
-                    if self.gmail is True:
-                        self.imap.uid("COPY", uid, "[Gmail]/Trash")
-                    else:
-                        self.imap.uid("STORE", uid, self.spamflagscmd,
-                                      "(\\Deleted)")
+                # Flag, copy to the gmail trash or set deleted flag (for spam
+                # with high score) as recorded when they were found
+                for action_id, op, uid, args in spamactions:
+                    self._run_action(action_id, op, self.imapsets.inbox, uid,
+                                     args)
+                if self.spamflags:
+                    sa_proc.newpastuids.extend(spamlist)
                 if self.expunge:
-                    self.imap.expunge()
+                    self._imap_action('expunge', self.imapsets.inbox)
 
+        sa_proc.seconds = time.monotonic() - start
         return sa_proc
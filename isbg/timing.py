@@ -0,0 +1,270 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  timing.py
+#  This file is part of isbg.
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+
+"""Timing of the phases of a run of isbg - IMAP Spam Begone.
+
+A :py:class:`Timings` object adds the time, the number of messages and the
+bytes of every phase (``search``, ``fetch``, ``unwrap``, ``scan``...),
+measured with :py:func:`time.monotonic` spans:
+
+    >>> timings = Timings()
+    >>> with timings.span('fetch') as phase:
+    ...     phase.nbytes += len(body)
+
+The latencies are added to a :py:class:`Histogram` to get their
+percentiles without keeping every sample, and :py:class:`Outliers` keeps
+the slowest messages of every phase.
+
+.. versionadded:: 2.3.0
+"""
+
+import bisect
+import collections
+import contextlib
+import heapq
+import itertools
+import time
+
+#: Upper bounds, in seconds, of the buckets of a :py:class:`Histogram`.
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+class Phase(object):
+    """The time, messages and bytes of a phase."""
+
+    __slots__ = ('seconds', 'count', 'nbytes', 'latency')
+
+    def __init__(self):
+        """Initialize a Phase object."""
+        self.seconds = 0.0       #: Seconds spent in the phase.
+        self.count = 0           #: Number of messages (or calls).
+        self.nbytes = 0          #: Bytes transferred or processed.
+        self.latency = Histogram()  #: The seconds of every span.
+
+    @property
+    def rate(self):
+        """Messages per second of the phase."""
+        return self.count / self.seconds if self.seconds > 0 else 0.0
+
+    def add(self, other):
+        """Add the values of another phase."""
+        self.seconds += other.seconds
+        self.count += other.count
+        self.nbytes += other.nbytes
+        self.latency.add(other.latency)
+
+
+class Timings(object):
+    """The phases of a run, in the order they have started."""
+
+    def __init__(self):
+        """Initialize a Timings object."""
+        #: The :py:class:`Phase` of every phase name.
+        self.phases = collections.OrderedDict()
+
+    def phase(self, name):
+        """Get the :py:class:`Phase` `name`, creating it if it's needed."""
+        if name not in self.phases:
+            self.phases[name] = Phase()
+        return self.phases[name]
+
+    @contextlib.contextmanager
+    def span(self, name, count=1, nbytes=0):
+        """Measure the time spent in a phase.
+
+        Args:
+            name (str): The phase.
+            count (int): Number of messages processed in the span.
+            nbytes (int): Bytes processed in the span. The bytes known only
+                at the end can be added to the phase yielded.
+
+        Yields:
+            Phase: The phase.
+
+        """
+        phase = self.phase(name)
+        start = time.monotonic()
+        try:
+            yield phase
+        finally:
+            seconds = time.monotonic() - start
+            phase.seconds += seconds
+            phase.latency.observe(seconds)
+            phase.count += count
+            phase.nbytes += nbytes
+
+    def add(self, name, seconds, count=1, nbytes=0):
+        """Add the time, messages and bytes measured elsewhere to a phase."""
+        phase = self.phase(name)
+        phase.seconds += seconds
+        phase.latency.observe(seconds)
+        phase.count += count
+        phase.nbytes += nbytes
+
+    def merge(self, other, prefix=''):
+        """Add the phases of other `Timings`, naming them with `prefix`."""
+        for name, phase in other.phases.items():
+            self.phase(prefix + name).add(phase)
+
+    def report(self):
+        """Get a line of text for every phase.
+
+        Returns:
+            list(str): The lines.
+
+        """
+        return ["{}: {:.3f}s, {} msgs, {} bytes, {:.1f} msgs/s".format(
+            name, phase.seconds, phase.count, phase.nbytes, phase.rate)
+            for name, phase in self.phases.items()]
+
+
+class Histogram(object):
+    """Values (e.g. latencies) counted in buckets.
+
+    Attributes:
+        buckets (tuple(float)): The upper bounds of the buckets, sorted. The
+            values greater than the last one are in an extra bucket.
+        counts (list(int)): Number of values of every bucket.
+        count (int): Number of values.
+        sum (float): Sum of the values.
+        max (float): The greatest value.
+
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        """Initialize a Histogram object."""
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count, self.sum, self.max = (0, 0.0, 0.0)
+
+    def observe(self, value):
+        """Add a value."""
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def add(self, other):
+        """Add the values of other histogram with the same buckets."""
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.count += other.count
+        self.sum += other.sum
+        self.max = max(self.max, other.max)
+
+    def quantile(self, fraction):
+        """Estimate a quantile.
+
+        Args:
+            fraction (float): The quantile, e.g. ``0.99`` for the 99th
+                percentile.
+
+        Returns:
+            float: The upper bound of the bucket where the quantile is (but
+            not more than `max`), ``0.0`` if there are no values.
+
+        """
+        if not self.count:
+            return 0.0
+        rank = fraction * self.count
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            if cumulative >= rank:
+                return min(bound, self.max)
+        return self.max
+
+
+class Outliers(object):
+    """The slowest messages of every phase.
+
+    Every phase keeps a heap of its `size` slowest messages, so the memory
+    used does not grow with the messages processed.
+
+    Attributes:
+        size (int): Number of messages kept of every phase, ``0`` to keep
+            none.
+        phases (dict): The heap of every phase, with tuples of the
+            milliseconds, a sequence number and the message record.
+
+    """
+
+    def __init__(self, size=5):
+        """Initialize a Outliers object."""
+        self.size = size
+        self.phases = collections.OrderedDict()
+        self._seq = itertools.count()
+
+    def qualifies(self, name, millis):
+        """Check if a message that took `millis` in a phase would be kept."""
+        if self.size <= 0 or millis <= 0:
+            return False
+        heap = self.phases.get(name)
+        return heap is None or len(heap) < self.size or millis > heap[0][0]
+
+    def add(self, name, millis, record):
+        """Add a message to a phase, if it's one of the slowest.
+
+        Args:
+            name (str): The phase.
+            millis (float): The milliseconds spent by the message in it.
+            record (dict): What is known of the message (``uid``, ``size``,
+                ``parts``, ``content_type``...).
+
+        """
+        if not self.qualifies(name, millis):
+            return
+        heap = self.phases.setdefault(name, [])
+        item = (millis, next(self._seq), record)
+        if len(heap) < self.size:
+            heapq.heappush(heap, item)
+        else:
+            heapq.heapreplace(heap, item)
+
+    def slowest(self, name):
+        """Get the slowest messages of a phase.
+
+        Returns:
+            list(dict): The records of the messages, the slowest first, with
+            their milliseconds in ``ms``.
+
+        """
+        return [dict(record, ms=millis) for millis, _, record in
+                sorted(self.phases.get(name, []), key=lambda i: -i[0])]
+
+    def merge(self, other, prefix=''):
+        """Add the messages of other `Outliers`, naming them with `prefix`."""
+        for name, heap in other.phases.items():
+            for millis, _, record in heap:
+                self.add(prefix + name, millis, record)
+
+    def report(self):
+        """Get a line of text for every message kept.
+
+        Returns:
+            list(str): The lines.
+
+        """
+        return ["slowest {}: uid {} in {}, {:.1f}ms, {} bytes, {} parts, {}"
+                .format(name, rec.get('uid'), rec.get('folder'), rec['ms'],
+                        rec.get('size'), rec.get('parts'),
+                        rec.get('content_type'))
+                for name in self.phases for rec in self.slowest(name)]
@@ -28,7 +28,7 @@
 
 import os
 import re
-from subprocess import Popen, PIPE   # To call Popen
+from subprocess import Popen, PIPE, TimeoutExpired   # To call Popen
 
 try:
     # C implementation:
@@ -202,6 +202,52 @@ def popen(cmd):
     return Popen(cmd, stdin=PIPE, stdout=PIPE, close_fds=True)
 
 
+def communicate(proc, data, timeout=None):
+    """Send data to a process and wait for it, killing it on timeout.
+
+    Args:
+        proc (subprocess.Popen): The process.
+        data (bytes): The data to send to the process `stdin`.
+        timeout (float): Seconds to wait for the process. If ``None``, it
+            waits forever.
+    Returns:
+        tuple: The `stdout` and `stderr` data, as
+        :py:meth:`subprocess.Popen.communicate`.
+
+    Raises:
+        subprocess.TimeoutExpired: If the process has not ended in `timeout`
+            seconds. The process has been killed.
+
+    """
+    try:
+        return proc.communicate(data, timeout=timeout)
+    except TimeoutExpired:
+        proc.kill()
+        proc.communicate()
+        raise
+
+
+def pid_running(pid):
+    """Check if a process is running.
+
+    Args:
+        pid (int): The process id.
+    Returns:
+        bool: ``False`` if the process is not running. It's always ``True``
+        where it cannot be checked.
+
+    """
+    if os.name != 'posix':
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:  # e.g. it's running as another user
+        pass
+    return True
+
+
 def score_from_mail(mail):
     """
     Search the spam score from a mail as a string.
@@ -124,6 +124,38 @@ def test_parse_args():
     __main__.parse_args(sbg)
     assert sbg.maxsize == 12000
 
+    # Parse with bogus and ok fuzzydistance
+    del sys.argv[1:]
+    for op in ["--imaphost", "localhost", "--imapuser", "anonymous",
+               "--imappasswd", "none", "--dryrun", "--fuzzydistance", "11"]:
+        sys.argv.append(op)
+    sbg = isbg.ISBG()
+    with pytest.raises(isbg.ISBGError, match="between 0 and 10"):
+        __main__.parse_args(sbg)
+        pytest.fail("It should rise a between 0 and 10 ISBGError")
+
+    sys.argv[-1] = "3"
+    sbg = isbg.ISBG()
+    __main__.parse_args(sbg)
+    assert sbg.fuzzydistance == 3
+
+    # Parse with bogus and ok max-runtime
+    del sys.argv[1:]
+    for op in ["--imaphost", "localhost", "--imapuser", "anonymous",
+               "--imappasswd", "none", "--dryrun", "--max-runtime", "0"]:
+        sys.argv.append(op)
+    sbg = isbg.ISBG()
+    with pytest.raises(isbg.ISBGError, match="higher than 0"):
+        __main__.parse_args(sbg)
+        pytest.fail("It should rise a higher than 0 ISBGError")
+
+    sys.argv[-1] = "600"
+    sys.argv.extend(["--scantimeout", "30"])
+    sbg = isbg.ISBG()
+    __main__.parse_args(sbg)
+    assert sbg.maxruntime == 600.0
+    assert sbg.scantimeout == 30.0
+
     # Parse with bogus partialrun
     del sys.argv[1:]
     for op in ["--imaphost", "localhost", "--imapuser", "anonymous",
@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  test_bulklearn.py
+#  This file is part of isbg.
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+
+"""Test cases for bulklearn module."""
+
+import os
+import socketserver
+import sys
+import threading
+try:
+    import pytest
+except ImportError:
+    pass
+
+from subprocess import TimeoutExpired
+
+# We add the upper dir to the path
+sys.path.insert(0, os.path.abspath(os.path.join(
+    os.path.dirname(__file__), '..')))
+from isbg import bulklearn  # noqa: E402
+from isbg import isbg  # noqa: E402
+from isbg import spamproc  # noqa: E402
+from isbg.imaputils import new_message  # noqa: E402
+
+from unittest import mock  # noqa: E402
+
+
+class FakeSpamd(socketserver.ThreadingTCPServer):
+    """A spamd that learns every message once."""
+
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self):
+        """Listen in a free port of localhost."""
+        socketserver.ThreadingTCPServer.__init__(self, ('127.0.0.1', 0),
+                                                 FakeSpamdHandler)
+        self.learned = set()
+        self.requests = []
+        self.lock = threading.Lock()
+
+
+class FakeSpamdHandler(socketserver.StreamRequestHandler):
+    """Answer a TELL request."""
+
+    def handle(self):
+        """Learn the message if it has not been learned."""
+        request = self.rfile.read()
+        headers, _, body = request.partition(b"\r\n\r\n")
+        with self.server.lock:
+            self.server.requests.append(headers.decode())
+            if b"sleep" in body:
+                threading.Event().wait(1)
+                return
+            if body in self.server.learned:
+                self.wfile.write(b"SPAMD/1.1 0 EX_OK\r\n\r\n")
+            else:
+                self.server.learned.add(body)
+                self.wfile.write(b"SPAMD/1.1 0 EX_OK\r\nDidSet: local\r\n\r\n")
+
+
+@pytest.fixture
+def spamd():
+    """Start a fake spamd."""
+    server = FakeSpamd()
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def _mail(text):
+    return new_message(("Subject: test\r\n\r\n" + text).encode())
+
+
+class TestSpamdClient(object):
+    """Tests for SpamdClient."""
+
+    def test_tell(self, spamd):
+        """Test tell."""
+        client = bulklearn.SpamdClient(*spamd.server_address, user="me")
+        assert client.tell(_mail("spam"), "spam") == (5, 0)
+        assert client.tell(_mail("spam"), "spam") == (6, 0)
+        assert spamd.requests[0].startswith("TELL SPAMC/1.5\r\n")
+        assert "Message-class: spam\r\nSet: local\r\nUser: me\r\n" in \
+            spamd.requests[0]
+        client.tell(_mail("ham"), "forget")
+        assert "Remove: local" in spamd.requests[-1]
+
+        with pytest.raises(TimeoutExpired):
+            client.tell(_mail("sleep"), "spam", timeout=0.1)
+
+    def test_tell_errors(self, spamd):
+        """Test the errors of tell."""
+        port = spamd.server_address[1]
+        spamd.server_close()
+        assert bulklearn.SpamdClient('127.0.0.1', port).tell(
+            _mail("spam"), "spam") == (-9999, None)
+
+        with mock.patch.object(bulklearn.socket, "create_connection") as conn:
+            conn.return_value.__enter__.return_value.recv.side_effect = [
+                b"SPAMD/1.1 69 EX_NOPERM\r\n\r\n", b""]
+            assert bulklearn.SpamdClient().tell(_mail("spam"), "spam") == \
+                (69, 69)
+
+
+def test_bulk_learn(spamd):
+    """Test learning with a BulkLearner."""
+    learner = bulklearn.BulkLearner(
+        bulklearn.SpamdClient(*spamd.server_address), 3)
+    sbg = isbg.ISBG()
+    sa = spamproc.SpamAssassin.create_from_isbg(sbg)
+    sa.learner = learner
+    sa.imap = mock.Mock()
+    sa.imap.uid.side_effect = lambda cmd, *args: \
+        ("OK", [" ".join(str(u) for u in range(1, 11))]) \
+        if cmd == "SEARCH" else \
+        ("OK", [(b"1 (BODY[] {20}", b"Subject: foo\r\n\r\n" +
+                 args[0].encode())])
+    learned = sa.learn("Spam", "spam", None, [])
+    learner.close()
+    assert learned.learned == 10
+    assert sorted(learned.uids) == list(range(1, 11))
+    assert len(spamd.learned) == 10
+
+
+def test_sync_bayes():
+    """Test sync_bayes."""
+    with mock.patch.object(bulklearn.utils, "popen",
+                           side_effect=OSError("No sa-learn")):
+        assert bulklearn.sync_bayes() is None
+    with mock.patch.object(bulklearn.utils, "popen") as popen, \
+            mock.patch.object(bulklearn.utils, "communicate"):
+        popen.return_value.returncode = 0
+        assert bulklearn.sync_bayes(10) == 0
+        popen.assert_called_once_with(["sa-learn", "--sync"])
+        assert bulklearn.sync_bayes(10, spamd="localhost:1783") == 0
+        # The journal of a remote spamd is not synced
+        popen.reset_mock()
+        assert bulklearn.sync_bayes(10, spamd="spamd.example.com") is None
+        assert not popen.called
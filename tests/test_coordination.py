@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  test_coordination.py
+#  This file is part of isbg.
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+
+"""Test cases for coordination module."""
+
+import os
+import sqlite3
+import sys
+import threading
+import time
+try:
+    import pytest
+except ImportError:
+    pass
+
+# We add the upper dir to the path
+sys.path.insert(0, os.path.abspath(os.path.join(
+    os.path.dirname(__file__), '..')))
+from isbg import coordination  # noqa: E402
+from isbg import isbg  # noqa: E402
+from isbg import spamproc  # noqa: E402
+
+from unittest import mock  # noqa: E402
+
+
+class TestSqliteLeases(object):
+    """Tests for SqliteLeases."""
+
+    def test_leases(self, tmpdir):
+        """Test acquire, renew and release."""
+        dbname = str(tmpdir.join("leases"))
+        node1 = coordination.SqliteLeases(dbname, owner="node1")
+        node2 = coordination.SqliteLeases(dbname, owner="node2")
+        assert node1.holder("acc") is None
+        assert node1.acquire("acc")
+        assert node1.acquire("acc"), "It's already ours"
+        assert not node2.acquire("acc")
+        assert not node2.renew("acc")
+        assert node2.holder("acc") == "node1"
+        assert node1.renew("acc")
+        assert node2.acquire("other"), "Other accounts are free"
+
+        node1.release("acc")
+        assert node1.holder("acc") is None
+        assert node2.acquire("acc")
+
+    def test_takeover(self, tmpdir):
+        """Test the takeover of expired leases."""
+        dbname = str(tmpdir.join("leases"))
+        node1 = coordination.SqliteLeases(dbname, owner="node1", ttl=60)
+        node2 = coordination.SqliteLeases(dbname, owner="node2", ttl=60)
+        assert node1.acquire("acc")
+        with mock.patch.object(coordination.time, "time",
+                               return_value=time.time() + 61):
+            assert node2.holder("acc") is None
+            assert node2.acquire("acc")
+        assert not node1.renew("acc"), "The lease has been lost"
+        node1.release("acc")
+        assert node1.holder("acc") == "node2", "Only our leases are released"
+
+    def test_heartbeat(self, tmpdir):
+        """Test that the heartbeat renews the lease."""
+        leases = coordination.SqliteLeases(str(tmpdir.join("leases")),
+                                           ttl=0.3)
+        assert leases.acquire("acc")
+        leases.heartbeat("acc", 0.05)
+        time.sleep(0.6)
+        assert leases.holder("acc") == leases.owner
+        leases.release("acc")
+        assert leases.holder("acc") is None
+
+    def test_heartbeat_lost(self, tmpdir):
+        """Test that the heartbeat calls `lost` when the lease is lost."""
+        dbname = str(tmpdir.join("leases"))
+        node1 = coordination.SqliteLeases(dbname, owner="node1")
+        node2 = coordination.SqliteLeases(dbname, owner="node2")
+        assert node1.acquire("acc")
+        lost = threading.Event()
+        node1.heartbeat("acc", 0.05, lost=lost.set)
+        node1._remove("acc")
+        assert node2.acquire("acc")
+        assert lost.wait(5), "The lease has been taken by node2"
+
+        # It's also lost if it cannot be renewed for ttl seconds
+        node1.ttl, lost = (0.2, threading.Event())
+        assert node1.acquire("other")
+        with mock.patch.object(node1, "renew",
+                               side_effect=sqlite3.OperationalError):
+            node1.heartbeat("other", 0.05, lost=lost.set)
+            assert not lost.wait(0.1)
+            assert lost.wait(5)
+
+    def test_coordinator(self):
+        """Test the interface of the backends."""
+        coord = coordination.Coordinator(ttl=10)
+        assert str(os.getpid()) in coord.owner
+        with pytest.raises(NotImplementedError):
+            coord.acquire("acc")
+
+
+def test_isbg_lease(tmpdir):
+    """Test that ISBG claims the account lease."""
+    sbg = isbg.ISBG()
+    sbg.leases = coordination.SqliteLeases(str(tmpdir.join("leases")),
+                                           owner="other")
+    assert sbg.leases.acquire(sbg.imapsets.hash.hexdigest())
+    sbg.leases = None
+    sbg.leasefile = str(tmpdir.join("leases"))
+    with pytest.raises(isbg.ISBGError, match="processed by other"):
+        sbg._do_lease_or_raise()
+
+
+def test_isbg_lease_lost(tmpdir):
+    """Test that ISBG stops the run when the lease is lost."""
+    sbg = isbg.ISBG()
+    sbg.leasefile, sbg.leasettl = (str(tmpdir.join("leases")), 0.15)
+    sbg._do_lease_or_raise()
+    sa = spamproc.SpamAssassin.create_from_isbg(sbg)
+    assert not sa._expired()
+
+    key = sbg.imapsets.hash.hexdigest()
+    sbg.leases._remove(key)
+    other = coordination.SqliteLeases(sbg.leasefile, owner="other")
+    assert other.acquire(key)
+    assert sbg.stop.wait(5)
+    assert sa._expired(), "The run stops as if the deadline was reached"
+    with mock.patch.object(sbg, "do_imap_login"), \
+            mock.patch.object(sbg, "do_spamassassin"), \
+            mock.patch.object(sbg, "do_imap_logout"):
+        with pytest.raises(isbg.ISBGError, match="lease .* lost"):
+            sbg._do_run()
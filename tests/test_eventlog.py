@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  test_eventlog.py
+#  This file is part of isbg.
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+
+"""Test cases for eventlog module."""
+
+import io
+import json
+import os
+import sys
+try:
+    import pytest
+except ImportError:
+    pass
+
+# We add the upper dir to the path
+sys.path.insert(0, os.path.abspath(os.path.join(
+    os.path.dirname(__file__), '..')))
+from isbg import eventlog  # noqa: E402
+from isbg import isbg  # noqa: E402
+from isbg import spamproc  # noqa: E402
+
+from unittest import mock  # noqa: E402
+
+
+def _events(stream):
+    return [json.loads(line) for line in stream.getvalue().splitlines()]
+
+
+class TestEventLog(object):
+    """Tests for EventLog."""
+
+    def test_emit(self):
+        """Test emit."""
+        log = eventlog.EventLog(io.StringIO())
+        log.emit('message', uid=1, score="1.0/5.0")
+        log.emit('run', duration_ms=10.5)
+        events = _events(log.stream)
+        assert [e['event'] for e in events] == ['message', 'run']
+        assert events[0]['uid'] == 1
+        assert events[1]['ts'] > 0
+
+    def test_open(self, tmpdir):
+        """Test open and close."""
+        assert eventlog.EventLog.open('-').stream is sys.stderr
+        filename = str(tmpdir.join("events"))
+        for num in range(2):
+            log = eventlog.EventLog.open(filename)
+            log.emit('run', num=num)
+            log.close()
+        with open(filename) as fhandle:
+            assert [json.loads(line)['num'] for line in fhandle] == [0, 1]
+
+
+def test_message_events():
+    """Test the events of the messages scanned and learned."""
+    sbg = isbg.ISBG()
+    sbg.eventlog = eventlog.EventLog(io.StringIO())
+    sa = spamproc.SpamAssassin.create_from_isbg(sbg)
+    sa.imap = mock.Mock()
+    sa.imap.uid.side_effect = lambda cmd, *args: \
+        ("OK", ["1 2"]) if cmd == "SEARCH" else \
+        ("OK", [(b"1 (BODY[] {20}", b"Subject: foo\r\n\r\nbar")])
+    sa.imap.append.return_value = ("OK", [])
+    with mock.patch.object(sa, "_test_mail", side_effect=[
+            (u"1.5/5.0\n", 0, None), (u"9.0/5.0\n", 1, None)]):
+        sa.process_inbox([])
+    with mock.patch.object(spamproc, "learn_mail", return_value=(5, 5)):
+        sa.learn("Spam", "spam", None, [])
+
+    events = _events(sbg.eventlog.stream)
+    assert [(e['uid'], e['action'], e['score']) for e in events] == [
+        (2, 'ham', '1.5/5.0'), (1, 'spam', '9.0/5.0'),
+        (2, 'learned', None), (1, 'learned', None)]
+    for event in events:
+        assert event['folder'] == ('INBOX' if 'learn_type' not in event
+                                   else 'Spam')
+        assert event['size'] == 19
+        assert event['fetch_ms'] >= 0 and event['scan_ms'] >= 0
+
+
+def test_run_events():
+    """Test the events of the run."""
+    sbg = isbg.ISBG()
+    sbg.eventlog = eventlog.EventLog(io.StringIO())
+    proc = spamproc.Sa_Process()
+    proc.nummsg, proc.numspam = (10, 2)
+    proc.timings.add('scan', 0.5)
+    sbg.results = {'INBOX': proc, 'Spam': spamproc.Sa_Learn()}
+    sbg.timings.add('run', 3.0)
+    sbg._do_run_events()
+    events = _events(sbg.eventlog.stream)
+    assert [e['event'] for e in events] == ['folder', 'folder', 'run']
+    assert events[0]['spam'] == 2
+    assert events[0]['phases_ms'] == {'scan': 500.0}
+    assert events[1]['learned'] == 0
+    assert events[2]['duration_ms'] == 3000.0
+
+
+def test_run_events_error(tmpdir):
+    """Test that the run event is written if the run fails."""
+    sbg = isbg.ISBG()
+    sbg.imapsets.passwd, sbg.ignorelockfile = ('passwd', True)
+    sbg.trackfile = str(tmpdir.join("track"))
+    sbg.ledgerfile = str(tmpdir.join("ledger.jsonl"))
+    sbg.eventlogfile = str(tmpdir.join("events"))
+    sbg.profiledir = str(tmpdir.join("profiles"))
+    with mock.patch.object(sbg, '_do_run', side_effect=isbg.ISBGError(
+            isbg.__exitcodes__['imap'], "imap failed")):
+        with pytest.raises(isbg.ISBGError, match="imap failed"):
+            sbg.do_isbg()
+    assert (sbg.eventlog, sbg.profiler) == (None, None)
+    assert os.path.isdir(sbg.profiledir)
+    with open(sbg.eventlogfile) as fhandle:
+        event, = [json.loads(line) for line in fhandle]
+    assert event['event'] == 'run'
+    assert (event['exitcode'], event['error']) == (
+        isbg.__exitcodes__['imap'], "imap failed")
+    assert event['duration_ms'] >= 0
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  test_fuzzy.py
+#  This file is part of isbg.
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+
+"""Test cases for fuzzy module."""
+
+import os
+import sys
+
+try:
+    import pytest
+except ImportError:
+    pass
+
+# We add the upper dir to the path
+sys.path.insert(0, os.path.abspath(os.path.join(
+    os.path.dirname(__file__), '..')))
+from isbg import fuzzy  # noqa: E402
+from isbg.imaputils import new_message  # noqa: E402
+
+from unittest import mock  # noqa: E402
+
+CAMPAIGN = (u"Dear {}, your account at http://bank.example.com/{} has been "
+            u"suspended. To restore the access to your funds please confirm "
+            u"your identity before 48 hours using the secure link bellow. "
+            u"Reference number {}. Thanks for trusting our bank.")
+
+
+def test_normalize():
+    """Test normalize."""
+    assert fuzzy.normalize(u"<b>Win</b> 1000 $ at http://x.org/a?b=2 now") \
+        == [u'win', u'0', u'at', u'x', u'org', u'now']
+
+
+def test_simhash():
+    """Test simhash and distance."""
+    fp1 = fuzzy.simhash(CAMPAIGN.format("John", "a8f3", 1234))
+    fp2 = fuzzy.simhash(CAMPAIGN.format("Mary", "77b1", 9876))
+    assert fp1 == fuzzy.simhash(CAMPAIGN.format("John", "a8f3", 1234))
+    assert fuzzy.distance(fp1, fp2) <= 12, "Same campaign should be near"
+    other = fuzzy.simhash(u"The meeting of tomorrow has been moved to the "
+                          u"small room of the second floor, please bring "
+                          u"the reports of the last quarter with you.")
+    assert fuzzy.distance(fp1, other) > 20, "Unrelated text should be far"
+    assert fuzzy.simhash(u"Too short") is None
+    assert fuzzy.distance(0, 7) == 3
+
+
+def test_simhash_mail():
+    """Test simhash with a email."""
+    with open('tests/examples/spam.eml', 'rb') as fmail:
+        mail = new_message(fmail.read())
+    assert fuzzy.simhash(mail) == fuzzy.simhash(fuzzy.mail_text(mail))
+    assert fuzzy.simhash(mail) is not None
+
+
+class TestSpamFingerprints(object):
+    """Tests for SpamFingerprints."""
+
+    def test_match_add(self):
+        """Test match and add."""
+        fps = fuzzy.SpamFingerprints(maxdistance=2)
+        assert fps.match(None) is None
+        assert fps.match(0b1111) is None
+        fps.add(0b1111, u"10/5\n")
+        fps.add(None, u"10/5\n")
+        assert len(fps) == 1
+        assert fps.match(0b1100) == u"10/5\n"
+        assert fps.match(0b1000) is None
+        # A near fingerprint updates the campaign:
+        fps.add(0b0111, u"12/5\n")
+        assert len(fps) == 1
+        assert fps.match(0b1111) == u"12/5\n"
+
+    def test_load_save(self, tmpdir):
+        """Test load and save."""
+        filename = str(tmpdir.join("fuzzy"))
+        fps = fuzzy.SpamFingerprints(filename, maxentries=1)
+        fps.load()
+        assert len(fps) == 0
+        fps.add(0b1111, u"10/5\n")
+        fps.add(0b1111 << 20, u"11/5\n")
+        fps.save()
+
+        fps = fuzzy.SpamFingerprints(filename)
+        fps.load()
+        assert len(fps) == 1
+        fps = fuzzy.SpamFingerprints(filename, maxage=-1)
+        fps.load()
+        assert len(fps) == 0, "Old campaigns should be forgotten"
+
+    def test_save_interrupted(self, tmpdir):
+        """Test a save killed while writing keeps the previous index."""
+        filename = str(tmpdir.join("fuzzy"))
+        fps = fuzzy.SpamFingerprints(filename)
+        fps.add(0b1111, u"10/5\n")
+        fps.save()
+        fps.add(0b1111 << 20, u"11/5\n")
+        with mock.patch('os.replace', side_effect=KeyboardInterrupt):
+            with pytest.raises(KeyboardInterrupt):
+                fps.save()
+        fps = fuzzy.SpamFingerprints(filename)
+        fps.load()
+        assert len(fps) == 1
@@ -24,6 +24,7 @@
 """Test cases for isbg module."""
 
 import email
+import imaplib
 import logging
 import os
 import sys
@@ -39,6 +40,10 @@ sys.path.insert(0, os.path.abspath(os.path.join(
     os.path.dirname(__file__), '..')))
 from isbg import imaputils  # noqa: E402
 
+from unittest import mock  # noqa: E402
+
+ABORT, ERROR = (imaplib.IMAP4.abort, imaplib.IMAP4.error)
+
 
 def test_mail_content():
     """Test mail_content function."""
@@ -81,6 +86,39 @@ def test_get_message():
     pass
 
 
+def test_message_key():
+    """Test message_key and fetch_message_keys."""
+    headers = b"Message-ID: <1@x>\r\nSubject: Hi\r\n\r\n"
+    key = imaputils.message_key(imaputils.new_message(headers))
+    assert key == imaputils.message_key(imaputils.new_message(
+        b"Subject: Hi\r\nMessage-ID: <1@x>\r\n\r\nbody"))
+    assert key != imaputils.message_key(imaputils.new_message(
+        b"Message-ID: <2@x>\r\nSubject: Hi\r\n\r\n"))
+
+    imap = mock.Mock()
+    imap.uid.return_value = ('OK', [
+        ('1 (UID 7 BODY[HEADER.FIELDS (MESSAGE-ID)] {30}', headers), ')',
+        (b'2 (UID 9 BODY[HEADER.FIELDS (MESSAGE-ID)] {2}', b'\r\n'), ')'])
+    keys = imaputils.fetch_message_keys(imap)
+    assert keys[7] == key
+    assert sorted(keys) == [7, 9]
+    imap.uid.return_value = ('NO', [None])
+    assert imaputils.fetch_message_keys(imap) == {}
+
+
+def test_fetch_messages():
+    """Test fetch_messages."""
+    imap = mock.Mock()
+    imap.uid.side_effect = lambda cmd, uids, what: ('OK', [
+        ('{0} (UID {0} BODY[] {{7}}'.format(uid), 'body ' + uid)
+        for uid in uids.split(',')] + [')'])
+    fetched = list(imaputils.fetch_messages(imap, ['1', '2', '3'], 2))
+    assert fetched == [(1, b'body 1'), (2, b'body 2'), (3, b'body 3')]
+    assert imap.uid.call_args_list == [
+        mock.call('FETCH', '1,2', '(BODY.PEEK[])'),
+        mock.call('FETCH', '3', '(BODY.PEEK[])')]
+
+
 def test_imapflags():
     """Test imapflags."""
     assert imaputils.imapflags(['foo', 'boo']) == '(foo,boo)'
@@ -101,6 +139,94 @@ def test_login_imap():
     # FIXME: require network
 
 
+class TestIsbgImap4(object):
+    """Test object IsbgImap4."""
+
+    @staticmethod
+    def _imap(imapmock):
+        """Create a IsbgImap4 logged in and with a mailbox selected."""
+        imapmock.abort, imapmock.error = (ABORT, ERROR)
+        imapmock.return_value.response.return_value = ('UIDVALIDITY', [b'7'])
+        imap = imaputils.IsbgImap4(nossl=True)
+        imap.retry_time = 0
+        imap.login('user', 'passwd')
+        imap.select('INBOX')
+        return imap
+
+    @mock.patch('imaplib.IMAP4')
+    def test_reconnect_idempotent(self, imapmock):
+        """Test that the idempotent commands are repeated on reconnect."""
+        imap = self._imap(imapmock)
+        imapmock.return_value.uid.side_effect = [
+            ABORT("socket error: EOF"), ('OK', [b'1 2'])]
+        assert imap.uid('SEARCH', 'ALL') == ('OK', ['1 2'])
+        assert imapmock.call_count == 2
+        imapmock.return_value.login.assert_called_with('user', 'passwd')
+        imapmock.return_value.select.assert_called_with('INBOX', False)
+
+        # After max_reconnects the error is raised:
+        imapmock.return_value.uid.side_effect = OSError("reset by peer")
+        with pytest.raises(OSError, match="reset"):
+            imap.uid('FETCH', '1', '(RFC822)')
+        assert imapmock.call_count == 2 + imap.max_reconnects
+
+    @mock.patch('imaplib.IMAP4')
+    def test_reconnect_not_idempotent(self, imapmock):
+        """Test that the not idempotent commands are not repeated."""
+        imap = self._imap(imapmock)
+        imapmock.return_value.uid.side_effect = ABORT("EOF")
+        with pytest.raises(ABORT):
+            imap.uid('COPY', '1', 'Spam')
+        assert imapmock.return_value.uid.call_count == 1
+        assert imapmock.call_count == 2, "It should be reconnected"
+
+    @mock.patch('imaplib.IMAP4')
+    def test_reconnect_uidvalidity(self, imapmock):
+        """Test that the reconnection fails if the uidvalidity changes."""
+        imap = self._imap(imapmock)
+        imapmock.return_value.response.return_value = ('UIDVALIDITY', [b'8'])
+        imapmock.return_value.uid.side_effect = ABORT("EOF")
+        with pytest.raises(ERROR, match="uidvalidity"):
+            imap.uid('SEARCH', 'ALL')
+
+    @mock.patch('imaplib.IMAP4')
+    def test_allows_keywords(self, imapmock):
+        """Test the keywords allowed by the PERMANENTFLAGS."""
+        imap = self._imap(imapmock)
+        imapmock.return_value.response.return_value = (
+            'PERMANENTFLAGS', [b'(\\Seen \\Deleted \\*)'])
+        imap.select('INBOX')
+        assert imap.allows_keywords('$IsbgScanned')
+        imapmock.return_value.response.return_value = (
+            'PERMANENTFLAGS', [b'(\\Seen \\Deleted $IsbgScanned)'])
+        imap.select('INBOX')
+        assert imap.allows_keywords('$IsbgScanned')
+        assert not imap.allows_keywords('$IsbgScanned', '$IsbgScore1')
+        imapmock.return_value.response.return_value = (
+            'PERMANENTFLAGS', [None])
+        imap.select('INBOX')
+        assert imap.allows_keywords('$IsbgScanned'), "Not sent: allowed"
+
+    @mock.patch('imaplib.IMAP4')
+    def test_stats(self, imapmock):
+        """Test the latencies and the bytes of the commands."""
+        imapmock.return_value.readline.return_value = b"* 1 FETCH\r\n"
+        imap = self._imap(imapmock)
+
+        def uid(*args):
+            imap.imap.send(b"A1 UID FETCH 1 (BODY.PEEK[])\r\n")
+            imap.imap.readline()
+            return ('OK', [b'1'])
+        imapmock.return_value.uid.side_effect = uid
+        imap.uid('fetch', '1', '(BODY.PEEK[])')
+        imap.uid('FETCH', '2', '(BODY.PEEK[])')
+        fetch = imap.stats.commands['FETCH']
+        assert (fetch.latency.count, fetch.sent, fetch.received) == \
+            (2, 60, 22)
+        assert sorted(imap.stats.commands) == ['FETCH', 'LOGIN', 'SELECT']
+        assert imap.stats.report()[0].startswith("FETCH: 2 calls, p50 ")
+
+
 class TestImapSettings(object):
     """Test object ImapSettings."""
 
@@ -26,8 +26,12 @@
 # With atexit._run_exitfuncs()  we free the lockfile, but we lost coverage
 # statistics.
 
+import mailbox
 import os
+import subprocess
 import sys
+import threading
+import time
 try:
     import pytest
 except ImportError:
@@ -37,6 +41,11 @@ except ImportError:
 sys.path.insert(0, os.path.abspath(os.path.join(
     os.path.dirname(__file__), '..')))
 from isbg import isbg  # noqa: E402
+from isbg import imaputils  # noqa: E402
+from isbg import spamproc  # noqa: E402
+
+from subprocess import TimeoutExpired  # noqa: E402
+from unittest import mock  # noqa: E402
 
 
 def test_ISBGError():
@@ -74,9 +83,223 @@ class TestISBG(object):
         assert os.path.exists(sbg.lockfilename) is False, \
             "File should not exist."
 
+    def test_lockfile(self, tmpdir):
+        """Test the lock files of the accounts."""
+        sbg = isbg.ISBG()
+        other = isbg.ISBG()
+        other.imapsets.user = 'other'
+        assert sbg.lockfilename != other.lockfilename, \
+            "Every account should have its lock file"
+        sbg.lockfilename = str(tmpdir.join("lock"))
+        other.lockfilename = sbg.lockfilename
+
+        sbg._do_lockfile_or_raise()
+        with pytest.raises(isbg.ISBGError, match=repr(os.getpid())):
+            other._do_lockfile_or_raise()
+        sbg.removelock()
+        other._do_lockfile_or_raise()
+        other.removelock()
+
+    def test_lockfile_stale_pid(self, tmpdir):
+        """Test the lock files without flock."""
+        sbg = isbg.ISBG()
+        sbg.lockfilename = str(tmpdir.join("lock"))
+        proc = subprocess.Popen([sys.executable, '-c', ''])
+        proc.wait()
+        with open(sbg.lockfilename, 'w') as lockfile:
+            lockfile.write(repr(proc.pid))
+        sbg._do_lockfile_pid_or_raise()     # The process has ended
+        with pytest.raises(isbg.ISBGError, match="already running"):
+            sbg._do_lockfile_pid_or_raise()
+        sbg.removelock()
+
     def test_do_isbg(self):
         """Test do_isbg."""
         sbg = isbg.ISBG()
         with pytest.raises(isbg.ISBGError, match="specify your imap password"):
             sbg.do_isbg()
             pytest.fail("It should rise a specify imap password " + "ISBGError")
+
+    def test_do_process_inbox(self, tmpdir):
+        """Test _do_process_inbox batches."""
+        def process_inbox(origpastuids, cursor=None, journal=None,
+                          skip=None):
+            batch = spamproc.Sa_Process()
+            batch.uids = [max(origpastuids + [0]) + 1]
+            batch.newpastuids = origpastuids
+            batch.nummsg = 1
+            batch.pending = 3 - len(origpastuids)
+            return batch
+
+        sbg = isbg.ISBG()
+        sbg.trackfile = str(tmpdir.join("track"))
+        sa = mock.Mock()
+        sa.process_inbox.side_effect = process_inbox
+
+        # Without max-runtime only one batch is processed:
+        proc = sbg._do_process_inbox(sa, 1, [])
+        assert proc.nummsg == 1
+        assert sbg.pastuid_read(1) == [1]
+
+        # With time enough, batches are processed until no one is left:
+        sbg.deadline = time.monotonic() + 60
+        proc = sbg._do_process_inbox(sa, 1, [])
+        assert proc.nummsg == 4
+        assert proc.pending == 0
+        assert sorted(sbg.pastuid_read(1)) == [1, 2, 3, 4]
+
+        # Without time left, only one batch is processed:
+        sbg.deadline = time.monotonic()
+        proc = sbg._do_process_inbox(sa, 1, [])
+        assert proc.nummsg == 1
+
+    def test_do_process_inbox_timeout(self, tmpdir):
+        """Test that a scan timeout does not stop the batches."""
+        sbg = isbg.ISBG()
+        sbg.trackfile = str(tmpdir.join("track"))
+        sbg.partialrun, sbg.deadline = (2, time.monotonic() + 60)
+        sbg.imap = mock.Mock()
+        sbg.imap.uid.side_effect = lambda cmd, uid, *args: \
+            ("OK", ["1 2 3 4 5"]) if cmd == "SEARCH" else \
+            ("OK", [(b"1 (BODY[] {20}", b"Subject: " + uid.encode() +
+                     b"\r\n\r\nbar")])
+        sa = spamproc.SpamAssassin.create_from_isbg(sbg)
+
+        def test_mail(mail, sa_proc):
+            if mail['Subject'] == '4':
+                raise TimeoutExpired("spamc", 1)
+            return "0/5\n", 0, None
+
+        with mock.patch.object(sa, '_test_mail', side_effect=test_mail):
+            proc = sbg._do_process_inbox(sa, 1, [])
+        assert proc.nummsg == 4
+        assert proc.deferred == ['4']
+        assert not proc.expired
+        assert sorted(sbg.pastuid_read(1)) == [1, 2, 3, 5]
+
+    def test_pastuid_cursor(self, tmpdir):
+        """Test pastuid_read, pastuid_write and backlog_cursor."""
+        sbg = isbg.ISBG()
+        sbg.trackfile = str(tmpdir.join("track"))
+        assert sbg.pastuid_read(1) == []
+        assert sbg.backlog_cursor(1) is None
+        sbg.pastuid_write(1, [1, 2], [3], cursor=2)
+        assert sorted(sbg.pastuid_read(1)) == [1, 2, 3]
+        assert sbg.backlog_cursor(1) == 2
+        assert sbg.pastuid_read(2) == [], "uidvalidity has changed"
+        assert sbg.backlog_cursor(2) is None
+
+    def test_pastuid_journal(self, tmpdir):
+        """Test that pastuid_read resumes from the uid journal."""
+        sbg = isbg.ISBG()
+        sbg.trackfile = str(tmpdir.join("track"))
+        sbg.pastuid_write(1, [1], [2])
+        jrnl = sbg._uid_journal(1, 'inbox')
+        jrnl.append(3)
+        jrnl.append(4)
+        jrnl.close()
+
+        # A new run (the previous one has crashed):
+        sbg = isbg.ISBG()
+        sbg.trackfile = str(tmpdir.join("track"))
+        assert sorted(sbg.pastuid_read(1)) == [1, 2, 3, 4]
+        sbg.pastuid_write(1, [1, 2, 3, 4], [5])
+        assert sbg._uid_journal(1, 'inbox').read() == [], \
+            "The journal should be emptied"
+        assert sorted(sbg.pastuid_read(1)) == [1, 2, 3, 4, 5]
+
+    def test_remap_pastuids(self, tmpdir):
+        """Test the recovery of the uids when the uidvalidity changes."""
+        sbg = isbg.ISBG()
+        sbg.trackfile = str(tmpdir.join("track"))
+        sbg.imap = mock.Mock()
+        assert sbg.remap_pastuids(1, 'INBOX') == 0, "Without track file"
+        sbg.pastuid_write(1, [1], [2, 3], keys={1: 'a', 2: 'b', 3: 'c'})
+        assert sbg.remap_pastuids(1, 'INBOX') == 0, "Same uidvalidity"
+        sbg.imap.select.assert_not_called()
+
+        with mock.patch.object(imaputils, 'fetch_message_keys',
+                               return_value={10: 'a', 11: 'c', 12: 'd'}):
+            assert sbg.remap_pastuids(2, 'INBOX') == 2
+        sbg.imap.select.assert_called_once_with('INBOX', 1)
+        assert sorted(sbg.pastuid_read(2)) == [10, 11]
+
+        # The keys are kept for the next change:
+        with mock.patch.object(imaputils, 'fetch_message_keys',
+                               return_value={20: 'c'}):
+            assert sbg.remap_pastuids(3, 'INBOX') == 1
+        assert sbg.pastuid_read(3) == [20]
+
+    def test_do_export_mbox(self, tmpdir):
+        """Test the export of the learn folders."""
+        sbg = isbg.ISBG()
+        sbg.exportmbox = str(tmpdir.join("export"))
+        sbg.imapsets.learnspambox = 'Spam'
+        sbg.imap = mock.Mock()
+        sbg.imap.uid.return_value = ('OK', ['1 2'])
+        with mock.patch.object(imaputils, 'fetch_messages', return_value=[
+                (1, b"Subject: 1\n\nspam\n"),
+                (2, b"Subject: 2\n\nspam\n")]) as fetch:
+            exported = sbg.do_export_mbox()
+        fetch.assert_called_once_with(sbg.imap, ['1', '2'], 100)
+        filename = os.path.join(sbg.exportmbox, "spam.mbox")
+        assert exported == {filename: 2}
+        assert [m['Subject'] for m in mailbox.mbox(filename)] == ['1', '2']
+
+    def test_parallel(self, tmpdir):
+        """Test the learning in parallel with the inbox scan."""
+        sbg = isbg.ISBG()
+        sbg.trackfile = str(tmpdir.join("track"))
+        sbg.parallel, sbg.nostats = (True, True)
+        sbg.imapsets.learnspambox = 'Spam'
+        sbg.imap = mock.Mock()
+        events = []
+
+        def do_learn(sa):
+            assert sa.gate is sbg.gate
+            sa.gate.wait(5)
+            events.append('learn')
+            return spamproc.Sa_Learn(), spamproc.Sa_Learn()
+
+        def do_process_inbox(*args):
+            events.append('inbox')
+            return spamproc.Sa_Process()
+
+        with mock.patch.object(imaputils, 'login_imap') as login, \
+                mock.patch.object(sbg, '_do_learn', side_effect=do_learn), \
+                mock.patch.object(sbg, '_do_process_inbox',
+                                  side_effect=do_process_inbox):
+            sbg.do_spamassassin()
+            assert events == ['inbox', 'learn']
+            login.return_value.logout.assert_called_once_with()
+
+    def test_parallel_error(self, tmpdir):
+        """Test that the learning stops if the inbox scan fails."""
+        sbg = isbg.ISBG()
+        sbg.trackfile = str(tmpdir.join("track"))
+        sbg.parallel, sbg.nostats = (True, True)
+        sbg.imapsets.learnspambox = 'Spam'
+        sbg.imap = mock.Mock()
+        started, stopped = (threading.Event(), [])
+
+        def do_learn(sa):
+            started.set()
+            for _ in range(500):
+                if sa._expired():
+                    stopped.append(sa.gate.is_set())
+                    break
+                time.sleep(0.01)
+            return spamproc.Sa_Learn(), spamproc.Sa_Learn()
+
+        def do_process_inbox(*args):
+            started.wait(5)
+            raise OSError("reset by peer")
+
+        with mock.patch.object(imaputils, 'login_imap') as login, \
+                mock.patch.object(sbg, '_do_learn', side_effect=do_learn), \
+                mock.patch.object(sbg, '_do_process_inbox',
+                                  side_effect=do_process_inbox):
+            with pytest.raises(OSError, match="reset"):
+                sbg.do_spamassassin()
+            assert stopped == [True]
+            login.return_value.logout.assert_called_once_with()
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  test_journal.py
+#  This file is part of isbg.
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+
+"""Test cases for journal module."""
+
+import os
+import sys
+
+# We add the upper dir to the path
+sys.path.insert(0, os.path.abspath(os.path.join(
+    os.path.dirname(__file__), '..')))
+from isbg import journal  # noqa: E402
+
+
+def test_write_atomic(tmpdir):
+    """Test write_atomic."""
+    filename = str(tmpdir.join("track"))
+    journal.write_atomic(filename, "foo")
+    journal.write_atomic(filename, "boo")
+    with open(filename) as rfile:
+        assert rfile.read() == "boo"
+    assert os.listdir(str(tmpdir)) == ["track"]
+
+
+class TestJournal(object):
+    """Tests for Journal."""
+
+    def test_journal(self, tmpdir):
+        """Test write, records and clear."""
+        filename = str(tmpdir.join("journal"))
+        jrnl = journal.Journal(filename, every=2)
+        assert jrnl.records() == []
+        jrnl.write({'a': 1})
+        assert jrnl._unsynced == 1
+        jrnl.write([2])
+        assert jrnl._unsynced == 0, "It should be synced every 2 records"
+        assert jrnl.records() == [{'a': 1}, [2]]
+
+        # A partial record is ignored:
+        with open(filename, "a") as afile:
+            afile.write('{"partial": ')
+        assert jrnl.records() == [{'a': 1}, [2]]
+
+        jrnl.clear("header")
+        assert jrnl.records() == ["header"]
+        jrnl.close()
+
+
+class TestUidJournal(object):
+    """Tests for UidJournal."""
+
+    def test_uid_journal(self, tmpdir):
+        """Test append, read and clear."""
+        filename = str(tmpdir.join("journal"))
+        jrnl = journal.UidJournal(filename, 10, fsync=False)
+        assert jrnl.read() == []
+        jrnl.append(u'3')
+        jrnl.append(4)
+        jrnl.close()
+        assert journal.UidJournal(filename, 10).read() == [3, 4]
+        assert journal.UidJournal(filename, 11).read() == [], \
+            "uidvalidity has changed"
+
+        # With other uidvalidity the old uids are removed:
+        jrnl = journal.UidJournal(filename, 11)
+        jrnl.append(5)
+        assert jrnl.read() == [5]
+        jrnl.clear()
+        assert jrnl.read() == []
+        jrnl.close()
+
+
+class TestActionJournal(object):
+    """Tests for ActionJournal."""
+
+    def test_action_journal(self, tmpdir):
+        """Test intend, done and pending."""
+        filename = str(tmpdir.join("actions"))
+        jrnl = journal.ActionJournal(filename)
+        assert jrnl.pending() == []
+        id1 = jrnl.intend('append', 'Spam', message=b'\x00mail', msgid='<a>')
+        id2 = jrnl.intend('store', 'INBOX', '3', ('+FLAGS', '(\\Seen)'),
+                          uidvalidity=7)
+        jrnl.done(id1)
+        jrnl.close()
+
+        jrnl = journal.ActionJournal(filename)
+        pending = jrnl.pending()
+        assert len(pending) == 1
+        assert pending[0]['id'] == id2
+        assert pending[0]['args'] == ['+FLAGS', '(\\Seen)']
+        assert jrnl.intend('expunge', 'INBOX') > id2
+        assert [a['message'] for a in jrnl.pending()] == [None, None]
+
+        # When all are done the journal is emptied:
+        jrnl.done(id2)
+        jrnl.done(id2 + 1)
+        assert jrnl.records() == []
+        jrnl.intend('append', 'Spam', message=b'\x00mail')
+        assert jrnl.pending()[0]['message'] == b'\x00mail'
+        jrnl.close()
@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  test_learnlocal.py
+#  This file is part of isbg.
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+
+"""Test cases for learnlocal module."""
+
+import concurrent.futures
+import mailbox
+import os
+import sys
+try:
+    import pytest
+except ImportError:
+    pass
+
+# We add the upper dir to the path
+sys.path.insert(0, os.path.abspath(os.path.join(
+    os.path.dirname(__file__), '..')))
+from isbg import isbg  # noqa: E402
+from isbg import learnlocal  # noqa: E402
+
+from unittest import mock  # noqa: E402
+
+
+def _mail(num):
+    return "Subject: test {0}\n\nbody {0}\n".format(num).encode()
+
+
+class FakeLearner(object):
+    """A BulkLearner that learns every message once."""
+
+    workers = 2
+
+    def __init__(self, code=None):
+        """Initialize a FakeLearner object."""
+        self.learned = []
+        self.code = code
+
+    def submit(self, mail, learn_type, timeout=None):
+        """Learn a message."""
+        future = concurrent.futures.Future()
+        if self.code is not None:
+            future.set_result((self.code, self.code))
+        elif mail in self.learned:
+            future.set_result((6, 0))
+        else:
+            self.learned.append(mail)
+            future.set_result((5, 0))
+        return future
+
+
+@pytest.fixture
+def boxes(tmpdir):
+    """Create a mbox file and a Maildir with two messages each."""
+    mbox = mailbox.mbox(str(tmpdir.join("spam.mbox")))
+    maildir = mailbox.Maildir(str(tmpdir.join("Maildir")))
+    for num in range(2):
+        mbox.add(_mail(num))
+        maildir.add(_mail(num + 2))
+    mbox.close()
+    return [mbox._path, maildir._path]  # pylint: disable=protected-access
+
+
+def test_iter_messages(boxes):
+    """Test iter_messages."""
+    assert [m.split(b"\n")[0] for m in learnlocal.iter_messages(boxes[0])] \
+        == [b"Subject: test 0", b"Subject: test 1"]
+    assert sorted(learnlocal.iter_messages(boxes[1])) == [_mail(2), _mail(3)]
+    with pytest.raises(isbg.ISBGError, match="not a mbox"):
+        list(learnlocal.iter_messages(boxes[0] + ".none"))
+
+
+def test_unwrap_message():
+    """Test unwrap_message."""
+    with open('tests/examples/spam.from.spamassassin.eml', 'rb') as fhandle:
+        wrapped = fhandle.read()
+    with open('tests/examples/spam.eml', 'rb') as fhandle:
+        spam = fhandle.read()
+    assert b"x-spam-type=original" not in learnlocal.unwrap_message(wrapped)
+    assert learnlocal.unwrap_message(spam) == spam
+
+
+@pytest.mark.parametrize("processes", [1, 2])
+def test_learn_local(boxes, processes):
+    """Test learn_local."""
+    learner = FakeLearner()
+    result = learnlocal.learn_local(boxes + boxes[:1], 'spam', learner,
+                                    processes)
+    assert result.tolearn == 6
+    assert result.learned == 4
+    assert len(learner.learned) == 4
+
+    with pytest.raises(isbg.ISBGError, match="allow-tell"):
+        learnlocal.learn_local(boxes, 'spam', FakeLearner(69), 1)
+
+
+def test_isbg_learn_local(boxes):
+    """Test the command line."""
+    with mock.patch.object(learnlocal.bulklearn.SpamdClient, "tell",
+                           return_value=(5, 0)) as tell, \
+            mock.patch.object(learnlocal.bulklearn, "sync_bayes") as sync:
+        result = learnlocal.isbg_learn_local([
+            'learn-local', '--ham', '--processes', '1', '--learnsync',
+            '--learnspamd', 'spamd:1783'] + boxes)
+        assert result.learned == 4
+        assert tell.call_args[0][1] == 'ham'
+        sync.assert_called_once_with(None, mock.ANY, 'spamd:1783')
+
+    with pytest.raises(isbg.ISBGError, match="1 or more"):
+        learnlocal.isbg_learn_local(['learn-local', '--spam', '--bulklearn',
+                                     '0'] + boxes)
@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  test_ledger.py
+#  This file is part of isbg.
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+
+
+"""Test cases for ledger module."""
+
+import concurrent.futures
+import json
+import os
+import sys
+try:
+    import pytest
+except ImportError:
+    pass
+
+# We add the upper dir to the path
+sys.path.insert(0, os.path.abspath(os.path.join(
+    os.path.dirname(__file__), '..')))
+from isbg import isbg  # noqa: E402
+from isbg import ledger  # noqa: E402
+from isbg import spamproc  # noqa: E402
+
+from unittest import mock  # noqa: E402
+
+
+def _record(num, messages=10, duration=2.0, backlog=0, error=None):
+    return {'start': 1000.0 * num, 'end': 1000.0 * num + duration,
+            'account': 'a' if num % 2 else 'b', 'duration': duration,
+            'exitcode': 1, 'error': error,
+            'folders': {'INBOX': {'messages': messages, 'spam': 1,
+                                  'errors': 1, 'bytes': 100,
+                                  'backlog': backlog},
+                        'Spam': {'messages': 2, 'learned': 2}}}
+
+
+class TestLedger(object):
+    """Tests for Ledger."""
+
+    def test_append(self, tmpdir):
+        """Test append, rotate and read."""
+        filename = str(tmpdir.join("ledger.jsonl"))
+        lgr = ledger.Ledger(filename, maxbytes=600, backups=2)
+        for num in range(8):
+            lgr.append(_record(num))
+        assert os.path.exists(filename + ".2")
+        assert not os.path.exists(filename + ".3")
+        assert os.path.getsize(filename) <= 600
+        starts = [rec['start'] for rec in lgr.read()]
+        assert starts == sorted(starts)
+        assert starts[-1] == 7000.0
+        assert len(starts) < 8      # The oldest have been dropped
+        assert {rec['account'] for rec in lgr.read('a')} == {'a'}
+
+        with open(filename, 'a') as fhandle:
+            fhandle.write("not json\n")
+        assert len(list(lgr.read())) == len(starts)
+
+        lgr.backups = 0
+        lgr.rotate()
+        assert not os.path.exists(filename)
+
+    def test_append_concurrent(self, tmpdir):
+        """Test that the runs of several accounts append at the same time."""
+        filename = str(tmpdir.join("ledger.jsonl"))
+
+        def append(num):
+            ledger.Ledger(filename, maxbytes=1200, backups=100).append(
+                _record(num))
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=8) as pool:
+            list(pool.map(append, range(200)))
+        starts = [rec['start'] for rec in ledger.Ledger(
+            filename, backups=100).read()]
+        assert sorted(starts) == [1000.0 * num for num in range(200)]
+
+
+def test_summarize():
+    """Test summarize and report."""
+    records = [_record(1, 10, 10.0, 50), _record(2, 30, 10.0, 20),
+               _record(3, 0, 1.0, 20, error="imap error")]
+    summary = ledger.summarize(records)
+    assert summary['runs'] == 3
+    assert summary['failed'] == 1
+    assert summary['messages'] == 46
+    assert summary['seconds'] == 21.0
+    assert summary['rate'] == 46 / 21.0
+    assert summary['trend'] == (12 / 10.0, 34 / 11.0)
+    assert summary['errors'] == 3
+    assert summary['folders']['INBOX']['backlog'] == [50, 20]
+    assert summary['folders']['Spam']['learned'] == 6
+    assert summary['folders']['Spam']['backlog'] is None
+
+    lines = ledger.report(summary)
+    assert lines[0].startswith("3 runs from ")
+    assert lines[0].endswith(", 1 failed (33.3%)")
+    assert lines[-2].endswith("backlog 50 -> 20")
+    assert ledger.report(ledger.summarize([])) == ["No runs recorded"]
+
+
+def test_isbg_stats(tmpdir, capsys):
+    """Test the command line."""
+    filename = str(tmpdir.join("ledger.jsonl"))
+    lgr = ledger.Ledger(filename)
+    for num in range(4):
+        lgr.append(_record(num))
+    summary = ledger.isbg_stats(['stats', '--ledger', filename])
+    assert summary['runs'] == 4
+    assert "4 runs from" in capsys.readouterr().out
+    summary = ledger.isbg_stats(['stats', '--ledger', filename, '--json',
+                                 '--last', '3', '--account', 'a'])
+    assert summary['runs'] == 2
+    assert json.loads(capsys.readouterr().out)['runs'] == 2
+    with pytest.raises(isbg.ISBGError, match="1 or more"):
+        ledger.isbg_stats(['stats', '--ledger', filename, '--last', '0'])
+
+
+def test_do_ledger(tmpdir):
+    """Test the record of a run of ISBG."""
+    sbg = isbg.ISBG()
+    sbg.ledgerfile = str(tmpdir.join("ledger.jsonl"))
+    proc = spamproc.Sa_Process()
+    proc.nummsg, proc.numspam, proc.pending = (10, 2, 5)
+    proc.timings.add('fetch', 0.5, nbytes=2000)
+    proc.timings.add('scan', 1.5)
+    sbg.results = {'INBOX': proc, 'Spam': spamproc.Sa_Learn()}
+    sbg.timings.add('run', 3.0)
+    sbg._do_ledger(100.0, 1)  # pylint: disable=protected-access
+    record, = ledger.Ledger(sbg.ledgerfile).read()
+    assert record['account'] == sbg.imapsets.hash.hexdigest()
+    assert (record['start'], record['duration']) == (100.0, 3.0)
+    assert (record['exitcode'], record['error']) == (1, None)
+    assert record['folders']['INBOX'] == {
+        'messages': 10, 'spam': 2, 'backlog': 5, 'errors': 0,
+        'deferred': 0, 'bytes': 2000, 'seconds': 2.0}
+    assert record['folders']['Spam']['learned'] == 0
+
+    # The errors writing it are only logged
+    sbg.ledgerfile = str(tmpdir.join("none", "ledger.jsonl"))
+    with mock.patch.object(sbg.logger, "warning") as warning:
+        sbg._do_ledger(100.0, 1)  # pylint: disable=protected-access
+    assert warning.called
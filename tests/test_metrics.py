@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  test_metrics.py
+#  This file is part of isbg.
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+
+"""Test cases for metrics module."""
+
+import concurrent.futures
+import os
+import sys
+import urllib.error
+import urllib.request
+try:
+    import pytest
+except ImportError:
+    pass
+
+# We add the upper dir to the path
+sys.path.insert(0, os.path.abspath(os.path.join(
+    os.path.dirname(__file__), '..')))
+from isbg import imaputils  # noqa: E402
+from isbg import isbg  # noqa: E402
+from isbg import metrics  # noqa: E402
+from isbg import spamproc  # noqa: E402
+from isbg import timing  # noqa: E402
+
+from unittest import mock  # noqa: E402
+
+
+def _metrics():
+    mtr = metrics.Metrics()
+    mtr.counter("isbg_spam_found_total", "Spams found.", 3,
+                account="a", folder='IN"BOX')
+    mtr.gauge("isbg_backlog_messages", "Backlog.", 7, account="a")
+    hist = timing.Histogram((0.1, 1.0))
+    hist.observe(0.05)
+    hist.observe(2.0)
+    mtr.histogram("isbg_phase_seconds", "Phases.", hist, phase="scan")
+    return mtr
+
+
+class TestMetrics(object):
+    """Tests for Metrics."""
+
+    def test_render(self):
+        """Test render."""
+        assert _metrics().render().splitlines() == [
+            '# HELP isbg_spam_found_total Spams found.',
+            '# TYPE isbg_spam_found_total counter',
+            'isbg_spam_found_total{account="a",folder="IN\\"BOX"} 3',
+            '# HELP isbg_backlog_messages Backlog.',
+            '# TYPE isbg_backlog_messages gauge',
+            'isbg_backlog_messages{account="a"} 7',
+            '# HELP isbg_phase_seconds Phases.',
+            '# TYPE isbg_phase_seconds histogram',
+            'isbg_phase_seconds_bucket{phase="scan",le="0.1"} 1',
+            'isbg_phase_seconds_bucket{phase="scan",le="1"} 1',
+            'isbg_phase_seconds_bucket{phase="scan",le="+Inf"} 2',
+            'isbg_phase_seconds_sum{phase="scan"} 2.05',
+            'isbg_phase_seconds_count{phase="scan"} 2']
+
+    def test_write(self, tmpdir):
+        """Test that the counters are added to those of the file."""
+        filename = str(tmpdir.join("isbg.prom"))
+        _metrics().write(filename)
+        mtr = _metrics()
+        mtr.gauge("isbg_backlog_messages", "Backlog.", 1, account="a")
+        mtr.write(filename)
+        assert sorted(os.listdir(str(tmpdir))) == ["isbg.prom",
+                                                   "isbg.prom.lock"]
+        with open(filename) as fhandle:
+            lines = fhandle.read().splitlines()
+        assert 'isbg_spam_found_total{account="a",folder="IN\\"BOX"} 6' \
+            in lines
+        assert 'isbg_backlog_messages{account="a"} 1' in lines
+        assert 'isbg_phase_seconds_bucket{phase="scan",le="+Inf"} 4' in lines
+        assert 'isbg_phase_seconds_count{phase="scan"} 4' in lines
+
+    def test_write_concurrent(self, tmpdir):
+        """Test that the runs of several accounts write the same file."""
+        filename = str(tmpdir.join("isbg.prom"))
+
+        def write(num):
+            mtr = metrics.Metrics()
+            mtr.counter("isbg_messages_total", "Messages.", 1,
+                        account=str(num % 4))
+            mtr.write(filename)
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=8) as pool:
+            list(pool.map(write, range(100)))
+        with open(filename) as fhandle:
+            lines = fhandle.read().splitlines()
+        for account in range(4):
+            assert 'isbg_messages_total{{account="{}"}} 25'.format(
+                account) in lines
+
+    def test_serve(self):
+        """Test the HTTP server."""
+        server = metrics.serve(_metrics, 0)
+        url = "http://127.0.0.1:{}/".format(server.server_address[1])
+        try:
+            with urllib.request.urlopen(url + "metrics") as response:
+                assert response.headers["Content-Type"] == \
+                    metrics.CONTENT_TYPE
+                assert b"isbg_backlog_messages" in response.read()
+            with pytest.raises(urllib.error.HTTPError):
+                urllib.request.urlopen(url)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+
+def test_do_metrics():
+    """Test the metrics of a run."""
+    sbg = isbg.ISBG()
+    sbg.imap = mock.Mock()
+    sbg.imap.stats = imaputils.ImapStats()
+    sbg.imap.stats.record("FETCH", 0.02, 50, 2000)
+    proc = spamproc.Sa_Process()
+    proc.nummsg, proc.numspam, proc.pending = (10, 2, 5)
+    proc.timings.add('scan', 0.5)
+    learned = spamproc.Sa_Learn()
+    learned.learned = 4
+    sbg.results = {'INBOX': proc, 'Spam': learned}
+    sbg.timings.add('run', 3.0)
+    text = sbg.do_metrics().render()
+    account = sbg.imapsets.hash.hexdigest()
+    assert 'isbg_messages_scanned_total{{account="{}",folder="INBOX"}} 10' \
+        .format(account) in text
+    assert 'isbg_messages_learned_total{{account="{}",folder="Spam"}} 4' \
+        .format(account) in text
+    assert 'isbg_run_duration_seconds{{account="{}"}} 3'.format(account) \
+        in text
+    assert 'isbg_phase_seconds_count{{account="{}",folder="INBOX",' \
+        'phase="scan"}} 1'.format(account) in text
+    assert 'isbg_imap_received_bytes_total{{account="{}",command="FETCH"}} ' \
+        '2000'.format(account) in text
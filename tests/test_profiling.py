@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  test_profiling.py
+#  This file is part of isbg.
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+
+
+"""Test cases for profiling module."""
+
+import os
+import pstats
+import sys
+
+# We add the upper dir to the path
+sys.path.insert(0, os.path.abspath(os.path.join(
+    os.path.dirname(__file__), '..')))
+from isbg import isbg  # noqa: E402
+from isbg import profiling  # noqa: E402
+
+from unittest import mock  # noqa: E402
+
+
+def _leaf(num):
+    return sum(range(num))
+
+
+def _work():
+    return [_leaf(20000) for _ in range(20)]
+
+
+class TestProfiler(object):
+    """Tests for Profiler."""
+
+    def test_phase(self, tmpdir):
+        """Test phase and dump."""
+        profiler = profiling.Profiler(str(tmpdir.join("profile")))
+        for _ in range(2):
+            with profiler.phase('scan'):
+                _work()
+        with profiler.phase('empty'):
+            pass
+        profiler.profiles['never'] = profiling.cProfile.Profile()
+        files = profiler.dump()
+        names = sorted(os.path.basename(f) for f in files)
+        assert names == ['empty.collapsed', 'empty.pstats', 'scan.collapsed',
+                         'scan.pstats']
+
+        stats = pstats.Stats(str(tmpdir.join("profile", "scan.pstats")))
+        calls = {func[2]: values[1] for func, values in stats.stats.items()}
+        assert calls['_work'] == 2
+        assert calls['_leaf'] == 40
+
+        with open(str(tmpdir.join("profile", "scan.collapsed"))) as fhandle:
+            lines = fhandle.read().splitlines()
+        stacks = [line.rsplit(' ', 1)[0] for line in lines]
+        assert any(stack.startswith('test_profiling.py:') and
+                   ':_work;' in stack and
+                   stack.endswith(':_leaf;<built-in_method_builtins.sum>')
+                   for stack in stacks)
+        assert all(int(line.rsplit(' ', 1)[1]) > 0 for line in lines)
+
+    def test_collapsed_stacks(self):
+        """Test collapsed_stacks splits the time between the callers."""
+        stats = mock.Mock()
+        root, left, right, leaf = [
+            ('f.py', num, name)
+            for num, name in enumerate(['root', 'left', 'right', 'leaf'])]
+        stats.stats = {
+            root: (1, 1, 0.1, 1.0, {}),
+            left: (1, 1, 0.1, 0.4, {root: (1, 1, 0.1, 0.4)}),
+            right: (1, 1, 0.1, 0.4, {root: (1, 1, 0.1, 0.4)}),
+            leaf: (2, 2, 0.6, 0.6, {left: (1, 1, 0.3, 0.3),
+                                    right: (1, 1, 0.3, 0.3)})}
+        stacks = profiling.collapsed_stacks(stats)
+        assert stacks == {
+            'f.py:0:root': 100000,
+            'f.py:0:root;f.py:1:left': 100000,
+            'f.py:0:root;f.py:2:right': 100000,
+            'f.py:0:root;f.py:1:left;f.py:3:leaf': 300000,
+            'f.py:0:root;f.py:2:right;f.py:3:leaf': 300000}
+
+
+def test_isbg_profile():
+    """Test the phases are profiled only with a profiler."""
+    sbg = isbg.ISBG()
+    with sbg._profile('inbox'):  # pylint: disable=protected-access
+        pass
+    sbg.profiler = profiling.Profiler('none')
+    with sbg._profile('inbox'):  # pylint: disable=protected-access
+        _work()
+    assert list(sbg.profiler.profiles) == ['inbox']
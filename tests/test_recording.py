@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  test_recording.py
+#  This file is part of isbg.
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+
+
+"""Test cases for recording module."""
+
+import email
+import imaplib
+import io
+import json
+import os
+import sys
+from subprocess import TimeoutExpired
+try:
+    import pytest
+except ImportError:
+    pass
+
+# We add the upper dir to the path
+sys.path.insert(0, os.path.abspath(os.path.join(
+    os.path.dirname(__file__), '..')))
+from isbg import isbg  # noqa: E402
+from isbg import recording  # noqa: E402
+from isbg import spamproc  # noqa: E402
+
+from unittest import mock  # noqa: E402
+
+_MAIL = (b"From: Jane <jane@example.com>\r\n"
+         b"Subject: Hello there\r\n"
+         b"Content-Type: multipart/mixed; boundary=\"b\"\r\n"
+         b"X-Spam-Status: No, score=1.0 required=5.0\r\n\r\n"
+         b"--b\r\nContent-Type: text/plain\r\n\r\nSecret text\r\n--b--\r\n")
+
+_FETCH = ('OK', [(b'1 (UID 7 BODY[] {%d}' % len(_MAIL), _MAIL), b')'])
+
+
+class _Imap(object):
+    """A fake imaplib.IMAP4 connection."""
+
+    def __init__(self, owner):
+        self.owner = owner
+
+    def login(self, user, passwd):
+        self.owner.sent += 20
+        return ('OK', [b'Logged in'])
+
+    def uid(self, command, *args):
+        self.owner.received += 100
+        if command == 'SEARCH':
+            raise imaplib.IMAP4.abort("connection lost")
+        return _FETCH
+
+
+def _record(bodies='keep'):
+    """Record a session, returning its records."""
+    stream = io.StringIO()
+    stream.close = mock.Mock()
+    recorder = recording.Recorder(stream, bodies)
+    owner = mock.Mock(sent=0, received=0)
+    imap = recorder.connect(lambda: _Imap(owner), owner)
+    assert imap.login('user', 'passwd') == ('OK', [b'Logged in'])
+    assert imap.uid('FETCH', '7', '(BODY.PEEK[])') == _FETCH
+    with pytest.raises(imaplib.IMAP4.abort):
+        imap.uid('SEARCH', None, 'ALL')
+    mail = email.message_from_bytes(_MAIL)
+    assert recorder.scan('test', lambda m, cmd: ('1.0/5.0\n', 0, _MAIL),
+                         mail, cmd=['spamc']) == ('1.0/5.0\n', 0, _MAIL)
+
+    def timeout(mail):
+        raise TimeoutExpired(['spamc'], 3)
+    with pytest.raises(TimeoutExpired):
+        recorder.scan('learn', timeout, mail)
+    recorder.close()
+    return [json.loads(line) for line in stream.getvalue().splitlines()]
+
+
+def test_redact():
+    """Test the redaction of the messages."""
+    redacted = recording.redact(_MAIL)
+    assert len(redacted) == len(_MAIL)
+    assert b"jane" not in redacted and b"Secret" not in redacted
+    assert b"From: xxxx" in redacted
+    assert b"X-Spam-Status: No, score=1.0" in redacted
+    mail = email.message_from_bytes(redacted)
+    assert mail.get_content_type() == 'multipart/mixed'
+    assert mail.get_payload(0).get_payload() == "xxxxxx xxxx"
+
+
+def test_encode():
+    """Test the JSON encoding of the results."""
+    for bodies in recording.BODIES:
+        encoded = json.loads(json.dumps(recording.encode(_FETCH, bodies)))
+        decoded = recording.decode(encoded)
+        assert decoded[0] == 'OK' and decoded[1][1] == b')'
+        assert decoded[1][0][0] == _FETCH[1][0][0]
+        assert len(decoded[1][0][1]) == len(_MAIL)
+        if bodies == 'keep':
+            assert decoded == _FETCH
+        elif bodies == 'hash':
+            assert decoded[1][0][1] == b"x" * len(_MAIL)
+            assert 'sha256' in encoded['tuple'][1][0]['tuple'][1]
+
+
+def test_recorder():
+    """Test the recording of a session."""
+    records = _record('hash')
+    assert records[0]['type'] == 'session'
+    assert records[0]['bodies'] == 'hash'
+    login, fetch, search, scan, learn = records[1:]
+    assert login['args'] == ['user', 'xxxxxxxx']
+    assert login['sent'] == 20 and fetch['received'] == 100
+    assert "Secret" not in json.dumps(records)
+    assert search['error'] == ['abort', 'connection lost']
+    assert scan['key'] == recording.digest(email.message_from_bytes(_MAIL))
+    assert scan['result'][:2] == ['1.0/5.0\n', 0]
+    assert learn['error'] == ['timeout', ['spamc']]
+    assert learn['timeout'] == 3
+
+    with pytest.raises(ValueError):
+        recording.Recorder(io.StringIO(), 'foo')
+
+
+def test_replayer():
+    """Test the replay of a session."""
+    replayer = recording.Replayer(_record(), speed=0, filename='rec')
+    owner = mock.Mock(sent=0, received=0)
+    factory = mock.Mock()
+    imap = replayer.connect(factory, owner)
+    factory.assert_not_called()
+    assert imap.login('user', 'foo') == ('OK', [b'Logged in'])
+    assert imap.uid('FETCH', '7', '(BODY.PEEK[])') == _FETCH
+    assert (owner.sent, owner.received) == (20, 100)
+    with pytest.raises(isbg.ISBGError, match="expunge called, uid"):
+        imap.expunge()
+    with pytest.raises(imaplib.IMAP4.abort, match="connection lost"):
+        imap.uid('SEARCH', None, 'ALL')
+    with pytest.raises(isbg.ISBGError, match="nothing else recorded"):
+        imap.logout()
+    with pytest.raises(isbg.ISBGError, match="no more IMAP connections"):
+        replayer.connect(factory, owner)
+
+    # The scans are served by the message, or in order
+    func = mock.Mock()
+    other = email.message_from_bytes(b"Subject: other\r\n\r\nfoo")
+    assert replayer.scan('test', func, other) == ('1.0/5.0\n', 0, _MAIL)
+    with pytest.raises(TimeoutExpired):
+        replayer.scan('learn', func, other)
+    with pytest.raises(isbg.ISBGError, match="no more 'test' scans"):
+        replayer.scan('test', func, other)
+    func.assert_not_called()
+
+
+def test_replayer_open(tmpdir):
+    """Test the replayer opens only recordings."""
+    filename = str(tmpdir.join("recording"))
+    recorder = recording.Recorder.open(filename)
+    recorder.close()
+    assert recording.Replayer.open(filename, 2.0).speed == 2.0
+    with open(filename, 'w') as fhandle:
+        fhandle.write('{"foo": 1}\n')
+    with pytest.raises(isbg.ISBGError, match="not a recording"):
+        recording.Replayer.open(filename)
+
+
+def test_session():
+    """Test SpamAssassin scans through its session."""
+    sa = spamproc.SpamAssassin(session=mock.Mock())
+    sa.session.scan.return_value = 'result'
+    func = mock.Mock()
+    assert sa._scan('test', func, 'mail', cmd='spamc') == 'result'
+    sa.session.scan.assert_called_once_with('test', func, 'mail',
+                                            cmd='spamc')
+    sa.session = None
+    sa._scan('learn', func, 'mail', 'spam')
+    func.assert_called_once_with('mail', 'spam')
@@ -23,18 +23,25 @@
 
 """Tests for spamproc.py."""
 
+import concurrent.futures
+import imaplib
 import os
 import sys
+import threading
+import time
 try:
     import pytest
 except ImportError:
     pass
 
 from email.errors import MessageError
+from subprocess import TimeoutExpired
+from unittest import mock
 
 # We add the upper dir to the path
 sys.path.insert(0, os.path.abspath(os.path.join(
     os.path.dirname(__file__), '..')))
+from isbg import journal    # noqa: E402
 from isbg import spamproc   # noqa: E402
 from isbg import isbg       # noqa: E402
 from isbg.imaputils import new_message  # noqa: E402
@@ -124,6 +131,9 @@ def test_test_mail():
     with pytest.raises(OSError, match="No such file"):
         spamproc.test_mail(mail, cmd=["_____fooo___x_x"])
         pytest.fail("Should rise OSError.")
+    with pytest.raises(TimeoutExpired):
+        spamproc.test_mail(mail, cmd=["sleep", "10"], timeout=0.1)
+        pytest.fail("Should rise TimeoutExpired.")
 
 
 class Test_Sa_Learn(object):
@@ -136,6 +146,7 @@ class Test_Sa_Learn(object):
         assert learn.learned == 0
         assert len(learn.uids) == 0
         assert len(learn.newpastuids) == 0
+        assert len(learn.deferred) == 0
 
 
 class Test_Sa_Process(object):
@@ -147,9 +158,29 @@ class Test_Sa_Process(object):
         assert proc.nummsg == 0
         assert proc.numspam == 0
         assert proc.spamdeleted == 0
+        assert proc.numfuzzy == 0
         assert len(proc.uids) == 0
         assert len(proc.newpastuids) == 0
 
+    def test_add(self):
+        """Test add."""
+        proc = spamproc.Sa_Process()
+        batch = spamproc.Sa_Process()
+        batch.nummsg, batch.numspam, batch.pending = (3, 1, 7)
+        batch.uids, batch.newpastuids = ([5, 4, 3], [1, 2])
+        batch.tiers['local'] = [3, 0.5]
+        proc.add(batch)
+        proc.add(batch)
+        assert proc.nummsg == 6
+        assert proc.numspam == 2
+        assert proc.pending == 7
+        assert proc.uids == [5, 4, 3, 5, 4, 3]
+        assert proc.newpastuids == [1, 2]
+        assert proc.tiers['local'] == [6, 1.0]
+        batch.outliers.add('scan', 5.0, {'uid': 3})
+        proc.add(batch)
+        assert proc.outliers.slowest('scan') == [{'uid': 3, 'ms': 5.0}]
+
 
 class Test_SpamAssassin(object):
     """Tests for SpamAssassin."""
@@ -157,7 +188,10 @@ class Test_SpamAssassin(object):
     _kwargs = ['imap', 'spamc', 'logger', 'partialrun', 'dryrun',
                'learnthendestroy', 'gmail', 'learnthenflag', 'learnunflagged',
                'learnflagged', 'deletehigherthan', 'imapsets', 'maxsize',
-               'noreport', 'spamflags', 'delete', 'expunge']
+               'noreport', 'spamflags', 'delete', 'expunge', 'fuzzy',
+               'tierband', 'localspamd', 'scantimeout', 'deadline',
+               'backlogshare', 'actions', 'keywords', 'gate',
+               'learner', 'eventlog', 'slowest', 'session', 'stop']
 
     def test__kwars(self):
         """Test _kwargs is up to date."""
@@ -196,6 +230,56 @@ class Test_SpamAssassin(object):
         sa.spamc = False
         assert sa.cmd_test == ["spamassassin", "--exit-code"]
 
+    def test_cmd_test_local(self):
+        """Test cmd_test_local."""
+        sa = spamproc.SpamAssassin()
+        assert sa.cmd_test_local == ["spamassassin", "--exit-code", "--local"]
+        sa.spamc = True
+        sa.localspamd = "localhost:7830"
+        assert sa.cmd_test_local == ["spamc", "-E", "--max-size=268435450",
+                                     "-d", "localhost", "-p", "7830"]
+        sa.localspamd = "localhost"
+        assert sa.cmd_test_local[-2:] == ["-d", "localhost"]
+
+    def test_timeout(self):
+        """Test _timeout and _expired."""
+        sa = spamproc.SpamAssassin()
+        assert sa.timeout() is None
+        assert not sa._expired()
+        sa.scantimeout = 30
+        assert sa.timeout() == 30
+        sa.deadline = time.monotonic() + 10
+        assert 0 < sa.timeout() <= 10
+        assert not sa._expired()
+        sa.deadline = time.monotonic() - 10
+        assert sa.timeout() == 0
+        assert sa._expired()
+
+    def test_test_mail_tiers(self):
+        """Test _test_mail with tiers."""
+        sa = spamproc.SpamAssassin(tierband=2.0)
+        proc = spamproc.Sa_Process()
+        with mock.patch.object(spamproc, "test_mail",
+                               return_value=(u"1.0/5.0\n", 0, b"")) as tmail:
+            assert sa._test_mail("", proc)[0] == u"1.0/5.0\n"
+            tmail.assert_called_once_with("", cmd=sa.cmd_test_local,
+                                          timeout=None)
+        with mock.patch.object(spamproc, "test_mail",
+                               side_effect=[(u"4.0/5.0\n", 0, b""),
+                                            (u"6.5/5.0\n", 1, b"")]) as tmail:
+            assert sa._test_mail("", proc)[:2] == (u"6.5/5.0\n", 1)
+            tmail.assert_called_with("", cmd=sa.cmd_test, timeout=None)
+        assert proc.tiers['local'][0] == 2
+        assert proc.tiers['full'][0] == 1
+
+        sa.tierband = None
+        with mock.patch.object(spamproc, "test_mail",
+                               return_value=(u"4.0/5.0\n", 0, b"")) as tmail:
+            sa._test_mail("", proc)
+            tmail.assert_called_once_with("", cmd=sa.cmd_test,
+                                          timeout=None)
+        assert proc.tiers['local'][0] == 2
+
     def test_create_from_isbg(self):
         """Test create_from_isbg."""
         sbg = isbg.ISBG()
@@ -245,6 +329,114 @@ class Test_SpamAssassin(object):
         assert ret == [u'4', u'2']
         assert oripast == [3, 1], "Unexpected new orig past uids."
 
+    def test_schedule_uids(self):
+        """Test schedule_uids."""
+        uids = [u' '.join(str(u) for u in range(1, 11))]
+        sched = spamproc.SpamAssassin.schedule_uids
+        # Without backlog it's like get_formated_uids:
+        assert sched(uids, [], None) == (
+            [str(u) for u in range(10, 0, -1)], [], None, 0)
+        assert sched(uids, [10], 4) == ([u'9', u'8', u'7', u'6'], [10],
+                                        None, 5)
+        # With backlog, the walk goes down from the cursor and starts again:
+        assert sched(uids, [], 4, 0.5) == ([u'10', u'9', u'8', u'7'], [],
+                                           7, 6)
+        assert sched(uids, [], 4, 0.5, 7) == ([u'10', u'9', u'6', u'5'], [],
+                                              5, 6)
+        assert sched(uids, [], 4, 0.5, 2) == ([u'10', u'9', u'1'], [],
+                                              1, 7)
+        assert sched(uids, [], 4, 0.5, 1) == ([u'10', u'9', u'8', u'7'], [],
+                                              7, 6)
+        # At least one of the backlog is taken:
+        assert sched(uids, [], 4, 0.1)[0] == [u'10', u'9', u'8', u'7']
+
+    def test_replay_actions(self, tmpdir):
+        """Test the actions journal and replay_actions."""
+        actions = journal.ActionJournal(str(tmpdir.join("actions")))
+        imap = mock.Mock()
+        imap.get_uidvalidity.return_value = 7
+        imap.uid.return_value = ("OK", [""])
+        sa = spamproc.SpamAssassin(imap=imap, actions=actions)
+        assert sa.replay_actions() == 0
+
+        # A run that does a append, but not the final store:
+        sa._imap_action('append', 'Spam', message=b'mail', msgid='<1@x>')
+        sa._intend('store', 'INBOX', '3', ('+FLAGS', '(\\Seen)'))
+        sa._intend('copy', 'INBOX', '4', ('Spam',), msgid='<2@x>')
+        imap.append.assert_called_once_with('Spam', None, None, b'mail')
+        assert [a['op'] for a in actions.pending()] == ['store', 'copy']
+
+        # The next run only replays the pending actions:
+        actions = journal.ActionJournal(str(tmpdir.join("actions")))
+        imap = mock.Mock()
+        imap.get_uidvalidity.return_value = 7
+        imap.uid.return_value = ("OK", [""])
+        sa = spamproc.SpamAssassin(imap=imap, actions=actions)
+        assert sa.replay_actions() == 2
+        imap.uid.assert_any_call('STORE', '3', '+FLAGS', '(\\Seen)')
+        imap.uid.assert_called_with('COPY', '4', 'Spam')
+        imap.append.assert_not_called()
+        assert actions.pending() == []
+
+        # Copies already done and changed uidvalidities are not replayed:
+        sa._intend('copy', 'INBOX', '4', ('Spam',), msgid='<2@x>')
+        sa._intend('store', 'Other', '5', ('+FLAGS', '(\\Seen)'))
+        imap.uid.return_value = ("OK", ["12"])
+        imap.get_uidvalidity.side_effect = lambda mb: 8 if mb == 'Other' \
+            else 7
+        imap.uid.reset_mock()
+        sa = spamproc.SpamAssassin(imap=imap, actions=actions)
+        assert sa.replay_actions() == 0
+        imap.uid.assert_called_once_with('SEARCH', None, 'HEADER',
+                                         'Message-ID', '"<2@x>"')
+
+    def test_imap_action_synced(self, tmpdir):
+        """Test that the action is synced to disk before it's done."""
+        actions = journal.ActionJournal(str(tmpdir.join("actions")))
+        imap = mock.Mock()
+        imap.get_uidvalidity.return_value = 7
+        calls = []
+        imap.uid.side_effect = lambda *args: calls.append('uid') or \
+            ("OK", [""])
+        sa = spamproc.SpamAssassin(imap=imap, actions=actions)
+        with mock.patch.object(journal.os, "fsync",
+                               side_effect=lambda fd: calls.append('fsync')):
+            sa._imap_action('store', 'INBOX', '3', ('+FLAGS', '(\\Seen)'))
+        assert calls[:2] == ['fsync', 'uid']
+
+    def test_imap_action_reconnect(self, tmpdir):
+        """Test that a copy interrupted by a reconnection is resumed."""
+        actions = journal.ActionJournal(str(tmpdir.join("actions")))
+        imap = mock.Mock()
+        imap.selected = ('INBOX', False)
+        imap.get_uidvalidity.return_value = 7
+        imap.uid.side_effect = [imaplib.IMAP4.abort("EOF"), ("OK", [""]),
+                                ("OK", [""])]
+        sa = spamproc.SpamAssassin(imap=imap, actions=actions)
+        sa._imap_action('copy', 'INBOX', '4', ('Spam',), msgid='<2@x>')
+        imap.uid.assert_called_with('COPY', '4', 'Spam')
+        imap.select.assert_called_with('INBOX', False)
+        assert actions.pending() == []
+
+        # It's not repeated if the message has reached the mailbox:
+        imap.uid.side_effect = [imaplib.IMAP4.abort("EOF"), ("OK", ["12"])]
+        sa._imap_action('copy', 'INBOX', '5', ('Spam',), msgid='<3@x>')
+        imap.uid.assert_called_with('SEARCH', None, 'HEADER', 'Message-ID',
+                                    '"<3@x>"')
+        assert actions.pending() == []
+
+        # A connection reset, or a SSL error, is an OSError:
+        imap.uid.side_effect = [ConnectionResetError("reset"), ("OK", [""]),
+                                ("OK", [""])]
+        sa._imap_action('copy', 'INBOX', '6', ('Spam',), msgid='<4@x>')
+        imap.uid.assert_called_with('COPY', '6', 'Spam')
+        assert actions.pending() == []
+        imap.append.side_effect = [OSError("SSL error"), ("OK", [""])]
+        imap.uid.side_effect = [("OK", [""])]
+        sa._imap_action('append', 'Spam', message=b'mail', msgid='<5@x>')
+        assert imap.append.call_count == 2
+        assert actions.pending() == []
+
     def test_process_spam(self):
         """Test _process_spam."""
         sbg = isbg.ISBG()
@@ -259,6 +451,166 @@ class Test_SpamAssassin(object):
         sa.deletehigherthan = 2
         sa._process_spam(1, u"3/10\n", "", [], 0, "")
 
+    def test_keywords(self):
+        """Test process_inbox and learn with keywords."""
+        sbg = isbg.ISBG()
+        sbg.keywords = True
+        sa = spamproc.SpamAssassin.create_from_isbg(sbg)
+        sa.imap = mock.Mock()
+        sa.imap.uid.side_effect = lambda cmd, *args: \
+            ("OK", ["1 2"]) if cmd == "SEARCH" else \
+            ("OK", [(b"1 (BODY[] {20}", b"Subject: foo\r\n\r\nbar")])
+        with mock.patch.object(sa, "_test_mail",
+                               return_value=(u"1.5/5.0\n", 0, None)):
+            proc = sa.process_inbox([])
+        assert proc.nummsg == 2
+        sa.imap.uid.assert_any_call("SEARCH", None, "UNKEYWORD",
+                                    "$IsbgScanned", "SMALLER", "120000")
+        sa.imap.uid.assert_called_with(
+            "STORE", "1,2", "+FLAGS", "($IsbgScanned $IsbgScore1)")
+        assert list(proc.timings.phases) == ['search', 'fetch', 'unwrap',
+                                             'scan', 'store']
+        assert proc.timings.phases['fetch'].count == 2
+        assert proc.timings.phases['fetch'].nbytes == 38
+
+        # The uids in the track files (e.g. of a run that has not stored
+        # its keywords) are not processed again
+        with mock.patch.object(sa, "_test_mail",
+                               return_value=(u"1.5/5.0\n", 0, None)):
+            proc = sa.process_inbox([1])
+        assert proc.nummsg == 1
+        assert proc.newpastuids == [1]
+
+        with mock.patch.object(spamproc, "learn_mail", return_value=(5, 5)):
+            learned = sa.learn("Spam", "spam", None, [])
+        assert learned.learned == 2
+        assert learned.timings.phases['learn'].count == 2
+        sa.imap.uid.assert_any_call("SEARCH", None, "UNKEYWORD",
+                                    "$IsbgLearnedSpam")
+        # One STORE for all the messages learned
+        sa.imap.uid.assert_called_with("STORE", "1,2", "+FLAGS",
+                                       "($IsbgLearnedSpam)")
+        assert [c[0][3] for c in sa.imap.uid.call_args_list
+                if c[0][0] == "STORE"].count("($IsbgLearnedSpam)") == 1
+
+        # Without keywords allowed, only the track files are used
+        sa.imap.allows_keywords.return_value = False
+        sa.imap.uid.reset_mock()
+        with mock.patch.object(sa, "_test_mail",
+                               return_value=(u"1.5/5.0\n", 0, None)):
+            proc = sa.process_inbox([])
+        assert proc.nummsg == 2
+        sa.imap.allows_keywords.assert_called_with("$IsbgScanned",
+                                                   "$IsbgScore1")
+        assert "STORE" not in [c[0][0] for c in sa.imap.uid.call_args_list]
+        assert sa.keywords is False
+
+    def test_learn_gate(self):
+        """Test that learn waits for the gate."""
+        sbg = isbg.ISBG()
+        sbg.gate = threading.Event()
+        sa = spamproc.SpamAssassin.create_from_isbg(sbg)
+        sa.imap = mock.Mock()
+        sa.imap.uid.side_effect = lambda cmd, *args: \
+            ("OK", ["1"]) if cmd == "SEARCH" else \
+            ("OK", [(b"1 (BODY[] {20}", b"Subject: foo\r\n\r\nbar")])
+        timer = threading.Timer(0.2, sbg.gate.set)
+        start = time.monotonic()
+        timer.start()
+        with mock.patch.object(spamproc, "learn_mail", return_value=(5, 5)):
+            assert sa.learn("Spam", "spam", None, []).learned == 1
+        assert time.monotonic() - start >= 0.2
+
+        # It does not wait after the deadline:
+        sbg.gate.clear()
+        sa.deadline = time.monotonic()
+        assert sa.learn("Spam", "spam", None, []).deferred == ["1"]
+
+    def test_learn_overlaps_scan(self):
+        """Test that learn fetches the messages before the gate is set."""
+        sbg = isbg.ISBG()
+        sbg.gate = threading.Event()
+        sa = spamproc.SpamAssassin.create_from_isbg(sbg)
+        sa.imap = mock.Mock()
+        fetched = threading.Semaphore(0)
+
+        def uid(cmd, uids, *args):
+            if cmd == "SEARCH":
+                return ("OK", ["1 2"])
+            fetched.release()
+            return ("OK", [(uids.encode() + b" (BODY[] {20}",
+                            b"Subject: foo\r\n\r\nbar")])
+
+        sa.imap.uid.side_effect = uid
+        with mock.patch.object(spamproc, "learn_mail",
+                               return_value=(5, 5)) as learn_mail:
+            executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+            learning = executor.submit(sa.learn, "Spam", "spam", None, [])
+            try:
+                # Both messages are fetched while the inbox is scanned
+                assert fetched.acquire(timeout=5)
+                assert fetched.acquire(timeout=5)
+                assert not learn_mail.called
+            finally:
+                sbg.gate.set()
+                executor.shutdown()
+            assert learning.result().learned == 2
+        assert learn_mail.call_count == 2
+
+        # The fetch stops when MAX_PREFETCH messages wait for the gate:
+        sbg.gate.clear()
+        with mock.patch.object(spamproc, "learn_mail", return_value=(5, 5)), \
+                mock.patch.object(spamproc, "MAX_PREFETCH", 1):
+            executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+            learning = executor.submit(sa.learn, "Spam", "spam", None, [])
+            try:
+                assert fetched.acquire(timeout=5)
+                assert not fetched.acquire(timeout=0.5)
+            finally:
+                sbg.gate.set()
+                executor.shutdown()
+            assert learning.result().learned == 2
+        assert fetched.acquire(timeout=5)
+
+    def test_outliers(self):
+        """Test the slowest messages of process_inbox."""
+        sbg = isbg.ISBG()
+        sbg.slowest = 1
+        sa = spamproc.SpamAssassin.create_from_isbg(sbg)
+        sa.imap = mock.Mock()
+        sa.imap.uid.side_effect = lambda cmd, uid, *args: \
+            ("OK", ["1 2"]) if cmd == "SEARCH" else \
+            ("OK", [(b"1 (BODY[] {20}", b"Subject: foo\r\n\r\n" +
+                     b"x" * int(uid))])
+
+        def scan(mail, sa_proc):
+            time.sleep(0.01 * len(mail.get_payload()))
+            return u"1.5/5.0\n", 0, None
+
+        with mock.patch.object(sa, "_test_mail", side_effect=scan):
+            proc = sa.process_inbox([])
+        assert proc.outliers.size == 1
+        slowest = proc.outliers.slowest('scan')
+        assert len(slowest) == 1
+        assert slowest[0]['uid'] == 2
+        assert slowest[0]['size'] == 18
+        assert slowest[0]['parts'] == 1
+        assert slowest[0]['content_type'] == 'text/plain'
+        assert slowest[0]['action'] == 'ham'
+        assert slowest[0]['ms'] >= 20
+
+        # Nothing is kept with 0
+        sa.slowest = 0
+        with mock.patch.object(sa, "_test_mail", side_effect=scan):
+            assert not sa.process_inbox([]).outliers.phases
+
+    def test_score_keyword(self):
+        """Test score_keyword."""
+        assert spamproc.score_keyword(u"7.3/5.0\n") == "$IsbgScore7"
+        assert spamproc.score_keyword(u"-2.1/5.0\n") == "$IsbgScore0"
+        assert spamproc.score_keyword(u"99/5.0\n") == "$IsbgScore20"
+        assert spamproc.score_keyword(u"") is None
+
     def test_process_inbox(self):
         """Test process_inbox."""
         sbg = isbg.ISBG()
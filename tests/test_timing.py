@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  test_timing.py
+#  This file is part of isbg.
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+
+"""Test cases for timing module."""
+
+import os
+import sys
+try:
+    import pytest
+except ImportError:
+    pass
+
+# We add the upper dir to the path
+sys.path.insert(0, os.path.abspath(os.path.join(
+    os.path.dirname(__file__), '..')))
+from isbg import timing  # noqa: E402
+
+from unittest import mock  # noqa: E402
+
+
+class TestTimings(object):
+    """Tests for Timings."""
+
+    def test_span(self):
+        """Test span."""
+        timings = timing.Timings()
+        with mock.patch.object(timing.time, "monotonic",
+                               side_effect=[10.0, 12.0, 20.0, 20.5]):
+            with timings.span('fetch') as phase:
+                phase.nbytes += 100
+            with pytest.raises(ValueError):
+                with timings.span('fetch', nbytes=50):
+                    raise ValueError()
+        fetch = timings.phases['fetch']
+        assert (fetch.seconds, fetch.count, fetch.nbytes) == (2.5, 2, 150)
+        assert fetch.rate == 0.8
+        assert timing.Phase().rate == 0.0
+
+    def test_merge(self):
+        """Test add, merge and report."""
+        timings = timing.Timings()
+        timings.add('scan', 2.0, 4)
+        timings.add('search', 0.5)
+        total = timing.Timings()
+        total.merge(timings, 'inbox ')
+        total.merge(timings, 'inbox ')
+        assert list(total.phases) == ['inbox scan', 'inbox search']
+        assert total.report() == [
+            "inbox scan: 4.000s, 8 msgs, 0 bytes, 2.0 msgs/s",
+            "inbox search: 1.000s, 2 msgs, 0 bytes, 2.0 msgs/s"]
+
+
+def test_histogram():
+    """Test Histogram."""
+    hist = timing.Histogram((0.01, 0.1, 1.0))
+    assert hist.quantile(0.5) == 0.0
+    for value in [0.005] * 90 + [0.05] * 8 + [0.5, 3.0]:
+        hist.observe(value)
+    assert hist.counts == [90, 8, 1, 1]
+    assert (hist.count, hist.max) == (100, 3.0)
+    assert hist.quantile(0.50) == 0.01
+    assert hist.quantile(0.95) == 0.1
+    assert hist.quantile(0.99) == 1.0
+    assert hist.quantile(1.0) == 3.0
+    hist.add(hist)
+    assert hist.counts == [180, 16, 2, 2]
+
+
+def test_outliers():
+    """Test Outliers."""
+    outliers = timing.Outliers(2)
+    for uid, millis in enumerate([5.0, 1.0, 9.0, 7.0, 0.0]):
+        outliers.add('scan', millis, {'uid': uid})
+    assert not outliers.qualifies('scan', 6.0)
+    assert outliers.qualifies('fetch', 0.1)
+    assert outliers.slowest('scan') == [{'uid': 2, 'ms': 9.0},
+                                        {'uid': 3, 'ms': 7.0}]
+    assert outliers.slowest('fetch') == []
+
+    merged = timing.Outliers(1)
+    merged.merge(outliers, 'inbox ')
+    assert merged.slowest('inbox scan') == [{'uid': 2, 'ms': 9.0}]
+    assert merged.report() == [
+        "slowest inbox scan: uid 2 in None, 9.0ms, None bytes, None parts, "
+        "None"]
+
+    assert not timing.Outliers(0).qualifies('scan', 1.0)
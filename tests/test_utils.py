@@ -26,6 +26,8 @@
 import os
 import sys
 
+from subprocess import TimeoutExpired
+
 try:
     import pytest
 except ImportError:
@@ -73,6 +75,25 @@ def test_get_ascii_or_value():
     assert ret == {u'isbg': (u'IMAP', [u'Spam', u'Begone'])}, 'error'
 
 
+def test_communicate():
+    """Test communicate."""
+    proc = utils.popen(["cat"])
+    assert utils.communicate(proc, b"isbg", 5)[0] == b"isbg"
+    proc = utils.popen(["sleep", "10"])
+    with pytest.raises(TimeoutExpired):
+        utils.communicate(proc, b"", 0.1)
+        pytest.fail("Should rise TimeoutExpired.")
+    assert proc.returncode is not None, "The process should be killed."
+
+
+def test_pid_running():
+    """Test pid_running."""
+    assert utils.pid_running(os.getpid())
+    proc = utils.popen(["true"])
+    proc.communicate()
+    assert not utils.pid_running(proc.pid)
+
+
 def test_score_from_mail():
     """Test score_from_mail."""
     # Without score: